@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+'''Time gimplib.pixelio against per-pixel pixel region access.
+
+Reads an RGBA stub drawable into brightness and alpha values and writes
+a gray+alpha drawable back, once pixel by pixel with struct as the
+plug-ins used to and once with pixelio.  Run it from anywhere:
+
+    python benchmarks/bench_pixelio.py [size ...]
+
+The stub drawable keeps its pixels in python, so the absolute times
+are not those inside gimp, where each pixel region access is a call
+into the gimp core and the per-pixel code is slower still.'''
+
+import os
+import sys
+import random
+import struct
+import time
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+from gimplib import pixelio, stub
+
+
+def make_drawable(size,bpp):
+    rand = random.Random(size)
+    data = bytearray(rand.getrandbits(8) for i in range(size*size*bpp))
+    return stub.drawable(size,size,bpp,data)
+
+def read_per_pixel(drawable):
+    rgn = drawable.get_pixel_rgn(0,0,drawable.width,drawable.height,False,False)
+    fmt = 'B'*rgn.bpp
+    brightness = [[0]*rgn.w for j in range(rgn.h)]
+    alpha = [[0]*rgn.w for j in range(rgn.h)]
+    for j in range(rgn.h):
+        for i in range(rgn.w):
+            r,g,b,a = struct.unpack(fmt,rgn[i,j])
+            brightness[j][i] = r+g+b
+            alpha[j][i] = a
+    return brightness,alpha
+
+def read_pixelio(drawable):
+    pixels = pixelio.read(drawable)
+    return pixels[...,:3].sum(axis=-1,dtype=numpy.int32),pixels[...,3]
+
+def write_per_pixel(drawable,value):
+    rgn = drawable.get_pixel_rgn(0,0,drawable.width,drawable.height,True,False)
+    for j in range(rgn.h):
+        for i in range(rgn.w):
+            rgn[i,j] = struct.pack('BB',value,255)
+    drawable.flush()
+
+def write_pixelio(drawable,value):
+    pixels = numpy.empty((drawable.height,drawable.width,2),dtype=numpy.uint8)
+    pixels[...,0] = value
+    pixels[...,1] = 255
+    pixelio.write(drawable,pixels)
+
+def best_time(func,*args):
+    best = None
+    for i in range(3):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best: best = elapsed
+    return best
+
+def main(sizes):
+    print '%6s %12s %12s %8s %12s %12s %8s' % ('size','read/pixel','read/array','speedup',
+                                               'write/pixel','write/array','speedup')
+    for size in sizes:
+        rgba = make_drawable(size,4)
+        b1,a1 = read_per_pixel(rgba)
+        b2,a2 = read_pixelio(rgba)
+        assert (numpy.array(b1) == b2).all() and (numpy.array(a1) == a2).all()
+        rp = best_time(read_per_pixel,rgba)
+        ra = best_time(read_pixelio,rgba)
+        gray = stub.drawable(size,size,2)
+        wp = best_time(write_per_pixel,gray,128)
+        wa = best_time(write_pixelio,gray,128)
+        print '%6d %12.4f %12.4f %8.1f %12.4f %12.4f %8.1f' % (size,rp,ra,rp/ra,wp,wa,wp/wa)
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [64,128,256,512]
+    main(sizes)
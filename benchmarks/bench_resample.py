@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+'''Time and check the resample kernels on synthetic images.
+
+The test image is a sum of sinusoids below the Nyquist frequency, so
+the exact value of the warped image is known everywhere and each
+kernel's RMS error can be measured as well as its time.  Each warp is
+timed twice, the first time including building its weights and the
+second time taking them from the cache.  Run it from anywhere:
+
+    python benchmarks/bench_resample.py [size ...]
+
+Inside gimp (from the Python-Fu console) the same warps are also done
+with gimp_drawable_transform_matrix for each gimp interpolation type:
+
+    import sys ; sys.path.insert(0,'/path/to/benchmarks')
+    import bench_resample ; bench_resample.main([512],use_gimp=True)
+
+The error of the gimp warps includes the rounding to 8 bits, so it is
+about 0.3 levels larger for the same accuracy.'''
+
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+from gimplib import resample, pixelio
+
+# (frequency x, frequency y, amplitude) in cycles per pixel
+waves = ((0.013,0.004,60.0),(-0.031,0.052,35.0),(0.11,0.07,20.0))
+kernels = ('nearest','linear','cubic','lanczos3')
+gimp_interpolations = (('nearest',0),('linear',1),('cubic',2),('lanczos3',3))
+border = 8     # pixels left out of the error at the edges
+
+
+def signal(x,y):
+    '''The test image at coordinates x,y (0 to 255).'''
+    value = 127.5
+    for fx,fy,a in waves:
+        value = value + a*numpy.cos(2.0*math.pi*(fx*x+fy*y))
+    return value
+
+def image(size,channels=1):
+    x,y = resample.grid((size,size))
+    values = signal(x,y)
+    if channels == 1: return values
+    return numpy.dstack([values]*channels)
+
+def transforms(size):
+    '''Output to input matrices (column vectors) and output shapes.'''
+    c = (size-1)/2.0
+    angle = math.radians(7.0) ; s = 0.93
+    ca = math.cos(angle)*s ; sa = math.sin(angle)*s
+    rotate = numpy.array([[ca,-sa,c-ca*c+sa*c],[sa,ca,c-sa*c-ca*c],[0.0,0.0,1.0]])
+    shift = numpy.array([[1.0,0.0,0.37],[0.0,1.0,-0.61],[0.0,0.0,1.0]])
+    up = numpy.array([[1/1.7,0.0,0.2],[0.0,1/1.7,0.3],[0.0,0.0,1.0]])
+    down = numpy.array([[2.5,0.0,0.75],[0.0,2.5,0.75],[0.0,0.0,1.0]])
+    return [('rotate+scale',rotate,(size,size)),
+            ('subpixel shift',shift,(size,size)),
+            ('scale up 1.7',up,(size,size)),
+            ('scale down 2.5',down,(size*2//5,size*2//5))]
+
+def expected(matrix,shape,smooth=1.0):
+    '''The exact warped image, with the waves above the output Nyquist
+       frequency removed when scaling down (smooth is the scale).'''
+    x,y = resample.grid(shape)
+    xs = matrix[0,0]*x + matrix[0,1]*y + matrix[0,2]
+    ys = matrix[1,0]*x + matrix[1,1]*y + matrix[1,2]
+    value = 127.5
+    for fx,fy,a in waves:
+        if max(abs(fx),abs(fy))*smooth < 0.5:
+            value = value + a*numpy.cos(2.0*math.pi*(fx*xs+fy*ys))
+    return value
+
+def rms_error(values,inside,truth):
+    ok = inside.copy()
+    ok[:border,:] = False ; ok[-border:,:] = False
+    ok[:,:border] = False ; ok[:,-border:] = False
+    if not ok.any(): return float('nan')
+    return math.sqrt(((values-truth)[ok]**2).mean())
+
+def timed(func,*args):
+    start = time.time()
+    result = func(*args)
+    return result,time.time()-start
+
+def bench_kernels(size):
+    print 'size %d: time (s) first / cached, rms error (levels)' % size
+    print '%-16s %-9s %9s %9s %9s %9s' % ('transform','kernel','first','cached','rgb','error')
+    single = image(size)
+    rgb = image(size,3)
+    for name,matrix,shape in transforms(size):
+        scale = max(matrix[0,0],1.0) if resample.is_scale_translate(matrix) else 1.0
+        truth = expected(matrix,shape,scale)
+        for kernel in kernels:
+            del resample._cache[:]
+            (values,inside),first = timed(resample.warp,single,matrix,shape,kernel)
+            (values,inside),cached = timed(resample.warp,single,matrix,shape,kernel)
+            (colors,inside),color = timed(resample.warp,rgb,matrix,shape,kernel)
+            print '%-16s %-9s %9.4f %9.4f %9.4f %9.3f' % (name,kernel,first,cached,color,
+                                                         rms_error(values,inside,truth))
+    print
+
+def gimp_warp(pixels,matrix,interpolation):
+    '''Warp a gray image with gimp_drawable_transform_matrix, same size out.'''
+    import gimp
+    size = pixels.shape[0]
+    img = gimp.pdb.gimp_image_new(size,size,1)          # GRAY
+    try:
+        layer = gimp.pdb.gimp_layer_new(img,size,size,2,'bench',100,0)   # GRAY_IMAGE
+        gimp.pdb.gimp_image_add_layer(img,layer,0)
+        pixelio.write(layer,pixelio.as_uint8(pixels/255.0))
+        # gimp takes forward matrices on coordinates with pixel centers at +0.5
+        center = numpy.array([[1.0,0.0,0.5],[0.0,1.0,0.5],[0.0,0.0,1.0]])
+        w = numpy.dot(center,numpy.dot(numpy.linalg.inv(matrix),numpy.linalg.inv(center)))
+        start = time.time()
+        gimp.pdb.gimp_drawable_transform_matrix(layer,w[0,0],w[0,1],w[0,2],
+                                                w[1,0],w[1,1],w[1,2],
+                                                w[2,0],w[2,1],w[2,2],
+                                                0,interpolation,0,3,1)
+        elapsed = time.time() - start
+        layer = img.layers[0]
+        x0,y0 = layer.offsets
+        result = numpy.zeros((size,size))
+        inside = numpy.zeros((size,size),dtype=bool)
+        values = pixelio.read(layer)
+        if values.ndim == 3: values = values[...,0]
+        h,w2 = values.shape
+        xa,ya = max(x0,0),max(y0,0)
+        xb,yb = min(x0+w2,size),min(y0+h,size)
+        result[ya:yb,xa:xb] = values[ya-y0:yb-y0,xa-x0:xb-x0]
+        inside[ya:yb,xa:xb] = True
+        return result,inside,elapsed
+    finally:
+        gimp.pdb.gimp_image_delete(img)
+
+def bench_gimp(size):
+    print 'size %d: gimp_drawable_transform_matrix against resample.warp' % size
+    print '%-16s %-9s %9s %9s %9s %9s' % ('transform','kernel','gimp','warp','gimp err','warp err')
+    single = image(size)
+    for name,matrix,shape in transforms(size):
+        if shape != (size,size): continue       # gimp keeps the layer size here
+        truth = expected(matrix,shape)
+        for kernel,interpolation in gimp_interpolations:
+            gvalues,ginside,gtime = gimp_warp(single,matrix,interpolation)
+            (values,inside),wtime = timed(resample.warp,single,matrix,shape,kernel)
+            print '%-16s %-9s %9.4f %9.4f %9.3f %9.3f' % (name,kernel,gtime,wtime,
+                                                         rms_error(gvalues,ginside & inside,truth),
+                                                         rms_error(values,inside,truth))
+    print
+
+def main(sizes,use_gimp=False):
+    for size in sizes:
+        bench_kernels(size)
+        if use_gimp: bench_gimp(size)
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [256,512,1024]
+    main(sizes)
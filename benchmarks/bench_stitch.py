@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+'''Benchmark the numerical kernels of stitch panorama on synthetic images.
+
+stitch_0.9.6.py is imported outside of gimp with the stub modules of
+gimplib.stub.  For each size a synthetic reference/transformed pair
+with a known similarity transform, radial distortion and noise is made
+(stub drawables holding the pixels), and
+
+  * the kernels svd, matrixmultiply, rss2transform, compute_transform_matrix,
+    triangulate, amoeba and compute_correlation are timed and checked
+    against their exact answers;
+  * the control point pipeline is run end to end as the plug-in runs
+    it: get_new_control_point refines a grid of roughly placed points
+    (simplex and, with numpy, ECC), the transform is fitted and the
+    points triangulated as in remove_distortion.  The points and the
+    fit are compared with the true mapping; the point errors are the
+    RMS over the points which did not fail (off by less than a pixel)
+    and the largest error of all.
+
+The warping and blending themselves are done by the gimp core and are
+not run.  Results are printed and, with --output, saved as JSON so runs
+can be compared:
+
+    python benchmarks/bench_stitch.py --sizes 256 --sizes 1024 --output results.json
+
+The 8192 pixel pair takes about 400 MB of memory.'''
+
+import imp
+import json
+import math
+import optparse
+import os
+import platform
+import random
+import sys
+import time
+
+sys.dont_write_bytecode = True   # keep imp.load_source from writing stitch_0.9.6.pyc
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,root)
+
+import numpy
+from gimplib import stub
+
+stub.install_modules()
+stitch = imp.load_source('stitch_panorama',os.path.join(root,'stitch_0.9.6.py'))
+
+sizes = [256,512,1024,2048,4096,8192]
+patch = 64          # selection size for the control points
+strip = 256         # rows of the synthetic images made at a time
+failed = 1.0        # control points off by more than this (pixels) have failed
+
+
+#------------ synthetic images
+
+class scene(object):
+    '''A random texture with detail at two scales, defined everywhere.
+
+       The texture is periodic (period 256*scale) so any size can be
+       sampled without storing it.'''
+    def __init__(self,seed=1):
+        rng = numpy.random.RandomState(seed)
+        self.bases = []
+        for scale,weight in ((2.7,0.6),(17.3,0.4)):
+            base = rng.rand(256,256)
+            for i in range(3):   # smooth, keeping it periodic
+                base = (4*base + numpy.roll(base,1,0) + numpy.roll(base,-1,0) +
+                        numpy.roll(base,1,1) + numpy.roll(base,-1,1))/8.0
+            base = (base-base.min())/(base.max()-base.min())
+            self.bases.append((base,scale,weight))
+    def __call__(self,x,y):
+        '''Brightness in [0,1] at float coordinate arrays x,y.'''
+        value = numpy.zeros(x.shape)
+        for base,scale,weight in self.bases:
+            u = x/scale ; v = y/scale
+            u0 = numpy.floor(u) ; v0 = numpy.floor(v)
+            fu = u-u0 ; fv = v-v0
+            i0 = u0.astype(int) % 256 ; j0 = v0.astype(int) % 256
+            i1 = (i0+1) % 256 ; j1 = (j0+1) % 256
+            value += weight*((1-fv)*((1-fu)*base[j0,i0] + fu*base[j0,i1]) +
+                             fv*((1-fu)*base[j1,i0] + fu*base[j1,i1]))
+        return value
+
+class pair(object):
+    '''A reference and transformed image of size x size with a known mapping.
+
+       The transformed image at t shows the scene at
+       similarity(undistort(t)), where undistort is a radial
+       distortion about the image center and similarity a rotation,
+       scale and shift.  The reference image shows the scene as is.'''
+    def __init__(self,size,angle=0.02,scale=1.02,shift=None,k1=2.e-8,noise=0.01,seed=1):
+        self.size = size
+        self.angle = angle
+        self.scale = scale
+        if shift is None: shift = (0.15*size,0.03*size)
+        self.shift = shift
+        self.k1 = k1*(1024.0/size)**2    # same relative distortion for all sizes
+        self.noise = noise
+        self.center = ((size-1)/2.0,(size-1)/2.0)
+        texture = scene(seed)
+        rng = numpy.random.RandomState(seed+1)
+        self.reference = self.make_layer(texture,rng,lambda x,y: (x,y))
+        self.transformed = self.make_layer(texture,rng,self.to_reference)
+    def make_layer(self,texture,rng,mapping):
+        layer = stub.drawable(self.size,self.size,3)
+        x = numpy.arange(self.size,dtype=numpy.float64)
+        for y0 in range(0,self.size,strip):
+            y1 = min(y0+strip,self.size)
+            xs,ys = numpy.meshgrid(x,numpy.arange(y0,y1,dtype=numpy.float64))
+            value = texture(*mapping(xs,ys))
+            value = value + rng.normal(0.0,self.noise,value.shape)
+            value = numpy.clip(numpy.round(value*230.0+10.0),0,255).astype(numpy.uint8)
+            rgb = numpy.dstack((value,value,value))
+            layer.data[y0*self.size*3:y1*self.size*3] = rgb.tobytes()
+        return layer
+    def distort(self,x,y,sign=1.0):
+        cx,cy = self.center
+        factor = 1.0 + sign*self.k1*((x-cx)**2+(y-cy)**2)
+        return cx+(x-cx)*factor,cy+(y-cy)*factor
+    def to_reference(self,x,y):
+        '''The true position in the reference image of t = (x,y).'''
+        x,y = self.distort(x,y)
+        c = math.cos(self.angle)*self.scale ; s = math.sin(self.angle)*self.scale
+        return c*x - s*y + self.shift[0], s*x + c*y + self.shift[1]
+    def to_transformed(self,x,y):
+        '''The true position in the transformed image of r = (x,y).'''
+        c = math.cos(self.angle)/self.scale ; s = math.sin(self.angle)/self.scale
+        x = x - self.shift[0] ; y = y - self.shift[1]
+        qx,qy = c*x + s*y, -s*x + c*y
+        px,py = qx,qy
+        for i in range(20):      # invert the distortion by fixed point iteration
+            dx,dy = self.distort(px,py)
+            px,py = px+(qx-dx),py+(qy-dy)
+        return px,py
+    def images(self):
+        rimage = stub.image(self.size,self.size,name='reference')
+        timage = stub.image(self.size,self.size,name='transformed')
+        rimage.layers = [self.reference]
+        timage.layers = [self.transformed]
+        return rimage,timage
+
+#------------ timing
+
+def best_time(func,repeat=3,number=1):
+    '''Best time of repeat runs of number calls of func, per call.'''
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for j in range(number):
+            func()
+        elapsed = (time.time()-start)/number
+        if best is None or elapsed < best: best = elapsed
+    return best
+
+def hull_area(points):
+    '''Area of the convex hull of (x,y) points (monotone chain).'''
+    points = sorted(set(points))
+    def cross(o,a,b):
+        return (a[0]-o[0])*(b[1]-o[1]) - (a[1]-o[1])*(b[0]-o[0])
+    lower = [] ; upper = []
+    for p in points:
+        while len(lower) >= 2 and cross(lower[-2],lower[-1],p) <= 0: lower.pop()
+        lower.append(p)
+    for p in reversed(points):
+        while len(upper) >= 2 and cross(upper[-2],upper[-1],p) <= 0: upper.pop()
+        upper.append(p)
+    hull = lower[:-1] + upper[:-1]
+    return abs(sum([hull[i][0]*hull[i-1][1] - hull[i-1][0]*hull[i][1]
+                    for i in range(len(hull))]))/2.0
+
+def triangle_area(a,b,c):
+    return abs((b[0]-a[0])*(c[1]-a[1]) - (b[1]-a[1])*(c[0]-a[0]))/2.0
+
+#------------ kernels
+
+def bench_kernels(repeat):
+    '''Time the numerical kernels and check them against exact answers.'''
+    rand = random.Random(7)
+    results = []
+    def add(kernel,seconds,error,**extra):
+        entry = {'kernel':kernel,'seconds':seconds,'error':error}
+        entry.update(extra)
+        results.append(entry)
+
+    for n in (3,10,50):
+        a = [[rand.uniform(0,1000),rand.uniform(0,1000),1.0] for i in range(n)]
+        u,w,v = stitch.svd(a)
+        usv = numpy.dot(numpy.dot(u,numpy.diag(w)),numpy.transpose(v))
+        add('svd',best_time(lambda: stitch.svd(a),repeat,10),
+            float(numpy.abs(usv-numpy.array(a)).max()),npoints=n)
+
+    a = [[rand.uniform(-1,1) for j in range(3)] for i in range(3)]
+    b = [[rand.uniform(-1,1) for j in range(3)] for i in range(3)]
+    add('matrixmultiply',best_time(lambda: stitch.matrixmultiply(a,b),repeat,1000),
+        float(numpy.abs(numpy.array(stitch.matrixmultiply(a,b))-numpy.dot(a,b)).max()))
+
+    var = (3.5,-2.25,0.03,1.01)
+    m = stitch.rss2transform(var[0],var[1],var[2],var[3],64,64)
+    back = stitch.transform2rss(m,64,64)
+    add('rss2transform',best_time(lambda: stitch.rss2transform(3.5,-2.25,0.03,1.01,64,64),
+                                  repeat,1000),
+        max([abs(x-y) for x,y in zip(var,back)]))
+
+    truth = [[1.01,0.02,0.0],[-0.02,0.99,0.0],[35.0,-12.0,1.0]]
+    for n in (3,10,50):
+        tarray = [[rand.uniform(0,1000),rand.uniform(0,1000),1.0] for i in range(n)]
+        rarray = [list(stitch.xytransform(truth,t[0],t[1]))+[1.0] for t in tarray]
+        m = stitch.compute_transform_matrix(rarray,tarray)
+        add('compute_transform_matrix',
+            best_time(lambda: stitch.compute_transform_matrix(rarray,tarray),repeat,10),
+            float(numpy.abs(numpy.array(m)-truth).max()),npoints=n)
+
+    for n in (8,16,24):
+        tarr = [[rand.uniform(0,1000),rand.uniform(0,1000),1.0] for i in range(n)]
+        tarr += [[0.0,0.0,1.0],[0.0,1000.0,1.0],[1000.0,0.0,1.0],[1000.0,1000.0,1.0]]
+        triangles = stitch.triangulate(tarr)
+        area = sum([triangle_area(tarr[i],tarr[j],tarr[k]) for i,j,k in triangles])
+        add('triangulate',best_time(lambda: stitch.triangulate(tarr),1,1),
+            abs(area-hull_area([(p[0],p[1]) for p in tarr]))/1.e6,
+            npoints=len(tarr),ntriangles=len(triangles))
+
+    optimum = [3.0,-1.0,0.02,1.05]
+    def func(var,data=None):
+        return -sum([(x-o)**2/s for x,o,s in zip(var,optimum,[10.,10.,0.01,0.01])])
+    result = stitch.amoeba([0.0,0.0,0.0,1.0],[2.0,2.0,0.1,0.1],func,1.e-8,1.e-8,500)
+    add('amoeba',best_time(lambda: stitch.amoeba([0.0,0.0,0.0,1.0],[2.0,2.0,0.1,0.1],
+                                                 func,1.e-8,1.e-8,500),repeat),
+        max([abs(x-o) for x,o in zip(result[0],optimum)]),iterations=result[2])
+
+    rlayer = stub.drawable(patch,patch,4)
+    tlayer = stub.drawable(patch,patch,4)
+    rng = numpy.random.RandomState(3)
+    rpix = rng.randint(0,256,(patch,patch,4)).astype(numpy.uint8)
+    tpix = rng.randint(0,256,(patch,patch,4)).astype(numpy.uint8)
+    tpix[...,:3] = rpix[...,:3]//2 + tpix[...,:3]//2
+    rpix[...,3] = tpix[...,3] = 255
+    rpix[:5,:,3] = 0
+    rlayer.data[:] = rpix.tobytes() ; tlayer.data[:] = tpix.tobytes()
+    rrgn = rlayer.get_pixel_rgn(0,0,patch,patch,False,False)
+    trgn = tlayer.get_pixel_rgn(0,0,patch,patch,False,False)
+    fast = stitch.compute_correlation(rrgn,trgn)
+    stitch_numpy = stitch.numpy
+    stitch.numpy = None        # the pure python path
+    try:
+        slow = stitch.compute_correlation(rrgn,trgn)
+        add('compute_correlation',best_time(lambda: stitch.compute_correlation(rrgn,trgn),repeat),
+            abs(slow-fast),path='python',patch=patch)
+    finally:
+        stitch.numpy = stitch_numpy
+    add('compute_correlation',best_time(lambda: stitch.compute_correlation(rrgn,trgn),repeat,10),
+        abs(slow-fast),path='numpy',patch=patch)
+    return results
+
+#------------ pipeline
+
+def bench_pipeline(size,grid=4,offset=3.0,methods=('amoeba','ecc')):
+    '''Run the control point pipeline on a size x size pair.'''
+    results = []
+    start = time.time()
+    images = pair(size)
+    setup = time.time()-start
+    rimage,timage = images.images()
+    rand = random.Random(size)
+    margin = max(patch,size//8)
+    inside = patch//2 + int(offset) + 2
+    xs = [margin + i*(size-1-2*margin)/float(grid-1) for i in range(grid)]
+    # reference points whose true position is well inside the transformed image
+    points = []
+    for y in xs:
+        for x in xs:
+            tx,ty = images.to_transformed(x,y)
+            if inside <= tx < size-inside and inside <= ty < size-inside:
+                points.append((x,y,tx,ty))
+    # in no particular order, as a user would add them (the first three
+    # in a row would give initial_rotation_scale a degenerate fit)
+    rand.shuffle(points)
+    for method in methods:
+        if method == 'ecc' and stitch.numpy is None: continue
+        s = stitch.stitchable(stitch.RUN_NONINTERACTIVE,rimage,timage)
+        s.rimglayer = images.reference
+        s.timglayer = images.transformed
+        s.refine_method = method
+        errors = []
+        start = time.time()
+        for x,y,tx,ty in points:
+            # the user's guess of the transformed point is a few pixels off
+            gx = int(round(tx + rand.uniform(-offset,offset)))
+            gy = int(round(ty + rand.uniform(-offset,offset)))
+            rimage.select_rectangle(int(round(x))-patch//2,int(round(y))-patch//2,patch,patch)
+            timage.select_rectangle(gx-patch//2,gy-patch//2,patch,patch)
+            cp = stitch.get_new_control_point(s)
+            s.add_control_point(cp)
+            ex,ey = images.to_transformed(cp.x1(),cp.y1())
+            errors.append(math.hypot(cp.x2()-ex,cp.y2()-ey))
+        correlate_time = time.time()-start
+        good = [e for e in errors if e < failed]
+        start = time.time()
+        tarr = [[cp.x2(),cp.y2(),1.0] for cp in s.control_points]
+        tarr += [[0.0,0.0,1.0],[0.0,size,1.0],[size,0.0,1.0],[size,size,1.0]]
+        triangles = stitch.triangulate(tarr)
+        triangulate_time = time.time()-start
+        # the fitted transform against the true mapping over the image
+        fit_errors = []
+        for v in numpy.linspace(0,size-1,9):
+            for u in numpy.linspace(0,size-1,9):
+                fx,fy = stitch.xytransform(s.transform,u,v)
+                tx,ty = images.to_reference(u,v)
+                fit_errors.append(math.hypot(fx-tx,fy-ty))
+        results.append({'size':size,'method':method,'npoints':len(points),
+                        'setup_seconds':setup,
+                        'correlate_seconds':correlate_time,
+                        'seconds_per_point':correlate_time/max(len(points),1),
+                        'fit_seconds':s.fit_report.solve_time,
+                        'triangulate_seconds':triangulate_time,
+                        'ntriangles':len(triangles),
+                        'failed_points':len(errors)-len(good),
+                        'point_rms_error':math.sqrt(sum([e*e for e in good])/max(len(good),1)),
+                        'point_max_error':max(errors or [0.0]),
+                        'fit_rms_residual':s.fit_report.rms,
+                        'condition_number':s.fit_report.condition_number,
+                        'transform_max_error':max(fit_errors)})
+    return results
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes',type='int',action='append',
+                      help='image size (repeat for several, default %s)' %
+                           ' '.join([str(s) for s in sizes[:4]]))
+    parser.add_option('--repeat',type='int',default=3,help='timing repeats (default 3)')
+    parser.add_option('--grid',type='int',default=4,help='control points per side (default 4)')
+    parser.add_option('--output',help='save the results as JSON to this file')
+    options,args = parser.parse_args()
+    run_sizes = (options.sizes or []) + [int(a) for a in args] or sizes[:4]
+
+    kernels = bench_kernels(options.repeat)
+    print '%-26s %12s %12s  %s' % ('kernel','seconds','error','')
+    for r in kernels:
+        extra = ' '.join(['%s=%s' % (k,r[k]) for k in sorted(r)
+                          if k not in ('kernel','seconds','error')])
+        print '%-26s %12.6f %12.3g  %s' % (r['kernel'],r['seconds'],r['error'],extra)
+
+    pipeline = []
+    print
+    print '%6s %7s %7s %7s %10s %10s %10s %10s %12s' % ('size','method','points','failed',
+                                                      's/point','point rms','point max',
+                                                      'fit rms','transform')
+    for size in run_sizes:
+        for r in bench_pipeline(size,options.grid):
+            pipeline.append(r)
+            print '%6d %7s %7d %7d %10.4f %10.4f %10.4f %10.4f %12.4f' % \
+                  (size,r['method'],r['npoints'],r['failed_points'],
+                   r['seconds_per_point'],r['point_rms_error'],
+                   r['point_max_error'],r['fit_rms_residual'],r['transform_max_error'])
+
+    if options.output:
+        f = open(options.output,'w')
+        try:
+            json.dump({'time':time.time(),
+                       'python':platform.python_version(),
+                       'platform':platform.platform(),
+                       'numpy':numpy.__version__,
+                       'stitch':stitch.stitch_plugin.version,
+                       'kernels':kernels,
+                       'pipeline':pipeline},f,indent=1,sort_keys=True)
+        finally:
+            f.close()
+
+if __name__ == '__main__':
+    main()
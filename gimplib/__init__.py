@@ -0,0 +1,6 @@
+'''Support modules for the python-fu plug-ins in this directory.
+
+The modules in this package are not plug-ins themselves.  They hold the
+array based code used by the plug-ins and most of them need numpy.  The
+plug-ins import them inside a try block and fall back to the gimp pdb
+when numpy (or this package) is not available.'''
@@ -0,0 +1,282 @@
+'''Blending masks for stitch panorama computed with numpy.
+
+The feathering mode weights each warped layer by the distance from a
+pixel to the nearest invalid (transparent) pixel of that layer.  The
+distances are exact euclidean distances computed with the linear time
+lower envelope algorithm of Felzenszwalb & Huttenlocher, "Distance
+Transforms of Sampled Functions" (2004), run over all the rows (then
+all the columns) of an image at once.
+
+The seam mode instead cuts the overlap along a minimum cost path so that
+moving objects are taken from one image only.  The path is found with
+dynamic programming, first on a block averaged copy of the cost and then
+at full resolution in a narrow band around the coarse path.'''
+
+import math
+import numpy
+
+from gimplib import pixelio
+
+big = 1.e20   # stands in for infinity in the squared distances
+
+
+def _edt_rows(f):
+    '''Exact 1-D squared distance transform along each row of f.
+
+       f is a 2-D float array of squared distances: 0.0 at the feature
+       pixels and big everywhere else.  All rows are processed at the
+       same time, so the python loops run over the columns only.'''
+    m,n = f.shape
+    d = numpy.empty_like(f)
+    if n == 0 or m == 0: return d
+    rows = numpy.arange(m)
+    v = numpy.zeros((m,n),dtype=numpy.intp)     # parabola vertices
+    z = numpy.empty((m,n+1),dtype=numpy.float64) # envelope boundaries
+    z[:,0] = -numpy.inf
+    z[:,1] = +numpy.inf
+    k = numpy.zeros(m,dtype=numpy.intp)         # number of parabolas - 1
+    # build the lower envelope of the parabolas
+    for q in range(1,n):
+        fq = f[:,q] + float(q*q)
+        while True:
+            vk = v[rows,k]
+            s = (fq - (f[rows,vk] + vk*vk)) / (2.0*(q-vk))
+            pop = s <= z[rows,k]
+            if not pop.any(): break
+            k[pop] -= 1
+        k += 1
+        v[rows,k] = q
+        z[rows,k] = s
+        z[rows,k+1] = +numpy.inf
+    # fill in the distances from the envelope
+    k[:] = 0
+    for q in range(n):
+        while True:
+            step = z[rows,k+1] < q
+            if not step.any(): break
+            k[step] += 1
+        vk = v[rows,k]
+        d[:,q] = (q-vk)**2 + f[rows,vk]
+    return d
+
+def distance_transform(valid):
+    '''Euclidean distance from each valid pixel to the nearest invalid pixel.
+
+       valid is a 2-D boolean array.  Pixels outside the array are not
+       considered, so pad the array with invalid pixels if the edges
+       should count.  Invalid pixels get a distance of 0.0.  If there are
+       no invalid pixels at all, the distances are huge.'''
+    f = numpy.where(valid,big,0.0)
+    f = _edt_rows(f.T).T    # columns first
+    f = _edt_rows(f)        # then rows
+    return numpy.sqrt(f)
+
+def feather_weights(rdistance,tdistance,feather):
+    '''Opacity of the reference layer given the distances in both layers.
+
+       Each layer gets a weight that ramps linearly from 0 at its edge
+       to 1 at a distance of feather pixels.  The reference layer sits on
+       top of the transformed layer, so its opacity is its share of the
+       total weight.  Where the transformed layer is invalid the
+       reference is fully opaque.'''
+    feather = max(float(feather),1.0)
+    rweight = numpy.minimum(rdistance/feather,1.0)
+    tweight = numpy.minimum(tdistance/feather,1.0)
+    total = rweight + tweight
+    alpha = numpy.where(total > 0.0,rweight/numpy.where(total > 0.0,total,1.0),1.0)
+    alpha[tweight <= 0.0] = 1.0
+    return alpha
+
+def _layer_window(layer,mask,x0,y0,x1,y1):
+    '''Get the valid pixels of a layer within x0,y0,x1,y1 (image coordinates).
+
+       Pixels outside of the layer are invalid.'''
+    valid = numpy.zeros((y1-y0,x1-x0),dtype=bool)
+    lx,ly = layer.offsets
+    ix0 = max(x0,lx)
+    iy0 = max(y0,ly)
+    ix1 = min(x1,lx+layer.width)
+    iy1 = min(y1,ly+layer.height)
+    if ix1 > ix0 and iy1 > iy0:
+        m = pixelio.read(mask,ix0-lx,iy0-ly,ix1-ix0,iy1-iy0)
+        valid[iy0-y0:iy1-y0,ix0-x0:ix1-x0] = m >= 128
+    return valid
+
+def feather_layer_masks(rlayer,rmask,tlayer,tmask,blend_fraction):
+    '''Replace the reference mask in the overlap by a distance feather.
+
+       The overlap is the intersection of the two layers.  The feather
+       width is blend_fraction times the narrow dimension of the overlap.
+       The transformed mask is left alone: it already marks the valid
+       pixels of the warped layer.  Returns False if the layers do not
+       overlap.'''
+    rx,ry = rlayer.offsets
+    tx,ty = tlayer.offsets
+    ox0 = max(rx,tx)
+    oy0 = max(ry,ty)
+    ox1 = min(rx+rlayer.width,tx+tlayer.width)
+    oy1 = min(ry+rlayer.height,ty+tlayer.height)
+    if ox1 <= ox0 or oy1 <= oy0: return False
+    feather = max(blend_fraction*min(ox1-ox0,oy1-oy0),1.0)
+    # Distances beyond the feather width do not matter, so only the
+    # overlap plus a margin of the feather width is transformed.
+    margin = int(math.ceil(feather))+1
+    wx0 = ox0-margin ; wy0 = oy0-margin
+    wx1 = ox1+margin ; wy1 = oy1+margin
+    rvalid = _layer_window(rlayer,rmask,wx0,wy0,wx1,wy1)
+    tvalid = _layer_window(tlayer,tmask,wx0,wy0,wx1,wy1)
+    rdistance = distance_transform(rvalid)
+    tdistance = distance_transform(tvalid)
+    alpha = feather_weights(rdistance,tdistance,feather)
+    alpha[~rvalid] = 0.0
+    inner = (slice(oy0-wy0,oy1-wy0),slice(ox0-wx0,ox1-wx0))
+    pixelio.write(rmask,alpha[inner],ox0-rx,oy0-ry)
+    return True
+
+
+def _overlap(rlayer,tlayer):
+    '''The intersection of two layers as x0,y0,x1,y1 (image coordinates).'''
+    rx,ry = rlayer.offsets
+    tx,ty = tlayer.offsets
+    return (max(rx,tx),max(ry,ty),
+            min(rx+rlayer.width,tx+tlayer.width),
+            min(ry+rlayer.height,ty+tlayer.height))
+
+def _layer_colors(layer,x0,y0,x1,y1):
+    '''Get the color channels of a layer in x0,y0,x1,y1 as floats.
+
+       The rectangle must lie inside the layer.  Gray layers are
+       returned with a single channel.'''
+    lx,ly = layer.offsets
+    data = pixelio.read(layer,x0-lx,y0-ly,x1-x0,y1-y0)
+    if data.ndim == 2: data = data[:,:,numpy.newaxis]
+    elif pixelio.has_alpha(data.shape[2]): data = data[:,:,:-1]   # drop alpha
+    return data.astype(numpy.float32)
+
+def seam_cost(rcolor,tcolor,valid):
+    '''The cost of cutting between two images at each pixel.
+
+       The cost is the color difference plus the gradient of the
+       brightness difference, so the seam avoids both mismatched and
+       busy regions.  Pixels which are not valid in both images cost
+       more than any valid pixel but the seam may still pass through
+       them.'''
+    diff = rcolor - tcolor
+    cost = numpy.abs(diff).sum(axis=2)
+    bdiff = diff.sum(axis=2)
+    grad = numpy.zeros_like(bdiff)
+    grad[:,1:] += numpy.abs(bdiff[:,1:]-bdiff[:,:-1])
+    grad[1:,:] += numpy.abs(bdiff[1:,:]-bdiff[:-1,:])
+    cost += grad
+    penalty = 2.0*cost.max() + 1.0
+    cost[~valid] = penalty
+    return cost
+
+def _shift(values,k):
+    '''values[i+k] for each i, big where i+k is outside values.'''
+    n = len(values)
+    out = numpy.empty(n) ; out[:] = big
+    if 0 <= k < n: out[:n-k] = values[k:]
+    elif 0 < -k < n: out[-k:] = values[:n+k]
+    return out
+
+def _seam_dp(cost,offsets=None):
+    '''Find the minimum cost top to bottom path through cost.
+
+       Row y of cost covers the columns offsets[y] onwards (default 0),
+       so a band along a path can be stored as a narrow array.  The path
+       moves at most one column per row.  Entries of cost which are >=
+       big are never used.  Returns the column of the path in each row.
+       The work is linear in the size of cost.'''
+    h,w = cost.shape
+    if offsets is None: offsets = numpy.zeros(h,dtype=numpy.intp)
+    total = cost[0].astype(numpy.float64)
+    back = numpy.zeros((h,w),dtype=numpy.int8)
+    for y in range(1,h):
+        d = int(offsets[y]-offsets[y-1])
+        left = _shift(total,d-1)
+        middle = _shift(total,d)
+        right = _shift(total,d+1)
+        choice = numpy.argmin(numpy.vstack((left,middle,right)),axis=0)
+        best = numpy.choose(choice,(left,middle,right))
+        back[y] = choice - 1
+        total = numpy.minimum(best + cost[y],big)
+    path = numpy.empty(h,dtype=numpy.intp)
+    path[-1] = int(numpy.argmin(total))
+    for y in range(h-1,0,-1):
+        path[y-1] = path[y] + back[y,path[y]] + offsets[y]-offsets[y-1]
+    return path + offsets
+
+def find_seam(cost,band=8,coarse_size=256):
+    '''Find a top to bottom seam through cost, coarse to fine.
+
+       The cost is block averaged so that the coarse grid is about
+       coarse_size on a side, the seam is found there, and then refined
+       at full resolution within band pixels of the coarse block: only a
+       window of 2*(factor+band)+1 columns around it in each row is
+       searched, however wide the overlap.'''
+    h,w = cost.shape
+    factor = int(max(1,min(h,w)//coarse_size))
+    if factor <= 1: return _seam_dp(cost)
+    ch = h//factor
+    cw = w//factor
+    coarse = cost[:ch*factor,:cw*factor].reshape(ch,factor,cw,factor).mean(axis=3).mean(axis=1)
+    cpath = _seam_dp(coarse)
+    # only search the fine seam near the coarse seam
+    rows = numpy.minimum(numpy.arange(h)//factor,ch-1)
+    center = cpath[rows]*factor + factor//2
+    halfwidth = factor + band
+    width = min(2*halfwidth+1,w)
+    offsets = numpy.clip(center-halfwidth,0,w-width).astype(numpy.intp)
+    window = cost[numpy.arange(h)[:,numpy.newaxis],
+                  offsets[:,numpy.newaxis]+numpy.arange(width)[numpy.newaxis,:]]
+    return _seam_dp(window,offsets)
+
+def seam_layer_masks(rlayer,rmask,tlayer,tmask,feather=0):
+    '''Replace the reference mask in the overlap by a minimum cost seam cut.
+
+       The seam runs along the long direction of the overlap.  On the
+       reference side of the seam the reference layer is opaque, on the
+       other side it is transparent, except where the transformed layer
+       has no pixels.  If feather is > 0 the cut is softened over that
+       many pixels across the seam.  Returns False if the layers do not
+       overlap.'''
+    ox0,oy0,ox1,oy1 = _overlap(rlayer,tlayer)
+    if ox1 <= ox0 or oy1 <= oy0: return False
+    rx,ry = rlayer.offsets
+    tx,ty = tlayer.offsets
+    rvalid = _layer_window(rlayer,rmask,ox0,oy0,ox1,oy1)
+    tvalid = _layer_window(tlayer,tmask,ox0,oy0,ox1,oy1)
+    cost = seam_cost(_layer_colors(rlayer,ox0,oy0,ox1,oy1),
+                     _layer_colors(tlayer,ox0,oy0,ox1,oy1),
+                     rvalid & tvalid)
+    vertical = (oy1-oy0) >= (ox1-ox0)
+    if vertical:
+        # the reference is on the left if its center is left of the transformed
+        rfirst = rx+rlayer.width/2.0 <= tx+tlayer.width/2.0
+    else:
+        rfirst = ry+rlayer.height/2.0 <= ty+tlayer.height/2.0
+        cost = cost.T
+    # a slight preference for the middle of the overlap breaks ties
+    # in featureless regions.
+    cols = numpy.arange(cost.shape[1])
+    cost = cost + 1.e-3*numpy.abs(cols-cost.shape[1]/2.0)/cost.shape[1]
+    path = find_seam(cost)
+    cols = numpy.arange(cost.shape[1])[numpy.newaxis,:]
+    if rfirst:
+        rside = cols < path[:,numpy.newaxis]
+    else:
+        rside = cols >= path[:,numpy.newaxis]
+    alpha = rside.astype(numpy.float32)
+    if feather > 0:
+        # box filter across the seam
+        n = 2*int(feather)+1
+        padded = numpy.concatenate((numpy.repeat(alpha[:,:1],n//2+1,axis=1),alpha,
+                                    numpy.repeat(alpha[:,-1:],n//2,axis=1)),axis=1)
+        csum = numpy.cumsum(padded,axis=1)
+        alpha = (csum[:,n:] - csum[:,:-n]) / float(n)
+    if not vertical: alpha = alpha.T
+    alpha[~tvalid] = 1.0
+    alpha[~rvalid] = 0.0
+    pixelio.write(rmask,alpha,ox0-rx,oy0-ry)
+    return True
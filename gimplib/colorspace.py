@@ -0,0 +1,200 @@
+'''Color space conversions for whole images.
+
+All the functions take arrays whose last axis holds the color channels,
+e.g. an (h,w,3) image, and convert every pixel at once.  RGB input may
+be uint8 (0-255) or float (0.0-1.0); RGB output is always float.  The
+RGB values are taken to be sRGB with a D65 white point.
+
+    hue is in degrees [0,360), saturation and value in [0,1]
+    L is in [0,100], a and b are roughly in [-128,127]
+
+For 8-bit images the sRGB decoding is done with a 256 entry lookup
+table.  Lab conversions of many 8-bit images can use a cached 3-D lookup
+table instead (see get_lut), which is much faster at a small loss of
+accuracy.'''
+
+import numpy
+
+# sRGB (D65) to XYZ
+_rgb2xyz = numpy.array([[0.4124564,0.3575761,0.1804375],
+                        [0.2126729,0.7151522,0.0721750],
+                        [0.0193339,0.1191920,0.9503041]])
+_xyz2rgb = numpy.linalg.inv(_rgb2xyz)
+_white = numpy.array([0.95047,1.00000,1.08883])   # D65 reference white
+_delta = 6.0/29.0
+
+_lut_cache = {}
+
+
+def as_float(rgb):
+    '''Return RGB values as floats in [0,1].'''
+    rgb = numpy.asarray(rgb)
+    if rgb.dtype == numpy.uint8:
+        return rgb.astype(numpy.float64)/255.0
+    return rgb.astype(numpy.float64)
+
+def to_uint8(rgb):
+    '''Convert float RGB values in [0,1] to 8-bit values.'''
+    return numpy.round(numpy.clip(rgb,0.0,1.0)*255.0).astype(numpy.uint8)
+
+def _decode_table():
+    '''The 256 entry sRGB to linear lookup table.'''
+    table = _lut_cache.get('srgb8')
+    if table is None:
+        table = _srgb_to_linear(numpy.arange(256)/255.0)
+        _lut_cache['srgb8'] = table
+    return table
+
+def _srgb_to_linear(c):
+    return numpy.where(c <= 0.04045,c/12.92,((c+0.055)/1.055)**2.4)
+
+def _linear_to_srgb(c):
+    c = numpy.clip(c,0.0,None)
+    return numpy.where(c <= 0.0031308,c*12.92,1.055*c**(1.0/2.4)-0.055)
+
+def srgb_to_linear(rgb):
+    '''Remove the sRGB gamma.  8-bit input uses a lookup table.'''
+    rgb = numpy.asarray(rgb)
+    if rgb.dtype == numpy.uint8:
+        return _decode_table()[rgb]
+    return _srgb_to_linear(rgb.astype(numpy.float64))
+
+def linear_to_srgb(rgb):
+    '''Apply the sRGB gamma.'''
+    return _linear_to_srgb(numpy.asarray(rgb,dtype=numpy.float64))
+
+def luminance(rgb):
+    '''Relative luminance Y (0.0-1.0) of sRGB values.'''
+    return numpy.dot(srgb_to_linear(rgb),_rgb2xyz[1])
+
+def luma(rgb):
+    '''Rec. 601 luma (0.0-1.0) of gamma encoded RGB, as used for gray images.'''
+    return numpy.dot(as_float(rgb),numpy.array([0.299,0.587,0.114]))
+
+def rgb_to_hsv(rgb):
+    '''Convert RGB to HSV.'''
+    rgb = as_float(rgb)
+    r = rgb[...,0] ; g = rgb[...,1] ; b = rgb[...,2]
+    value = rgb.max(axis=-1)
+    chroma = value - rgb.min(axis=-1)
+    saturation = numpy.where(value > 0.0,chroma/numpy.where(value > 0.0,value,1.0),0.0)
+    safe = numpy.where(chroma > 0.0,chroma,1.0)
+    hue = numpy.where(r == value,(g-b)/safe,
+                      numpy.where(g == value,2.0+(b-r)/safe,4.0+(r-g)/safe))
+    hue = numpy.where(chroma > 0.0,(hue*60.0) % 360.0,0.0)
+    return numpy.concatenate((hue[...,numpy.newaxis],
+                              saturation[...,numpy.newaxis],
+                              value[...,numpy.newaxis]),axis=-1)
+
+def hsv_to_rgb(hsv):
+    '''Convert HSV to RGB.'''
+    hsv = numpy.asarray(hsv,dtype=numpy.float64)
+    h = (hsv[...,0] % 360.0)/60.0
+    s = hsv[...,1]
+    v = hsv[...,2]
+    i = numpy.floor(h).astype(int) % 6
+    f = h - numpy.floor(h)
+    p = v*(1.0-s)
+    q = v*(1.0-s*f)
+    t = v*(1.0-s*(1.0-f))
+    r = numpy.choose(i,(v,q,p,p,t,v))
+    g = numpy.choose(i,(t,v,v,q,p,p))
+    b = numpy.choose(i,(p,p,t,v,v,q))
+    return numpy.concatenate((r[...,numpy.newaxis],
+                              g[...,numpy.newaxis],
+                              b[...,numpy.newaxis]),axis=-1)
+
+# numpy.cbrt is only in numpy >= 1.10
+_cbrt = getattr(numpy,'cbrt',None) or (lambda t: numpy.sign(t)*numpy.abs(t)**(1.0/3.0))
+
+def _f(t):
+    return numpy.where(t > _delta**3,_cbrt(t),t/(3.0*_delta*_delta)+4.0/29.0)
+
+def _finv(t):
+    return numpy.where(t > _delta,t**3,3.0*_delta*_delta*(t-4.0/29.0))
+
+def rgb_to_xyz(rgb):
+    '''Convert sRGB to CIE XYZ (D65).'''
+    return numpy.dot(srgb_to_linear(rgb),_rgb2xyz.T)
+
+def xyz_to_rgb(xyz):
+    '''Convert CIE XYZ (D65) to sRGB.  Out of gamut values are clipped.'''
+    return numpy.clip(linear_to_srgb(numpy.dot(xyz,_xyz2rgb.T)),0.0,1.0)
+
+def rgb_to_lab(rgb):
+    '''Convert sRGB to CIE L*a*b* (D65).'''
+    f = _f(rgb_to_xyz(rgb)/_white)
+    fx = f[...,0] ; fy = f[...,1] ; fz = f[...,2]
+    return numpy.concatenate(((116.0*fy-16.0)[...,numpy.newaxis],
+                              (500.0*(fx-fy))[...,numpy.newaxis],
+                              (200.0*(fy-fz))[...,numpy.newaxis]),axis=-1)
+
+def lab_to_rgb(lab):
+    '''Convert CIE L*a*b* (D65) to sRGB.'''
+    lab = numpy.asarray(lab,dtype=numpy.float64)
+    fy = (lab[...,0]+16.0)/116.0
+    fx = fy + lab[...,1]/500.0
+    fz = fy - lab[...,2]/200.0
+    xyz = numpy.concatenate((fx[...,numpy.newaxis],
+                             fy[...,numpy.newaxis],
+                             fz[...,numpy.newaxis]),axis=-1)
+    return xyz_to_rgb(_finv(xyz)*_white)
+
+class lut3d(object):
+    '''A 3-D lookup table for converting 8-bit RGB images.
+
+       The conversion is evaluated on a size x size x size grid of RGB
+       values and interpolated trilinearly in between.  This is only
+       suitable for smooth conversions like RGB to Lab; the hue of HSV
+       wraps around and cannot be interpolated.'''
+    def __init__(self,convert,size=33):
+        self.size = size
+        grid = numpy.linspace(0.0,1.0,size)
+        r,g,b = numpy.meshgrid(grid,grid,grid,indexing='ij')
+        rgb = numpy.concatenate((r[...,numpy.newaxis],g[...,numpy.newaxis],
+                                 b[...,numpy.newaxis]),axis=-1)
+        self.table = convert(rgb).reshape(size**3,-1)
+    def __call__(self,rgb):
+        '''Convert an 8-bit RGB array.'''
+        rgb = numpy.asarray(rgb)
+        n = self.size
+        x = rgb[...,:3].astype(numpy.float64)*((n-1)/255.0)
+        i = numpy.minimum(x.astype(numpy.intp),n-2)
+        f = x - i
+        base = (i[...,0]*n + i[...,1])*n + i[...,2]
+        result = 0.0
+        for dr in (0,1):
+            wr = f[...,0] if dr else 1.0-f[...,0]
+            for dg in (0,1):
+                wg = f[...,1] if dg else 1.0-f[...,1]
+                for db in (0,1):
+                    wb = f[...,2] if db else 1.0-f[...,2]
+                    corner = self.table[base + (dr*n + dg)*n + db]
+                    result = result + (wr*wg*wb)[...,numpy.newaxis]*corner
+        return result
+
+_conversions = {'lab':rgb_to_lab,'xyz':rgb_to_xyz}
+
+def get_lut(name,size=33):
+    '''Get the cached 3-D lookup table for a conversion ('lab' or 'xyz').'''
+    key = (name,size)
+    lut = _lut_cache.get(key)
+    if lut is None:
+        lut = lut3d(_conversions[name],size)
+        _lut_cache[key] = lut
+    return lut
+
+def channel_statistics(values,mask=None):
+    '''Mean and standard deviation of each channel, optionally under a mask.
+
+       values is an (...,nchannels) array and mask a boolean array of
+       the same shape without the channel axis.  Returns two arrays of
+       length nchannels.'''
+    values = numpy.asarray(values,dtype=numpy.float64)
+    values = values.reshape(-1,values.shape[-1])
+    if mask is not None:
+        values = values[numpy.asarray(mask).reshape(-1)]
+    if not len(values):
+        zero = numpy.zeros(values.shape[-1])
+        return zero,zero
+    return values.mean(axis=0),values.std(axis=0)
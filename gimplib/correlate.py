@@ -0,0 +1,81 @@
+'''Normalized cross correlation of image patches.
+
+This is the array version of compute_correlation in stitch panorama:
+the brightness (sum of the color channels) of two RGBA patches is
+correlated over the pixels where both alpha channels are nonzero, after
+subtracting the mean brightness of each.  The value is in [-1,1] and is
+0.0 when there are no common pixels or one patch is flat.'''
+
+import numpy
+
+from gimplib import pixelio
+
+
+def has_alpha(pixels):
+    return pixelio.has_alpha(pixels.shape[-1])
+
+def brightness(pixels):
+    '''Sum of the color channels of an (h,w,bpp) array, as floats.'''
+    ncolor = pixelio.color_channels(pixels.shape[-1])
+    return pixels[...,:ncolor].sum(axis=-1,dtype=numpy.float64)
+
+def opaque(pixels):
+    '''Pixels with nonzero alpha (all pixels if there is no alpha).'''
+    if has_alpha(pixels): return pixels[...,-1] != 0
+    return numpy.ones(pixels.shape[:-1],dtype=bool)
+
+def correlation(rvalues,tvalues,valid=None):
+    '''Zero mean normalized cross correlation of two 2-D arrays.'''
+    r = numpy.asarray(rvalues,dtype=numpy.float64)
+    t = numpy.asarray(tvalues,dtype=numpy.float64)
+    if valid is not None:
+        r = r[valid]
+        t = t[valid]
+    if not r.size: return 0.0
+    r = r - r.mean()
+    t = t - t.mean()
+    rsum2 = numpy.dot(r.ravel(),r.ravel())
+    tsum2 = numpy.dot(t.ravel(),t.ravel())
+    if not rsum2 or not tsum2: return 0.0
+    return float(numpy.dot(r.ravel(),t.ravel())/(numpy.sqrt(rsum2)*numpy.sqrt(tsum2)))
+
+def pixel_correlation(rpixels,tpixels):
+    '''Correlation of two (h,w,bpp) pixel arrays, like compute_correlation.'''
+    return correlation(brightness(rpixels),brightness(tpixels),
+                       opaque(rpixels) & opaque(tpixels))
+
+def drawable_patch(drawable,x,y,size):
+    '''Read a size x size patch of a drawable centered on pixel x,y.
+
+       Returns (pixels,valid,x0,y0) where pixels is an (size,size,bpp)
+       array, valid flags the opaque pixels inside the drawable and
+       x0,y0 are the drawable coordinates of the patch corner.'''
+    x0 = int(round(x)) - size//2
+    y0 = int(round(y)) - size//2
+    pixels = numpy.zeros((size,size,drawable.bpp),dtype=numpy.uint8)
+    valid = numpy.zeros((size,size),dtype=bool)
+    ix0 = max(x0,0) ; iy0 = max(y0,0)
+    ix1 = min(x0+size,drawable.width) ; iy1 = min(y0+size,drawable.height)
+    if ix1 > ix0 and iy1 > iy0:
+        rgn = drawable.get_pixel_rgn(ix0,iy0,ix1-ix0,iy1-iy0,False,False)
+        pixels[iy0-y0:iy1-y0,ix0-x0:ix1-x0] = pixelio.read_region(rgn)
+        valid[iy0-y0:iy1-y0,ix0-x0:ix1-x0] = True
+    valid &= opaque(pixels)
+    return pixels,valid,x0,y0
+
+def read_brightness(drawable,x,y,w,h,values,valid):
+    '''Read the brightness of a w x h rectangle of a drawable at x,y.
+
+       values and valid are (h,w) arrays to fill, e.g. views of arrays
+       from a scratch.buffer_pool.  Pixels outside the drawable or
+       transparent are marked invalid.'''
+    ix0 = max(x,0) ; iy0 = max(y,0)
+    ix1 = min(x+w,drawable.width) ; iy1 = min(y+h,drawable.height)
+    valid[...] = False
+    if ix1 <= ix0 or iy1 <= iy0: return
+    rgn = drawable.get_pixel_rgn(ix0,iy0,ix1-ix0,iy1-iy0,False,False)
+    pixels = pixelio.read_region(rgn)
+    ncolor = pixelio.color_channels(pixels.shape[-1])
+    pixels[...,:ncolor].sum(axis=-1,dtype=values.dtype,
+                            out=values[iy0-y:iy1-y,ix0-x:ix1-x])
+    valid[iy0-y:iy1-y,ix0-x:ix1-x] = opaque(pixels)
@@ -0,0 +1,105 @@
+'''On-disk cache of control points and transforms keyed by image content.
+
+Image IDs change every gimp session, so the image parasites used by
+stitch panorama are often not found again.  This cache is keyed by a
+sha1 digest of the pixels of both images (and the stitch options which
+change the result) instead, so stitching the same pair of images again
+finds the control points, the solved transform and its condition number
+without any correlation work.
+
+Each entry is a control point file (see cpfile) named after the key,
+with the transform and condition number in its JSON sidecar.  The
+least recently used entries are removed when the cache grows beyond
+max_bytes.  Nothing here needs numpy.'''
+
+import hashlib
+import json
+import os
+import time
+
+from gimplib import cpfile
+
+default_max_bytes = 16*1024*1024
+_suffix = '.stcp'
+_strip_rows = 64      # rows of pixels hashed at a time
+
+
+def drawable_digest(drawable):
+    '''sha1 hex digest of the size, type and pixels of a drawable.'''
+    width,height,bpp = drawable.width,drawable.height,drawable.bpp
+    digest = hashlib.sha1(('%d %d %d\n' % (width,height,bpp)).encode('ascii'))
+    rgn = drawable.get_pixel_rgn(0,0,width,height,False,False)
+    for y in range(0,height,_strip_rows):
+        digest.update(rgn[0:width,y:min(y+_strip_rows,height)])
+    return digest.hexdigest()
+
+def cache_key(rdigest,tdigest,options=None):
+    '''Key for a pair of image digests and a dictionary of options.'''
+    text = json.dumps([cpfile.version,rdigest,tdigest,options or {}],sort_keys=True)
+    return hashlib.sha1(text.encode('ascii')).hexdigest()
+
+class cache(object):
+    '''A directory of cached control point solutions.'''
+    def __init__(self,directory,max_bytes=default_max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+    def _filename(self,key):
+        return os.path.join(self.directory,key+_suffix)
+    def get(self,key):
+        '''Return (records,transform,condition_number) or None.
+
+           records are as returned by cpfile.loads.  A hit marks the
+           entry as recently used.'''
+        filename = self._filename(key)
+        if not os.path.isfile(filename):
+            return None
+        try:
+            records,metadata = cpfile.load(filename,migrate=False)
+        except (IOError,OSError,ValueError):
+            self.remove(key)
+            return None
+        metadata = metadata or {}
+        now = time.time()
+        for name in (filename,cpfile.sidecar_name(filename)):
+            try:
+                os.utime(name,(now,now))
+            except OSError:
+                pass
+        return records,metadata.get('transform'),metadata.get('condition_number')
+    def put(self,key,records,transform=None,condition_number=None):
+        '''Store an entry, then evict old entries if the cache is too big.'''
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        metadata = {'transform':transform,'condition_number':condition_number}
+        cpfile.save(self._filename(key),records,metadata)
+        self.evict()
+    def remove(self,key):
+        filename = self._filename(key)
+        for name in (filename,cpfile.sidecar_name(filename)):
+            if os.path.isfile(name):
+                os.remove(name)
+    def entries(self):
+        '''List (last use time,size,key) of the entries, oldest first.'''
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for name in os.listdir(self.directory):
+            if not name.endswith(_suffix): continue
+            filename = os.path.join(self.directory,name)
+            size = 0
+            for fname in (filename,cpfile.sidecar_name(filename)):
+                if os.path.isfile(fname):
+                    size += os.path.getsize(fname)
+            entries.append((os.path.getmtime(filename),size,name[:-len(_suffix)]))
+        entries.sort()
+        return entries
+    def size(self):
+        return sum([e[1] for e in self.entries()])
+    def evict(self):
+        '''Remove least recently used entries until under max_bytes.'''
+        entries = self.entries()
+        total = sum([e[1] for e in entries])
+        for mtime,size,key in entries:
+            if total <= self.max_bytes: break
+            self.remove(key)
+            total -= size
@@ -0,0 +1,173 @@
+'''Versioned binary file format for stitch panorama control points.
+
+A control point file is a 16 byte header followed by one 48 byte record
+per control point, all little-endian:
+
+    header:  magic 'STCP', version (uint16), header size (uint16),
+             number of points (uint32), record size (uint32)
+    record:  x1, y1, x2, y2, correlation (float64),
+             colorbalance (uint8), 7 bytes of padding
+
+A missing correlation is stored as NaN.  The records can be used in
+place, without copying, as a numpy structured array (see loads).
+Metadata such as the image names goes into a JSON sidecar file next to
+the control point file (name + '.json').
+
+Older versions of stitch panorama pickled the list of control point
+objects.  Those pickles are still read, with an unpickler which only
+accepts the control point class, and files are migrated to this format
+when they are loaded.'''
+
+import json
+import math
+import os
+import pickle
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+magic = b'STCP'
+version = 1
+_header = struct.Struct('<4sHHII')
+_record = struct.Struct('<5dB7x')
+
+if numpy is not None:
+    record_dtype = numpy.dtype({'names':['x1','y1','x2','y2','correlation','colorbalance'],
+                                'formats':['<f8','<f8','<f8','<f8','<f8','u1'],
+                                'offsets':[0,8,16,24,32,40],
+                                'itemsize':_record.size})
+else:
+    record_dtype = None
+
+
+def dumps(records):
+    '''Pack control points into a string in the binary format.
+
+       records is a sequence of (x1,y1,x2,y2,correlation,colorbalance)
+       tuples.  correlation may be None.'''
+    parts = [_header.pack(magic,version,_header.size,len(records),_record.size)]
+    for x1,y1,x2,y2,correlation,colorbalance in records:
+        if correlation is None: correlation = float('nan')
+        parts.append(_record.pack(x1,y1,x2,y2,correlation,bool(colorbalance)))
+    return b''.join(parts)
+
+def is_legacy(data):
+    '''Is data a control point list in the old pickle format?'''
+    return not data[:len(magic)] == magic
+
+def loads(data):
+    '''Unpack control points from a string in the binary format.
+
+       With numpy, the result is a structured array of record_dtype
+       which shares memory with data.  Without numpy it is a list of
+       (x1,y1,x2,y2,correlation,colorbalance) tuples.  Either way,
+       as_tuples converts the result to a list of tuples with None for
+       missing correlations.  Legacy pickles are converted on the fly.
+       A ValueError is raised if data is not a control point list.'''
+    if is_legacy(data):
+        return records_from_pickle(data)
+    if len(data) < _header.size:
+        raise ValueError('control point data is truncated')
+    tag,fversion,hsize,npoints,rsize = _header.unpack_from(data,0)
+    if fversion > version:
+        raise ValueError('control point format version %d is newer than %d' % (fversion,version))
+    if rsize < _record.size or hsize < _header.size:
+        raise ValueError('control point header is corrupt')
+    if len(data) < hsize+npoints*rsize:
+        raise ValueError('control point data is truncated')
+    if numpy is not None and rsize == _record.size:
+        return numpy.frombuffer(data,dtype=record_dtype,count=npoints,offset=hsize)
+    view = memoryview(data)
+    records = []
+    for i in range(npoints):
+        x1,y1,x2,y2,correlation,colorbalance = _record.unpack_from(view,hsize+i*rsize)
+        records.append((x1,y1,x2,y2,correlation,bool(colorbalance)))
+    return records
+
+def as_tuples(records):
+    '''Convert the result of loads to a list of tuples.
+
+       Missing (NaN) correlations become None.'''
+    tuples = []
+    for r in records:
+        x1,y1,x2,y2,correlation,colorbalance = [r[i] for i in range(6)]
+        if correlation is not None:
+            correlation = float(correlation)
+            if math.isnan(correlation): correlation = None
+        tuples.append((float(x1),float(y1),float(x2),float(y2),
+                       correlation,bool(colorbalance)))
+    return tuples
+
+class _legacy_point(object):
+    '''Stands in for the old pickled control_point class.'''
+    def record(self):
+        x1,y1,x2,y2 = self.__dict__['xy']
+        return (float(x1),float(y1),float(x2),float(y2),
+                self.__dict__.get('correlation'),
+                self.__dict__.get('colorbalance',True))
+
+class _legacy_unpickler(pickle.Unpickler):
+    '''Unpickler which refuses anything but lists of control points.'''
+    _safe = {('copy_reg','_reconstructor'),('copyreg','_reconstructor'),
+             ('__builtin__','object'),('builtins','object')}
+    def find_class(self,module,name):
+        if name == 'control_point':
+            return _legacy_point
+        if (module,name) in self._safe:
+            return pickle.Unpickler.find_class(self,module,name)
+        raise pickle.UnpicklingError('%s.%s is not allowed in a control point file' % (module,name))
+
+def records_from_pickle(data):
+    '''Read a legacy pickled control point list.'''
+    try:
+        import io
+        points = _legacy_unpickler(io.BytesIO(data)).load()
+        return [p.record() for p in points]
+    except Exception as e:
+        raise ValueError('not a control point file: %s' % e)
+
+def sidecar_name(filename):
+    return filename + '.json'
+
+def save(filename,records,metadata=None):
+    '''Save control points to a file, and metadata to its JSON sidecar.'''
+    fobj = open(filename,'wb')
+    try:
+        fobj.write(dumps(records))
+    finally:
+        fobj.close()
+    if metadata is not None:
+        fobj = open(sidecar_name(filename),'w')
+        try:
+            json.dump(metadata,fobj,indent=1,sort_keys=True)
+        finally:
+            fobj.close()
+
+def load(filename,migrate=True):
+    '''Load control points from a file.
+
+       Returns (records,metadata) where metadata is the content of the
+       JSON sidecar, or None if there is none.  If the file is a legacy
+       pickle and migrate is True, it is rewritten in the binary format
+       and the original is kept as filename + '.bak'.'''
+    fobj = open(filename,'rb')
+    try:
+        data = fobj.read()
+    finally:
+        fobj.close()
+    records = loads(data)
+    metadata = None
+    if os.path.isfile(sidecar_name(filename)):
+        fobj = open(sidecar_name(filename),'r')
+        try:
+            metadata = json.load(fobj)
+        except ValueError:
+            metadata = None
+        fobj.close()
+    if migrate and is_legacy(data):
+        os.rename(filename,filename+'.bak')
+        save(filename,records)
+    return records,metadata
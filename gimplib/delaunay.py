@@ -0,0 +1,286 @@
+'''A Delaunay triangulation kept up to date point by point.
+
+stitch panorama triangulated the control points from scratch every
+time, testing every triple of points against every other point.
+triangulation instead keeps the triangles and changes only the part a
+point touches.
+
+insert is the Bowyer-Watson algorithm: the triangles whose circumcircle
+holds the new point (a connected cavity around it) are removed and the
+cavity is filled with triangles fanning from the new point.  remove
+takes out the triangles around a point and fills the hole with the
+Delaunay triangles of the points around it.  Triangles outside the
+convex hull are kept as ghost triangles, a hull edge and the vertex at
+infinity (INF), so points outside the hull need no special case.  A
+point is found by walking from triangle to triangle towards it,
+starting from the nearest of a few sampled vertices, which takes about
+n**(1/3) steps, instead of looking at every triangle.
+
+The orientation and in-circle tests are computed in floating point and,
+when the result is too close to zero to trust the sign, again exactly
+with fractions, so cocircular points (like the corners of an image) do
+no harm.  While the points are all on a line there are no triangles.
+Pure python, no numpy.'''
+
+import random
+
+from fractions import Fraction
+
+INF = -1              # the vertex at infinity of the ghost triangles
+
+_orient_bound = 3.3306690738754716e-16
+_incircle_bound = 1.1102230246251577e-15
+
+
+def orient(a,b,c):
+    '''> 0 if a,b,c turn counterclockwise, < 0 clockwise, 0 on a line.'''
+    l = (b[0]-a[0])*(c[1]-a[1])
+    r = (b[1]-a[1])*(c[0]-a[0])
+    det = l - r
+    if abs(det) > _orient_bound*(abs(l)+abs(r)): return det
+    a = [Fraction(v) for v in a] ; b = [Fraction(v) for v in b] ; c = [Fraction(v) for v in c]
+    return float((b[0]-a[0])*(c[1]-a[1]) - (b[1]-a[1])*(c[0]-a[0]))
+
+def incircle(a,b,c,d):
+    '''> 0 if d is inside the circle through the counterclockwise a,b,c.'''
+    adx = a[0]-d[0] ; ady = a[1]-d[1]
+    bdx = b[0]-d[0] ; bdy = b[1]-d[1]
+    cdx = c[0]-d[0] ; cdy = c[1]-d[1]
+    alift = adx*adx + ady*ady
+    blift = bdx*bdx + bdy*bdy
+    clift = cdx*cdx + cdy*cdy
+    det = alift*(bdx*cdy - cdx*bdy) + blift*(cdx*ady - adx*cdy) + clift*(adx*bdy - bdx*ady)
+    permanent = (abs(bdx*cdy) + abs(cdx*bdy))*alift + (abs(cdx*ady) + abs(adx*cdy))*blift + \
+                (abs(adx*bdy) + abs(bdx*ady))*clift
+    if abs(det) > _incircle_bound*permanent: return det
+    d = [Fraction(v) for v in d]
+    adx,ady = Fraction(a[0])-d[0],Fraction(a[1])-d[1]
+    bdx,bdy = Fraction(b[0])-d[0],Fraction(b[1])-d[1]
+    cdx,cdy = Fraction(c[0])-d[0],Fraction(c[1])-d[1]
+    return float((adx*adx + ady*ady)*(bdx*cdy - cdx*bdy) +
+                 (bdx*bdx + bdy*bdy)*(cdx*ady - adx*cdy) +
+                 (cdx*cdx + cdy*cdy)*(adx*bdy - bdx*ady))
+
+def _rotate(triangle,v):
+    '''The triangle rotated to start with vertex v.'''
+    a,b,c = triangle
+    if a == v: return triangle
+    if b == v: return (b,c,a)
+    return (c,a,b)
+
+class triangulation(object):
+    '''The Delaunay triangulation of points inserted and removed one at a time.
+
+       Vertices are numbered in the order the points were inserted and
+       keep their number when other points are removed.'''
+    def __init__(self,points=()):
+        self.points = []        # vertex -> (x,y), None once removed
+        self.where = {}         # (x,y) -> vertex
+        self.triangle = {}      # triangle id -> (a,b,c) counterclockwise, INF last
+        self.edge = {}          # directed edge (a,b) -> triangle id having it
+        self.incident = {}      # vertex -> a triangle id having it
+        self.next_id = 0
+        self.last = None        # where the last walk ended
+        self.random = random.Random(0)
+        for x,y in points: self.insert(x,y)
+    def __len__(self):
+        return len(self.where)
+    def vertices(self):
+        return [v for v,p in enumerate(self.points) if p is not None]
+    def triangles(self):
+        '''The finite triangles as counterclockwise vertex triples.'''
+        return [t for t in self.triangle.values() if t[2] != INF]
+    # -- the triangle and edge tables
+    def _add(self,a,b,c):
+        if a == INF: a,b,c = b,c,a
+        elif b == INF: a,b,c = c,a,b
+        t = self.next_id
+        self.next_id += 1
+        self.triangle[t] = (a,b,c)
+        self.edge[(a,b)] = t ; self.edge[(b,c)] = t ; self.edge[(c,a)] = t
+        for v in (a,b,c): self.incident[v] = t
+        self.last = t
+        return t
+    def _delete(self,t):
+        a,b,c = self.triangle.pop(t)
+        for e in ((a,b),(b,c),(c,a)):
+            if self.edge.get(e) == t: del self.edge[e]
+    def _clear(self):
+        self.triangle = {} ; self.edge = {} ; self.incident = {} ; self.last = None
+    # -- point location
+    def _start(self,p):
+        '''A triangle near p to walk from: by the nearest of a few sampled vertices.'''
+        if self.last in self.triangle: start = self.last
+        else: start = next(iter(self.triangle))
+        n = len(self.where)
+        if n > 8:
+            best = self.triangle[start][0]
+            best = (self.points[best][0]-p[0])**2 + (self.points[best][1]-p[1])**2 \
+                   if best != INF else None
+            for i in range(int(n**(1/3.0))+1):
+                v = self.random.randrange(len(self.points))
+                if self.points[v] is None: continue
+                d = (self.points[v][0]-p[0])**2 + (self.points[v][1]-p[1])**2
+                t = self.incident.get(v)
+                if (best is None or d < best) and t in self.triangle and v in self.triangle[t]:
+                    best,start = d,t
+        return start
+    def _walk(self,p):
+        '''A finite triangle holding p (closed), or a ghost triangle whose
+           hull edge p is beyond.'''
+        t = self._start(p)
+        a,b,c = self.triangle[t]
+        if c == INF: t = self.edge[(b,a)]
+        for step in range(4*len(self.triangle)+4):
+            triangle = self.triangle[t]
+            if triangle[2] == INF: return t
+            i = self.random.randrange(3)
+            for k in range(3):
+                u = triangle[(i+k) % 3] ; v = triangle[(i+k+1) % 3]
+                if orient(self.points[u],self.points[v],p) < 0:
+                    t = self.edge[(v,u)]
+                    break
+            else:
+                self.last = t
+                return t
+        raise RuntimeError('the walk to (%g,%g) did not end' % tuple(p))
+    def locate(self,x,y):
+        '''The finite triangle (a,b,c) holding the point x,y, or None outside the hull.'''
+        if not self.triangle: return None
+        t = self._walk((x,y))
+        triangle = self.triangle[t]
+        if triangle[2] == INF: return None
+        return triangle
+    # -- insertion
+    def _conflict(self,t,p):
+        '''Is the point p inside the circumcircle of triangle t?'''
+        a,b,c = self.triangle[t]
+        if c == INF:
+            pa = self.points[a] ; pb = self.points[b]
+            side = orient(pa,pb,p)
+            if side: return side > 0
+            # on the hull line: in conflict inside the hull edge only
+            return min(pa,pb) < tuple(p) < max(pa,pb)
+        return incircle(self.points[a],self.points[b],self.points[c],p) > 0
+    def _insert_vertex(self,v):
+        p = self.points[v]
+        start = self._walk(p)
+        cavity = set([start])
+        checked = {}
+        stack = [start]
+        boundary = []
+        while stack:
+            t = stack.pop()
+            a,b,c = self.triangle[t]
+            for u,w in ((a,b),(b,c),(c,a)):
+                n = self.edge[(w,u)]
+                if n not in cavity:
+                    if n not in checked: checked[n] = self._conflict(n,p)
+                    if checked[n]:
+                        cavity.add(n)
+                        stack.append(n)
+                        continue
+                    boundary.append((u,w))
+        # edges between two cavity triangles are not on the boundary
+        boundary = [(u,w) for u,w in boundary if self.edge[(w,u)] not in cavity]
+        for t in cavity: self._delete(t)
+        for u,w in boundary: self._add(u,w,v)
+    def _rebuild(self):
+        '''Triangulate the remaining points from scratch (or wait for a
+           third point off the line).'''
+        self._clear()
+        vertices = self.vertices()
+        for i in range(2,len(vertices)):
+            a,b,c = vertices[0],vertices[1],vertices[i]
+            side = orient(self.points[a],self.points[b],self.points[c])
+            if side:
+                if side < 0: a,b = b,a
+                self._add(a,b,c)
+                self._add(b,a,INF) ; self._add(c,b,INF) ; self._add(a,c,INF)
+                for v in vertices[2:]:
+                    if v != c: self._insert_vertex(v)
+                return
+    def insert(self,x,y):
+        '''Add the point x,y.  Returns its vertex (the existing one for a
+           point already there).'''
+        p = (float(x),float(y))
+        if p in self.where: return self.where[p]
+        v = len(self.points)
+        self.points.append(p)
+        self.where[p] = v
+        if self.triangle: self._insert_vertex(v)
+        else: self._rebuild()
+        return v
+    # -- removal
+    def _star(self,v):
+        '''The triangles around vertex v, each rotated to start with v, in order.'''
+        t = self.incident.get(v)
+        if t not in self.triangle or v not in self.triangle[t]:
+            t = [s for s,triangle in self.triangle.items() if v in triangle][0]
+        star = []
+        first = t
+        while True:
+            triangle = _rotate(self.triangle[t],v)
+            star.append((t,triangle))
+            t = self.edge[(v,triangle[2])]
+            if t == first: return star
+    def _fill(self,v,star):
+        '''The triangles filling the hole left by vertex v, or None if
+           they cannot be found by the Delaunay triangles of its neighbours.'''
+        link = [x for t,(w,x,y) in star if x != INF]
+        hole = [(self.points[x],self.points[y]) for t,(w,x,y) in star if INF not in (x,y)]
+        vp = self.points[v]
+        local = triangulation([self.points[x] for x in link])
+        if not local.triangle: return None
+        # local vertices are numbered as link (without repeated points)
+        number = [self.where[p] for p in local.points]
+        required = set([(x,y) for t,(w,x,y) in star])
+        new = []
+        for a,b,c in local.triangles():
+            pa,pb,pc = local.points[a],local.points[b],local.points[c]
+            centroid = ((pa[0]+pb[0]+pc[0])/3.0,(pa[1]+pb[1]+pc[1])/3.0)
+            for px,py in hole:
+                if orient(vp,px,centroid) >= 0 and orient(px,py,centroid) >= 0 and \
+                   orient(py,vp,centroid) >= 0:
+                    new.append((number[a],number[b],number[c]))
+                    break
+        edges = set()
+        for a,b,c in new: edges.update(((a,b),(b,c),(c,a)))
+        for a,b in list(edges):
+            if (b,a) not in edges and (a,b) not in required:
+                new.append((b,a,INF))        # a new hull edge
+        edges = set()
+        for triangle in new:
+            a,b,c = triangle
+            for e in ((a,b),(b,c),(c,a)):
+                if e in edges: return None
+                edges.add(e)
+        for a,b in edges:
+            if (b,a) not in edges and (a,b) not in required: return None
+        if not required <= edges: return None
+        return new
+    def remove(self,v):
+        '''Take out vertex v.'''
+        p = self.points[v]
+        if p is None: raise KeyError('vertex %d was removed already' % v)
+        if not self.triangle:
+            self.points[v] = None
+            del self.where[p]
+            return
+        star = self._star(v)
+        new = self._fill(v,star)
+        self.points[v] = None
+        del self.where[p]
+        if new is None:
+            self._rebuild()
+            return
+        for t,triangle in star: self._delete(t)
+        for a,b,c in new: self._add(a,b,c)
+    def sync(self,points):
+        '''Make the vertices the (x,y) points given, removing and inserting
+           only the points which changed.  Returns the vertex of each point.'''
+        points = [(float(x),float(y)) for x,y in points]
+        wanted = set(points)
+        for p,v in list(self.where.items()):
+            if p not in wanted: self.remove(v)
+        return [self.insert(x,y) for x,y in points]
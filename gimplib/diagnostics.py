@@ -0,0 +1,144 @@
+'''Reports on how well a transform fits its control points.
+
+stitch panorama solves for the transform by least squares every time
+the control points change.  fit_report collects what is known about the
+solution: the model (shift, similarity or affine by the number of
+points), the condition number of the least squares problem, the
+residual of each control point, their RMS and maximum, the leverage of
+each point and the time the solve took.  A fit whose condition number
+is above max_condition or whose largest residual is above max_error is
+flagged in the report's warnings, so a batch job can reject it instead
+of stitching a bad panorama.
+
+json_log appends reports to a file, one JSON object per line.
+Transforms are 3x3 lists acting on row vectors [x,y,1] as in stitch
+panorama.  Nothing here needs numpy.'''
+
+import json
+import math
+import time
+
+max_condition = 1.e6      # condition numbers above this are ill conditioned
+max_error = None          # residuals (pixels) above this are flagged (None: no limit)
+
+
+def model_name(npoints):
+    '''The transform model stitch panorama fits to npoints control points.'''
+    if npoints == 1: return 'shift'
+    if npoints == 2: return 'similarity'
+    return 'affine'
+
+def _transform(transform,x,y):
+    rx = x*transform[0][0] + y*transform[1][0] + transform[2][0]
+    ry = x*transform[0][1] + y*transform[1][1] + transform[2][1]
+    rh = x*transform[0][2] + y*transform[1][2] + transform[2][2]
+    return rx/rh,ry/rh
+
+def residuals(rarray,tarray,transform):
+    '''The x,y residuals of the transformed points from the reference points.'''
+    result = []
+    for (rx,ry,r1),(tx,ty,t1) in zip(rarray,tarray):
+        x,y = _transform(transform,tx,ty)
+        result.append((x-rx,y-ry))
+    return result
+
+def _inverse3(a):
+    '''Inverse of a 3x3 matrix (lists), None if it is singular.'''
+    c00 = a[1][1]*a[2][2] - a[1][2]*a[2][1]
+    c01 = a[1][2]*a[2][0] - a[1][0]*a[2][2]
+    c02 = a[1][0]*a[2][1] - a[1][1]*a[2][0]
+    det = a[0][0]*c00 + a[0][1]*c01 + a[0][2]*c02
+    scale = max([abs(v) for row in a for v in row])
+    if not scale or abs(det) <= 1.e-12*scale**3: return None
+    return [[c00/det,
+             (a[0][2]*a[2][1] - a[0][1]*a[2][2])/det,
+             (a[0][1]*a[1][2] - a[0][2]*a[1][1])/det],
+            [c01/det,
+             (a[0][0]*a[2][2] - a[0][2]*a[2][0])/det,
+             (a[0][2]*a[1][0] - a[0][0]*a[1][2])/det],
+            [c02/det,
+             (a[0][1]*a[2][0] - a[0][0]*a[2][1])/det,
+             (a[0][0]*a[1][1] - a[0][1]*a[1][0])/det]]
+
+def leverage(tarray):
+    '''The leverage (hat matrix diagonal) of each point of an affine fit.
+
+       A point with leverage near 1 pins the transform by itself, so an
+       error in it hardly shows in its own residual.  The 1 and 2 point
+       models fit the points exactly and every point has leverage 1.'''
+    n = len(tarray)
+    if n < 3: return [1.0]*n
+    normal = [[sum([t[i]*t[j] for t in tarray]) for j in range(3)] for i in range(3)]
+    inverse = _inverse3(normal)
+    if inverse is None: return [1.0]*n
+    result = []
+    for t in tarray:
+        result.append(sum([t[i]*inverse[i][j]*t[j] for i in range(3) for j in range(3)]))
+    return result
+
+class fit_report(object):
+    '''Diagnostics for one transform fit.'''
+    def __init__(self,rarray,tarray,transform,condition_number=None,solve_time=None):
+        self.npoints = len(rarray)
+        self.model = model_name(self.npoints)
+        self.transform = [list(row) for row in transform]
+        self.condition_number = condition_number
+        self.solve_time = solve_time
+        self.time = time.time()
+        self.xyresiduals = residuals(rarray,tarray,transform)
+        self.residuals = [math.sqrt(x*x+y*y) for x,y in self.xyresiduals]
+        if self.npoints:
+            self.rms = math.sqrt(sum([r*r for r in self.residuals])/self.npoints)
+            self.max = max(self.residuals)
+            self.max_index = self.residuals.index(self.max)
+        else:
+            self.rms = self.max = 0.0
+            self.max_index = None
+        self.leverage = leverage(tarray)
+        self.warnings = []
+        if self.ill_conditioned():
+            self.warnings.append('ill conditioned fit')
+        if max_error is not None and self.max > max_error:
+            self.warnings.append('control point %d is off by %.2f pixels' %
+                                 (self.max_index+1,self.max))
+    def ill_conditioned(self):
+        return self.condition_number is not None and \
+               not self.condition_number < max_condition
+    def ok(self):
+        return not self.warnings
+    def as_dict(self):
+        return {'time':self.time,
+                'model':self.model,
+                'npoints':self.npoints,
+                'transform':self.transform,
+                'condition_number':self.condition_number,
+                'solve_time':self.solve_time,
+                'rms':self.rms,
+                'max':self.max,
+                'residuals':self.residuals,
+                'xyresiduals':[list(r) for r in self.xyresiduals],
+                'leverage':self.leverage,
+                'warnings':self.warnings}
+    def summary(self):
+        '''One line description of the fit.'''
+        text = '%s fit to %d points: rms %.2f max %.2f pixels' % \
+               (self.model,self.npoints,self.rms,self.max)
+        if self.condition_number is not None:
+            text += ', condition number %.3g' % self.condition_number
+        if self.warnings:
+            text += ' (' + '; '.join(self.warnings) + ')'
+        return text
+
+class json_log(object):
+    '''Append fit reports to a file as JSON lines.'''
+    def __init__(self,filename):
+        self.filename = filename
+    def write(self,report,**extra):
+        '''Log a report, with extra keys (e.g. image names) added to it.'''
+        entry = report.as_dict()
+        entry.update(extra)
+        f = open(self.filename,'a')
+        try:
+            f.write(json.dumps(entry,sort_keys=True) + '\n')
+        finally:
+            f.close()
@@ -0,0 +1,156 @@
+'''Downscaled images for the stages that do not need every pixel.
+
+Choosing images, estimating overlaps and previews work on a few
+hundred pixels across, yet a gimp image is decoded at full size.
+read gives an image at a mip level, level n being 1/2**n of the full
+size, chosen by target as the smallest level at least target pixels
+across.  JPEG files are decoded in PIL's draft mode, which scales the
+DCT by 1/2, 1/4 or 1/8 while decoding and so skips most of the work;
+other files (and levels past 1/8) are decoded and block averaged.
+Each level made is cached as a .npy file in a .stitch-mips directory
+next to the source, used again while it is newer than the source.
+
+PIL is optional: without it (or for images not saved in a file)
+image_level averages the pixels of the gimp drawable instead.  Full
+resolution is left to gimp and the final render.'''
+
+import math
+import os
+import numpy
+
+from gimplib import pixelio
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+max_level = 8                 # smallest level is 1/256 of the full size
+draft_levels = 3              # levels JPEG draft mode can decode (1/8)
+cache_name = '.stitch-mips'   # the cache directory next to the sources
+
+
+def choose_level(width,height,target):
+    '''The smallest level with at least target pixels across.'''
+    level = 0
+    size = max(width,height)
+    while level < max_level and size//2**(level+1) >= target: level += 1
+    return level
+
+def level_size(width,height,level):
+    '''The (width,height) of an image at a level.'''
+    scale = 2**level
+    return (max((width+scale-1)//scale,1),max((height+scale-1)//scale,1))
+
+def shrink(pixels,factor):
+    '''Block average an (h,w[,bpp]) array by factor, edges included.'''
+    if factor <= 1: return pixels
+    pixels = numpy.asarray(pixels)
+    h,w = pixels.shape[:2]
+    bh = (h+factor-1)//factor ; bw = (w+factor-1)//factor
+    padded = numpy.zeros((bh*factor,bw*factor)+pixels.shape[2:])
+    padded[:h,:w] = pixels
+    count = numpy.zeros((bh*factor,bw*factor))
+    count[:h,:w] = 1.0
+    sums = padded.reshape((bh,factor,bw,factor)+pixels.shape[2:]).sum(axis=3).sum(axis=1)
+    counts = count.reshape(bh,factor,bw,factor).sum(axis=3).sum(axis=1)
+    if pixels.ndim == 3: counts = counts[...,numpy.newaxis]
+    return numpy.round(sums/counts).astype(numpy.uint8)
+
+def cache_file(filename,level):
+    directory = os.path.join(os.path.dirname(os.path.abspath(filename)),cache_name)
+    return os.path.join(directory,'%s.%d.npy' % (os.path.basename(filename),level))
+
+def _cached(filename,level):
+    name = cache_file(filename,level)
+    try:
+        if os.path.getmtime(name) >= os.path.getmtime(filename):
+            return numpy.load(name)
+    except (IOError,OSError,ValueError):
+        pass
+    return None
+
+def _save(filename,level,pixels):
+    '''Cache a level, quietly giving up if the directory is not writable.'''
+    name = cache_file(filename,level)
+    try:
+        if not os.path.isdir(os.path.dirname(name)): os.mkdir(os.path.dirname(name))
+        numpy.save(name,pixels)
+    except (IOError,OSError):
+        pass
+
+def image_size(filename):
+    '''(width,height) of an image file from its header, or None.'''
+    if Image is None: return None
+    try:
+        return Image.open(filename).size
+    except IOError:
+        return None
+
+def capture_time(filename):
+    '''The EXIF capture time of an image file ('YYYY:MM:DD HH:MM:SS'), or None.'''
+    if Image is None or not filename: return None
+    try:
+        exif = Image.open(filename)._getexif()
+    except (IOError,AttributeError,SyntaxError,ValueError):
+        return None
+    if not exif: return None
+    return exif.get(36867) or exif.get(306)   # DateTimeOriginal, else DateTime
+
+def _decode(filename,level):
+    image = Image.open(filename)
+    width,height = image.size
+    target = level_size(width,height,level)
+    if image.format == 'JPEG' and level:
+        # the decoder scales by up to 1/8 to no less than the size asked
+        image.draft(image.mode,level_size(width,height,min(level,draft_levels)))
+    if image.mode not in ('L','LA','RGB','RGBA'):
+        image = image.convert('RGBA' if 'A' in image.mode else 'RGB')
+    pixels = numpy.asarray(image)
+    # what the draft did not do, block averaging does
+    factor = int(round(pixels.shape[1]/float(target[0])))
+    return shrink(pixels,max(factor,1))
+
+def read_level(filename,level):
+    '''The image in a file at a level as an (h,w[,bpp]) uint8 array, or
+       None if the file cannot be decoded (or PIL is missing).'''
+    pixels = _cached(filename,level)
+    if pixels is not None: return pixels
+    if Image is None: return None
+    try:
+        pixels = _decode(filename,level)
+    except (IOError,OSError):
+        return None
+    if level: _save(filename,level,pixels)
+    return pixels
+
+def read(filename,target):
+    '''The image in a file at the smallest level target pixels across, or None.'''
+    size = image_size(filename)
+    if size is None: return None
+    return read_level(filename,choose_level(size[0],size[1],target))
+
+def drawable_level(drawable,level):
+    '''A drawable at a level, block averaged a strip at a time.'''
+    factor = 2**level
+    rows = max(pixelio.strip_rows//factor,1)*factor
+    strips = []
+    for y0 in range(0,drawable.height,rows):
+        pixels = pixelio.read(drawable,0,y0,drawable.width,min(rows,drawable.height-y0))
+        strips.append(shrink(pixels,factor))
+    return numpy.concatenate(strips,axis=0)
+
+def image_level(image,drawable,target):
+    '''A gimp image's drawable at the smallest level target pixels across.
+
+       Decoded from the image's file when it has one of the same size
+       (and so presumably the same pixels), else averaged from the
+       drawable.  Returns (pixels,level).'''
+    level = choose_level(drawable.width,drawable.height,target)
+    filename = getattr(image,'filename',None)
+    if filename and os.path.isfile(filename) and \
+       image_size(filename) == (drawable.width,drawable.height):
+        pixels = read_level(filename,level)
+        if pixels is not None and pixels.shape[:2] == level_size(drawable.width,drawable.height,level)[::-1]:
+            return pixels,level
+    return drawable_level(drawable,level),level
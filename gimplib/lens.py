@@ -0,0 +1,253 @@
+'''Radial lens distortion fitted to control points.
+
+The model takes a point p of the (distorted) image to
+
+    c + (p-c)*(1 + k1*r**2 + k2*r**4)       r = |p-c|/s
+
+where c is the optical center (an offset from the image center) and s
+half the image diagonal, so k1 and k2 do not depend on the image size.
+k1 < 0 corrects pincushion and k1 > 0 barrel distortion.  Both images
+of a pair come from the same camera and lens, so fit finds one model
+together with the affine transform between the undistorted images by
+Levenberg-Marquardt least squares on the control points.
+
+An image is corrected once by remap through the undistortion map.  The
+model is radially symmetric, so the map is a table of the distorted
+radius against the undistorted one, computed once per model and kept
+in a small cache for every image of the same size taken with the same
+camera and lens.  Models can be saved as profiles in a JSON file to be
+used again for images which do not have enough control points.'''
+
+import json
+import math
+import os
+import numpy
+
+from gimplib import resample
+
+strip_rows = 64       # output rows remapped at a time
+table_size = 4096     # samples in the radius table
+max_tables = 8        # radius tables kept in the cache
+_tables = []          # (key,table) pairs, most recently used last
+
+
+class model(object):
+    '''Radial distortion k1,k2 about an optical center.
+
+       center is the offset of the optical center from the image
+       center in pixels.'''
+    def __init__(self,k1=0.0,k2=0.0,center=(0.0,0.0)):
+        self.k1 = float(k1)
+        self.k2 = float(k2)
+        self.center = (float(center[0]),float(center[1]))
+    def __repr__(self):
+        return 'lens.model(k1=%g,k2=%g,center=(%g,%g))' % ((self.k1,self.k2)+self.center)
+    def key(self):
+        return (self.k1,self.k2) + self.center
+    def as_dict(self):
+        return {'k1':self.k1,'k2':self.k2,'center':list(self.center)}
+    def is_identity(self):
+        return not self.k1 and not self.k2
+    def frame(self,shape):
+        '''The optical center (pixel coordinates) and radius scale for an image shape.'''
+        h,w = shape[:2]
+        return ((w-1)/2.0+self.center[0],(h-1)/2.0+self.center[1]),0.5*math.hypot(w,h)
+    def factor(self,r2):
+        '''Radial factor for squared normalized radius r2.'''
+        return 1.0 + self.k1*r2 + self.k2*r2*r2
+    def undistort(self,x,y,shape):
+        '''Corrected positions of image points x,y.'''
+        (cx,cy),s = self.frame(shape)
+        dx = numpy.asarray(x,dtype=numpy.float64)-cx
+        dy = numpy.asarray(y,dtype=numpy.float64)-cy
+        f = self.factor((dx*dx+dy*dy)/(s*s))
+        return cx+dx*f,cy+dy*f
+    def distort(self,x,y,shape):
+        '''Image positions of corrected points x,y (the inverse of undistort).'''
+        (cx,cy),s = self.frame(shape)
+        dx = numpy.asarray(x,dtype=numpy.float64)-cx
+        dy = numpy.asarray(y,dtype=numpy.float64)-cy
+        rho = numpy.sqrt(dx*dx+dy*dy)/s
+        f = numpy.interp(rho,*self.radius_table(rho.max() if rho.size else 0.0))
+        return cx+dx*f,cy+dy*f
+    def radius_table(self,rmax):
+        '''Table (rho,f) of corrected normalized radii rho and the factor f
+           to multiply them by to get the image radius, up to at least
+           rmax.  Cached by model.'''
+        rmax = max(float(rmax),1.0)
+        key = self.key()
+        for i,(k,table) in enumerate(_tables):
+            if k == key and table[0][-1] >= rmax:
+                del _tables[i]
+                _tables.append((k,table))
+                return table
+        # Newton's method for the image radius d with d*factor(d**2) = rho
+        rho = numpy.linspace(0.0,rmax*1.25,table_size)
+        d = rho.copy()
+        for iteration in range(50):
+            g = d*self.factor(d*d) - rho
+            dg = 1.0 + 3.0*self.k1*d*d + 5.0*self.k2*d**4
+            dg = numpy.where(numpy.abs(dg) < 1.e-6,1.e-6,dg)
+            step = g/dg
+            d = d - step
+            if numpy.abs(step).max() < 1.e-12: break
+        f = numpy.ones_like(rho)
+        f[1:] = d[1:]/rho[1:]
+        table = (rho,f)
+        _tables[:] = [(k,t) for k,t in _tables if k != key][-(max_tables-1):]
+        _tables.append((key,table))
+        return table
+    def undistortion_map(self,shape,y0=0,y1=None):
+        '''Image coordinates (xs,ys) of the corrected pixels of rows y0:y1.'''
+        h,w = shape[:2]
+        if y1 is None: y1 = h
+        (cx,cy),s = self.frame(shape)
+        corners = numpy.array([[0,0],[w-1,0],[0,h-1],[w-1,h-1]],dtype=numpy.float64)
+        rmax = numpy.hypot(corners[:,0]-cx,corners[:,1]-cy).max()/s
+        rho,f = self.radius_table(rmax)
+        dx = numpy.arange(w,dtype=numpy.float64)[numpy.newaxis,:] - cx
+        dy = numpy.arange(y0,y1,dtype=numpy.float64)[:,numpy.newaxis] - cy
+        factor = numpy.interp(numpy.sqrt(dx*dx+dy*dy)/s,rho,f)
+        return cx+dx*factor,cy+dy*factor
+
+def from_dict(d):
+    return model(d.get('k1',0.0),d.get('k2',0.0),d.get('center',(0.0,0.0)))
+
+def remap(pixels,lens_model,kernel='linear'):
+    '''Correct an (h,w,bpp) uint8 image for the lens distortion.
+
+       The result has the same size and an alpha channel (added if the
+       image has none) which is 0 where there is no image data.  kernel
+       is a resample kernel name.'''
+    pixels = numpy.asarray(pixels)
+    if pixels.ndim == 2: pixels = pixels[:,:,numpy.newaxis]
+    h,w,bpp = pixels.shape
+    alpha = bpp in (2,4)
+    ncolor = bpp-1 if alpha else bpp
+    out = numpy.zeros((h,w,ncolor+1),dtype=numpy.uint8)
+    margin = resample.kernels[kernel][0]//2
+    for y0 in range(0,h,strip_rows):
+        y1 = min(y0+strip_rows,h)
+        xs,ys = lens_model.undistortion_map(pixels.shape,y0,y1)
+        iy0 = max(int(math.floor(ys.min()))-margin,0)
+        iy1 = min(int(math.ceil(ys.max()))+1+margin,h)
+        if iy1 <= iy0: continue
+        source = pixels[iy0:iy1]
+        ys = ys - iy0
+        values,inside = resample.interpolate(source,xs,ys,kernel)
+        out[y0:y1,:,:ncolor] = numpy.clip(numpy.round(values[...,:ncolor]),0,255)
+        if alpha:
+            out[y0:y1,:,-1] = numpy.clip(numpy.round(values[...,-1]),0,255)
+        else:
+            out[y0:y1,:,-1] = numpy.where(inside,255,0)
+    return out
+
+def _affine(params):
+    '''The 3x3 row vector transform of the 6 affine parameters.'''
+    return [[params[0],params[1],0.0],[params[2],params[3],0.0],[params[4],params[5],1.0]]
+
+def fit(rpoints,tpoints,rshape,tshape=None,transform=None,itmax=100):
+    '''Fit a lens model and an affine transform to control points.
+
+       rpoints and tpoints are (n,2) arrays of matching points in the
+       reference and transformed images, and transform an initial 3x3
+       transform (row vectors [x,y,1], as in stitch panorama) from the
+       transformed to the reference image.  Fits
+
+           undistort(r) = [undistort(t),1] . transform
+
+       for k1, k2 and the optical center, leaving out the center (and
+       then k2) if there are too few points.  Returns (model,transform,
+       rms) with the rms residual in pixels, or None with fewer than 6
+       points, which leave too little to fit beyond the transform.'''
+    r = numpy.asarray(rpoints,dtype=numpy.float64).reshape(-1,2)
+    t = numpy.asarray(tpoints,dtype=numpy.float64).reshape(-1,2)
+    if tshape is None: tshape = rshape
+    n = len(r)
+    if n < 6: return None
+    if transform is None:
+        a = numpy.hstack((t,numpy.ones((n,1))))
+        m = numpy.linalg.lstsq(a,r,rcond=None)[0]
+        affine = [m[0,0],m[0,1],m[1,0],m[1,1],m[2,0],m[2,1]]
+    else:
+        affine = [transform[0][0],transform[0][1],transform[1][0],transform[1][1],
+                  transform[2][0],transform[2][1]]
+    if n >= 10: nlens = 4
+    elif n >= 8: nlens = 2
+    else: nlens = 1
+    def unpack(q):
+        lens = list(q[6:]) + [0.0]*(4-nlens)
+        return model(lens[0],lens[1],(lens[2],lens[3]))
+    def residuals(q):
+        lens_model = unpack(q)
+        ux,uy = lens_model.undistort(r[:,0],r[:,1],rshape)
+        tx,ty = lens_model.undistort(t[:,0],t[:,1],tshape)
+        px = q[0]*tx + q[2]*ty + q[4]
+        py = q[1]*tx + q[3]*ty + q[5]
+        return numpy.concatenate((px-ux,py-uy))
+    q = numpy.array(affine + [0.0]*nlens)
+    steps = numpy.array([1.e-6,1.e-6,1.e-6,1.e-6,1.e-3,1.e-3] + [1.e-6,1.e-6,1.e-3,1.e-3][:nlens])
+    res = residuals(q)
+    cost = numpy.dot(res,res)
+    damping = 1.e-3
+    for iteration in range(itmax):
+        jacobian = numpy.empty((len(res),len(q)))
+        for j in range(len(q)):
+            dq = q.copy()
+            dq[j] += steps[j]
+            jacobian[:,j] = (residuals(dq)-res)/steps[j]
+        jtj = numpy.dot(jacobian.T,jacobian)
+        jtr = numpy.dot(jacobian.T,res)
+        improved = False
+        while damping < 1.e10:
+            try:
+                delta = numpy.linalg.solve(jtj + damping*numpy.diag(numpy.diag(jtj)+1.e-12),-jtr)
+            except numpy.linalg.LinAlgError:
+                damping *= 10.0
+                continue
+            new_res = residuals(q+delta)
+            new_cost = numpy.dot(new_res,new_res)
+            if new_cost < cost:
+                q = q+delta
+                converged = cost-new_cost < 1.e-12*max(cost,1.e-30)
+                res,cost = new_res,new_cost
+                damping = max(damping/10.0,1.e-12)
+                improved = True
+                break
+            damping *= 10.0
+        if not improved or converged: break
+    return unpack(q),_affine(q),math.sqrt(cost/n)
+
+def _shape_key(shape):
+    return '%dx%d' % (shape[1],shape[0])
+
+def save_profile(filename,shape,lens_model):
+    '''Save a lens model for images of a shape in a JSON profile file.'''
+    profiles = {}
+    if os.path.exists(filename):
+        f = open(filename)
+        try:
+            profiles = json.load(f)
+        except ValueError:
+            profiles = {}
+        f.close()
+    profiles[_shape_key(shape)] = lens_model.as_dict()
+    f = open(filename,'w')
+    try:
+        json.dump(profiles,f,indent=1,sort_keys=True)
+    finally:
+        f.close()
+
+def load_profile(filename,shape):
+    '''The lens model saved for images of a shape, or None.'''
+    if not os.path.exists(filename): return None
+    f = open(filename)
+    try:
+        profiles = json.load(f)
+    except ValueError:
+        return None
+    finally:
+        f.close()
+    d = profiles.get(_shape_key(shape))
+    if d is None: return None
+    return from_dict(d)
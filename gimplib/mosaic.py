@@ -0,0 +1,217 @@
+'''Stitching a panorama straight to a tiled TIFF file, one tile at a time.
+
+The gimp path builds the whole panorama as an image with a layer per
+source image and blends them through layer masks, which needs the
+panorama in memory several times over.  write_panorama instead makes
+each output tile from the source images as it is written: the
+reference layer is a shifted window of its image, the transformed
+layer is resampled (with adaptive supersampling from render if asked),
+and the two are composited through their blend masks in the same pass.
+Only the source images, one tile and a downsampled proxy of the
+panorama are ever in memory, and a source may itself be a
+tilestore.store (a panorama stitched before, say), of which only the
+tiles under the output tile are read.
+
+The blend masks are the feather of blend.feather_weights.  A whole
+distance transform would need the whole layer, so the distance of a
+pixel to the edge of its layer is taken from the layer's outline on
+the canvas instead (a rectangle for the reference, the transformed
+corners of the image for the other), times the layer's own alpha,
+which is exact for straight edges and close for the curved edges left
+by lens correction or projection.
+
+Coordinates are array indices as in resample: the pixel at row y,
+column x of the canvas is at x,y.'''
+
+import math
+import numpy
+
+from gimplib import blend, render, resample, tiffwriter, tilestore
+
+tile_size = 256       # TIFF tile size in pixels
+proxy_size = 1024     # largest dimension of the preview proxy
+
+
+def polygon_distance(xs,ys,polygon):
+    '''Distance from points xs,ys to the edges of a convex polygon.
+
+       polygon is a list of (x,y) corners in order (either way round).
+       Points outside the polygon get 0.'''
+    polygon = numpy.asarray(polygon,dtype=numpy.float64)
+    px = polygon[:,0] ; py = polygon[:,1]
+    area = numpy.dot(px,numpy.roll(py,-1)) - numpy.dot(py,numpy.roll(px,-1))
+    sign = 1.0 if area > 0 else -1.0
+    distance = None
+    for i in range(len(polygon)):
+        x0,y0 = polygon[i] ; x1,y1 = polygon[(i+1) % len(polygon)]
+        length = math.hypot(x1-x0,y1-y0)
+        if not length: continue
+        # positive on the inner side of the edge
+        d = sign*((x1-x0)*(ys-y0) - (y1-y0)*(xs-x0))/length
+        distance = d if distance is None else numpy.minimum(distance,d)
+    return numpy.maximum(distance,0.0)
+
+def _colors(values,ncolor):
+    '''The first ncolor color channels of values, gray repeated for RGB.'''
+    if values.shape[-1] >= ncolor: return values[...,:ncolor]
+    return numpy.repeat(values[...,:1],ncolor,axis=-1)
+
+class layer(object):
+    '''An image placed on the canvas.
+
+       pixels is the (h,w,bpp) uint8 image (an array or a
+       tilestore.store) and outline its corners on
+       the canvas.  The image is either shifted by offset (integers) or
+       placed by mapping(xs,ys), which takes canvas coordinates to image
+       coordinates.  supersample uses render for the mapped image.'''
+    def __init__(self,pixels,outline,offset=(0,0),mapping=None,
+                 kernel='linear',supersample=False):
+        if not isinstance(pixels,tilestore.store):
+            pixels = numpy.asarray(pixels)
+            if pixels.ndim == 2: pixels = pixels[:,:,numpy.newaxis]
+        self.pixels = pixels
+        self.outline = outline
+        self.offset = (int(offset[0]),int(offset[1]))
+        self.mapping = mapping
+        self.kernel = kernel
+        self.supersample = supersample
+        self.alpha = pixels.shape[2] in (2,4)
+        self.ncolor = pixels.shape[2]-1 if self.alpha else pixels.shape[2]
+        xs = [x for x,y in outline] ; ys = [y for x,y in outline]
+        self.bounds = (min(xs),min(ys),max(xs),max(ys))
+        self._energy = None
+    def _shifted(self,x0,y0,x1,y1):
+        '''(values,coverage) of a box of the shifted image.'''
+        h,w = self.pixels.shape[:2]
+        values = numpy.zeros((y1-y0,x1-x0,self.pixels.shape[2]))
+        coverage = numpy.zeros((y1-y0,x1-x0))
+        ox,oy = self.offset
+        ix0 = max(x0,ox) ; iy0 = max(y0,oy)
+        ix1 = min(x1,ox+w) ; iy1 = min(y1,oy+h)
+        if ix1 > ix0 and iy1 > iy0:
+            window = (slice(iy0-y0,iy1-y0),slice(ix0-x0,ix1-x0))
+            values[window] = self.pixels[iy0-oy:iy1-oy,ix0-ox:ix1-ox]
+            coverage[window] = 1.0
+        return values,coverage
+    def _source(self,x0,y0,x1,y1):
+        '''(pixels,sx0,sy0): the source pixels a box maps into, with the
+           coordinates of their corner.  All of an array source; the
+           box's footprint (from its edges) read from a tile store.'''
+        if not isinstance(self.pixels,tilestore.store): return self.pixels,0,0
+        n = 16
+        t = numpy.linspace(0.0,1.0,n)
+        xs = numpy.concatenate((x0+t*(x1-1-x0),x0+t*(x1-1-x0),[x0]*n,[x1-1]*n)).astype(numpy.float64)
+        ys = numpy.concatenate(([y0]*n,[y1-1]*n,y0+t*(y1-1-y0),y0+t*(y1-1-y0))).astype(numpy.float64)
+        sx,sy = self.mapping(xs,ys)
+        h,w = self.pixels.shape[:2]
+        margin = resample.kernels[self.kernel][0]//2 + 2
+        sx0 = int(numpy.clip(math.floor(numpy.min(sx))-margin,0,w))
+        sy0 = int(numpy.clip(math.floor(numpy.min(sy))-margin,0,h))
+        sx1 = int(numpy.clip(math.ceil(numpy.max(sx))+margin+1,sx0,w))
+        sy1 = int(numpy.clip(math.ceil(numpy.max(sy))+margin+1,sy0,h))
+        return self.pixels.read(sx0,sy0,sx1-sx0,sy1-sy0),sx0,sy0
+    def _mapped(self,x0,y0,x1,y1):
+        '''(values,coverage) of a box of the mapped image.'''
+        source,sx0,sy0 = self._source(x0,y0,x1,y1)
+        if not source.size:
+            return (numpy.zeros((y1-y0,x1-x0,self.pixels.shape[2])),numpy.zeros((y1-y0,x1-x0)))
+        if self.supersample:
+            energy = None
+            if source is self.pixels:
+                if self._energy is None:
+                    self._energy = render.gradient_energy(self.pixels,render.tile_size)
+                energy = self._energy
+            def mapping(x,y):
+                sx,sy = self.mapping(x+x0,y+y0)
+                return sx-sx0,sy-sy0
+            pixels,report = render.render(source,mapping,(y1-y0,x1-x0),
+                                          kernel=self.kernel,energy_blocks=energy)
+            values = numpy.zeros((y1-y0,x1-x0,self.pixels.shape[2]))
+            values[...,:self.ncolor] = pixels[...,:-1]
+            if self.alpha:
+                values[...,-1] = pixels[...,-1]
+                return values,numpy.where(pixels[...,-1] > 0,1.0,0.0)
+            return values,pixels[...,-1]/255.0
+        y,x = numpy.mgrid[y0:y1,x0:x1].astype(numpy.float64)
+        sx,sy = self.mapping(x,y)
+        values,inside = resample.interpolate(source,sx-sx0,sy-sy0,self.kernel)
+        return values,inside.astype(numpy.float64)
+    def tile(self,x0,y0,x1,y1):
+        '''(colors,alpha,distance) of the canvas box x0,y0,x1,y1.
+
+           colors are (h,w,ncolor) floats 0-255, alpha 0-1 and distance
+           the distance to the edge of the layer times alpha.'''
+        shape = (y1-y0,x1-x0)
+        bx0,by0,bx1,by1 = self.bounds
+        if bx1 < x0-1 or by1 < y0-1 or bx0 > x1 or by0 > y1:
+            return numpy.zeros(shape+(self.ncolor,)),numpy.zeros(shape),numpy.zeros(shape)
+        if self.mapping is None: values,coverage = self._shifted(x0,y0,x1,y1)
+        else: values,coverage = self._mapped(x0,y0,x1,y1)
+        if self.alpha: alpha = numpy.clip(values[...,-1]/255.0,0.0,1.0)*(coverage > 0)
+        else: alpha = coverage
+        y,x = numpy.mgrid[y0:y1,x0:x1].astype(numpy.float64)
+        distance = polygon_distance(x,y,self.outline)*alpha
+        return values[...,:self.ncolor],alpha,distance
+
+def composite(reference,transformed,box,feather):
+    '''The (h,w,ncolor+1) uint8 panorama in a canvas box.
+
+       The reference layer is on top of the transformed layer, its
+       opacity feathered over feather pixels from its edges.'''
+    rcolors,ralpha,rdistance = reference.tile(*box)
+    tcolors,talpha,tdistance = transformed.tile(*box)
+    ncolor = max(reference.ncolor,transformed.ncolor)
+    rcolors = _colors(rcolors,ncolor) ; tcolors = _colors(tcolors,ncolor)
+    top = blend.feather_weights(rdistance,tdistance,feather)*ralpha
+    bottom = talpha*(1.0-top)
+    alpha = top + bottom
+    colors = (rcolors*top[...,numpy.newaxis] + tcolors*bottom[...,numpy.newaxis]) / \
+             numpy.where(alpha > 0.0,alpha,1.0)[...,numpy.newaxis]
+    out = numpy.empty(alpha.shape+(ncolor+1,),dtype=numpy.uint8)
+    out[...,:ncolor] = numpy.clip(numpy.round(colors),0,255)
+    out[...,-1] = numpy.round(alpha*255.0)
+    return out
+
+def proxy_factor(width,height,tile=tile_size,size=proxy_size):
+    '''Power of two (at most tile) the panorama is shrunk by for the proxy.'''
+    factor = 1
+    while max(width,height) > size*factor and factor < tile: factor *= 2
+    return factor
+
+def shrink(pixels,factor):
+    '''Block average of an (h,w,ncolor+1) uint8 tile, weighted by alpha.
+
+       h and w must be multiples of factor.'''
+    h,w,bpp = pixels.shape
+    values = pixels.astype(numpy.float64)
+    a = values[...,-1:]
+    values[...,:-1] *= a
+    blocks = values.reshape(h//factor,factor,w//factor,factor,bpp).sum(axis=3).sum(axis=1)
+    out = numpy.empty(blocks.shape)
+    asum = blocks[...,-1:]
+    out[...,:-1] = blocks[...,:-1]/numpy.where(asum > 0.0,asum,1.0)
+    out[...,-1:] = asum/(factor*factor)
+    return numpy.clip(numpy.round(out),0,255).astype(numpy.uint8)
+
+def write_panorama(filename,width,height,reference,transformed,feather,
+                   tile=tile_size,compression='deflate',size=proxy_size,progress=None):
+    '''Write the panorama of two layers to a tiled TIFF (BigTIFF if large).
+
+       Returns a proxy of the panorama at most about size pixels across
+       with alpha, for previewing.  progress(done,total) is called after
+       each tile.'''
+    ncolor = max(reference.ncolor,transformed.ncolor)
+    factor = proxy_factor(width,height,tile,size)
+    step = tile//factor
+    with tiffwriter.tiled_tiff(filename,width,height,ncolor+1,tile,compression) as tiff:
+        proxy = numpy.zeros((tiff.tiles_down*step,tiff.tiles_across*step,ncolor+1),dtype=numpy.uint8)
+        buffer = numpy.zeros((tile,tile,ncolor+1),dtype=numpy.uint8)
+        tiles = tiff.tiles()
+        for i,(column,row) in enumerate(tiles):
+            x0,y0,x1,y1 = tiff.tile_box(column,row)
+            buffer[:] = 0
+            buffer[:y1-y0,:x1-x0] = composite(reference,transformed,(x0,y0,x1,y1),feather)
+            tiff.write_tile(column,row,buffer)
+            proxy[row*step:(row+1)*step,column*step:(column+1)*step] = shrink(buffer,factor)
+            if progress: progress(i+1,len(tiles))
+    return proxy[:int(math.ceil(height/float(factor))),:int(math.ceil(width/float(factor)))]
@@ -0,0 +1,206 @@
+'''Simplex (Nelder-Mead) maximization with batched function evaluation.
+
+amoeba is a drop in replacement for the routine of the same name that
+used to live in stitch panorama.  Vertices which do not depend on each
+other (the initial simplex, the shrunken simplex and, optionally, the
+reflected and expanded points) are evaluated together through the map
+method of an executor, so a multiprocessing.Pool, a thread pool or a
+concurrent.futures executor can evaluate them in parallel.  The default
+executor evaluates them one after the other, which gives exactly the
+same result as the old routine.
+
+Function values are memoized by vertex, and the memo can be shared
+between calls (e.g. when restarting from the best vertex), so no vertex
+is ever evaluated twice.  A wall clock timeout stops the search early
+with the best vertex found so far.  Nothing here needs numpy.'''
+
+import time
+
+from gimplib import trace
+
+
+class serial_executor(object):
+    '''Evaluates one vertex after the other.'''
+    def map(self,func,iterable):
+        return [func(x) for x in iterable]
+
+class _call(object):
+    '''func(var,data=data) as a picklable callable of one argument.'''
+    def __init__(self,func,data):
+        self.func = func
+        self.data = data
+    def __call__(self,var):
+        return self.func(list(var),data=self.data)
+
+class evaluator(object):
+    '''Evaluates batches of vertices through an executor, with a memo.'''
+    def __init__(self,func,data=None,executor=None,memo=None):
+        self.call = trace.wrap(_call(func,data),'amoeba evaluation')
+        self.executor = executor or serial_executor()
+        if memo is None: memo = {}
+        self.memo = memo
+        self.evaluations = 0
+    def __call__(self,vertices):
+        '''Return the function values of a list of vertices.'''
+        keys = [tuple(v) for v in vertices]
+        missing = []
+        for key in keys:
+            if key not in self.memo and key not in missing:
+                missing.append(key)
+        if missing:
+            values = list(self.executor.map(self.call,missing))
+            self.evaluations += len(missing)
+            for key,value in zip(missing,values):
+                self.memo[key] = value
+        return [self.memo[key] for key in keys]
+
+@trace.traced('amoeba')
+def amoeba(var,scale,func,ftolerance=1.e-4,xtolerance=1.e-4,itmax=500,data=None,
+           executor=None,memo=None,timeout=None,speculative=False):
+    '''Use the simplex method to maximize a function of 1 or more variables.
+
+       Input:
+              var = the initial guess, a list with one element for each variable
+              scale = the search scale for each variable, a list with one
+                      element for each variable.
+              func = the function to maximize.
+
+       Optional Input:
+              ftolerance = convergence criterion on the function values (default = 1.e-4)
+              xtolerance = convergence criterion on the variable values (default = 1.e-4)
+              itmax = maximum number of iterations allowed (default = 500).
+              data = data to be passed to func (default = None).
+              executor = object with a map(func,iterable) method used to
+                         evaluate independent vertices (default = serial).
+              memo = dictionary of function values by tuple(vertex),
+                     shared between calls (default = a new dictionary).
+              timeout = wall clock limit in seconds (default = None, no limit).
+              speculative = evaluate the expanded vertex together with the
+                            reflected one instead of only when it is needed.
+                            Only worth it with a parallel executor
+                            (default = False).
+
+       Output:
+              (varbest,funcvalue,iterations)
+              varbest = a list of the variables at the maximum.
+              funcvalue = the function value at the maximum.
+              iterations = the number of iterations used.
+
+       - Setting itmax to zero disables the itmax check and the routine will run
+         until convergence, even if it takes forever.
+       - Setting ftolerance or xtolerance to 0.0 turns that convergence criterion
+         off.  But do not set both ftolerance and xtolerance to zero or the routine
+         will exit immediately without finding the maximum.
+       - To check for convergence, check if (iterations < itmax).  A timeout
+         also returns early, with the best vertex so far.
+
+       The function should be defined like func(var,data) where
+       data is optional data to pass to the function.  With a process
+       pool executor, func and data must be picklable.
+
+       Example:
+
+           from gimplib import optimize
+           def afunc(var,data=None): return 1.0-var[0]*var[0]-var[1]*var[1]
+           print optimize.amoeba([0.25,0.25],[0.5,0.5],afunc)
+
+       Version 1.0 2005-March-28 T. Metcalf
+               1.1 2005-March-29 T. Metcalf - Use scale in simsize calculation.
+                                            - Use func convergence *and* x convergence
+                                              rather than func convergence *or* x
+                                              convergence.
+               1.2 Batch evaluation through an executor, memo, timeout.
+       '''
+
+    evaluate = evaluator(func,data,executor,memo)
+    if timeout is not None: deadline = time.time() + timeout
+
+    nvar = len(var)       # number of variables in the minimization
+    nsimplex = nvar + 1   # number of vertices in the simplex
+
+    # first set up the simplex
+
+    simplex = [0]*(nvar+1)  # set the initial simplex
+    simplex[0] = list(var)
+    for i in range(nvar):
+        simplex[i+1] = list(var)
+        simplex[i+1][i] += scale[i]
+
+    fvalue = evaluate(simplex)  # set the function values for the simplex
+
+    # Ooze the simplex to the maximum
+
+    iteration = 0
+
+    while 1:
+        # find the index of the best and worst vertices in the simplex
+        ssworst = 0
+        ssbest  = 0
+        for i in range(nsimplex):
+            if fvalue[i] > fvalue[ssbest]:
+                ssbest = i
+            if fvalue[i] < fvalue[ssworst]:
+                ssworst = i
+
+        # get the average of the nsimplex-1 best vertices in the simplex
+        pavg = [0.0]*nvar
+        for i in range(nsimplex):
+            if i != ssworst:
+                for j in range(nvar): pavg[j] += simplex[i][j]
+        for j in range(nvar): pavg[j] = pavg[j]/nvar  # nvar is nsimplex-1
+        simscale = 0.0
+        for i in range(nvar):
+            simscale += abs(pavg[i]-simplex[ssworst][i])/scale[i]
+        simscale = simscale/nvar
+
+        # find the range of the function values
+        fscale = (abs(fvalue[ssbest])+abs(fvalue[ssworst]))/2.0
+        if fscale != 0.0:
+            frange = abs(fvalue[ssbest]-fvalue[ssworst])/fscale
+        else:
+            frange = 0.0  # all the fvalues are zero in this case
+
+        # have we converged?
+        if (((ftolerance <= 0.0 or frange < ftolerance) and    # converged to maximum
+             (xtolerance <= 0.0 or simscale < xtolerance)) or  # simplex contracted enough
+            (itmax and iteration >= itmax) or                  # ran out of iterations
+            (timeout is not None and time.time() > deadline)): # ran out of time
+            return simplex[ssbest],fvalue[ssbest],iteration
+
+        # reflect the worst vertex
+        pnew = [0.0]*nvar
+        pnew2 = [0.0]*nvar
+        for i in range(nvar):
+            pnew[i] = 2.0*pavg[i] - simplex[ssworst][i]
+            pnew2[i] = 3.0*pavg[i] - 2.0*simplex[ssworst][i]
+        if speculative:
+            fnew,fnew2 = evaluate([pnew,pnew2])
+        else:
+            fnew = evaluate([pnew])[0]
+        if fnew <= fvalue[ssworst]:
+            # the new vertex is worse than the worst so shrink
+            # the simplex.  The shrunken vertices are independent.
+            shrink = [i for i in range(nsimplex) if i != ssbest and i != ssworst]
+            for i in shrink:
+                for j in range(nvar):
+                    simplex[i][j] = 0.5*simplex[ssbest][j] + 0.5*simplex[i][j]
+            for j in range(nvar):
+                pnew[j] = 0.5*simplex[ssbest][j] + 0.5*simplex[ssworst][j]
+            values = evaluate([simplex[i] for i in shrink] + [pnew])
+            for i,value in zip(shrink,values):
+                fvalue[i] = value
+            fnew = values[-1]
+        elif fnew >= fvalue[ssbest]:
+            # the new vertex is better than the best so expand
+            # the simplex.
+            if not speculative:
+                fnew2 = evaluate([pnew2])[0]
+            if fnew2 > fnew:
+                # accept the new vertex in the simplex
+                pnew = pnew2
+                fnew = fnew2
+        # replace the worst vertex with the new vertex
+        for i in range(nvar):
+            simplex[ssworst][i] = pnew[i]
+        fvalue[ssworst] = fnew
+        iteration += 1
@@ -0,0 +1,120 @@
+'''Rasterized control point markers.
+
+The markers are antialiased disks drawn in a single color with partial
+opacity, like the circles stitch panorama used to draw with one ellipse
+select and bucket fill per point.  All the markers in a rectangle are
+rasterized in one vectorized pass and overlapping markers build up
+opacity the same way repeated bucket fills do.
+
+marker_overlay remembers which points were drawn, so after an edit only
+the rectangles around moved, added or deleted points are redrawn.  The
+layer holding the markers only needs to cover their bounding box.'''
+
+import collections
+import math
+
+import numpy
+
+max_dirty_rects = 16   # more than this are merged into their bounding box
+
+
+def marker_box(x,y,radius):
+    '''Integer rectangle (x0,y0,x1,y1) touched by a marker.'''
+    return (int(math.floor(x-radius-1.0)),int(math.floor(y-radius-1.0)),
+            int(math.ceil(x+radius+1.0)),int(math.ceil(y+radius+1.0)))
+
+def union(rects):
+    '''Bounding box of a list of rectangles, or None if it is empty.'''
+    if not rects: return None
+    return (min([r[0] for r in rects]),min([r[1] for r in rects]),
+            max([r[2] for r in rects]),max([r[3] for r in rects]))
+
+def intersection(a,b):
+    '''Intersection of two rectangles, or None if they do not overlap.'''
+    x0 = max(a[0],b[0]) ; y0 = max(a[1],b[1])
+    x1 = min(a[2],b[2]) ; y1 = min(a[3],b[3])
+    if x1 <= x0 or y1 <= y0: return None
+    return (x0,y0,x1,y1)
+
+def render(points,rect,radius=10.0,opacity=0.3):
+    '''Rasterize markers into an alpha array covering rect (x0,y0,x1,y1).
+
+       Pixel centers are at half integer coordinates.  The coverage of
+       each pixel by each disk is approximated by its distance to the
+       edge, and overlapping markers combine as 1-prod(1-opacity*coverage).
+       Returns a float array of shape (y1-y0,x1-x0) in [0,1].'''
+    x0,y0,x1,y1 = rect
+    height = y1 - y0
+    width = x1 - x0
+    # the log of the transparency, summed over markers
+    logt = numpy.zeros((height+2,width+2))
+    xy = numpy.array([p for p in points
+                      if intersection(marker_box(p[0],p[1],radius),rect)],
+                     dtype=numpy.float64).reshape(-1,2)
+    if len(xy):
+        size = int(math.ceil(radius))*2 + 3
+        offsets = numpy.arange(size)
+        # top left pixel of each marker's box, relative to rect
+        bx = numpy.floor(xy[:,0]-radius-1.0).astype(int) - x0
+        by = numpy.floor(xy[:,1]-radius-1.0).astype(int) - y0
+        px = bx[:,numpy.newaxis] + offsets            # (n,size)
+        py = by[:,numpy.newaxis] + offsets
+        dx = (px + x0 + 0.5) - xy[:,0:1]
+        dy = (py + y0 + 0.5) - xy[:,1:2]
+        distance = numpy.sqrt(dx[:,numpy.newaxis,:]**2 + dy[:,:,numpy.newaxis]**2)
+        coverage = numpy.clip(radius + 0.5 - distance,0.0,1.0)
+        # pixels outside rect go to the 1 pixel border of logt
+        ix = numpy.clip(px,-1,width) + 1
+        iy = numpy.clip(py,-1,height) + 1
+        iy,ix = numpy.broadcast_arrays(iy[:,:,numpy.newaxis],ix[:,numpy.newaxis,:])
+        numpy.add.at(logt,(iy,ix),numpy.log1p(-opacity*coverage))
+    return 1.0 - numpy.exp(logt[1:-1,1:-1])
+
+def to_pixels(alpha,color):
+    '''Make color+alpha pixels (uint8, shape (h,w,len(color)+1)).'''
+    h,w = alpha.shape
+    pixels = numpy.empty((h,w,len(color)+1),dtype=numpy.uint8)
+    pixels[:,:,:-1] = numpy.asarray(color,dtype=numpy.uint8)
+    pixels[:,:,-1] = numpy.round(alpha*255.0).astype(numpy.uint8)
+    return pixels
+
+class marker_overlay(object):
+    '''The markers drawn on one layer, for working out what to redraw.
+
+       rect is the area covered by the layer (image coordinates) and
+       points the marker positions last drawn into it.'''
+    def __init__(self,radius=10.0,opacity=0.3):
+        self.radius = radius
+        self.opacity = opacity
+        self.reset()
+    def reset(self):
+        '''Forget the layer, e.g. after it has been removed.'''
+        self.rect = None
+        self.points = []
+    def bounds(self,points,width,height):
+        '''Bounding box of the markers, clipped to a width x height image.'''
+        box = union([marker_box(x,y,self.radius) for x,y in points])
+        if box is None: return None
+        return intersection(box,(0,0,width,height))
+    def covers(self,rect):
+        '''Does the layer cover rect?'''
+        return self.rect is not None and rect is not None and \
+               intersection(self.rect,rect) == rect
+    def dirty(self,points):
+        '''Rectangles to redraw to go from the drawn points to points.
+
+           Only the boxes of points which were added or removed (moving
+           is both) are dirty.  They are clipped to the layer.'''
+        old = collections.Counter(self.points)
+        new = collections.Counter(points)
+        changed = list((old-new).elements()) + list((new-old).elements())
+        rects = [marker_box(x,y,self.radius) for x,y in changed]
+        if len(rects) > max_dirty_rects:
+            rects = [union(rects)]
+        clipped = []
+        for r in rects:
+            r = intersection(r,self.rect)
+            if r: clipped.append(r)
+        return clipped
+    def render(self,points,rect):
+        return render(points,rect,self.radius,self.opacity)
@@ -0,0 +1,176 @@
+'''Choosing which pairs of images to match in a panorama of many.
+
+Matching control points between every pair of N images takes N*(N-1)/2
+matches, most of them between images which do not overlap.  pairs
+describes each image by a tiny global descriptor made from a thumbnail
+of it (from ingest) and proposes only the pairs whose descriptors are
+alike, together with the neighbours in the capture sequence, which
+nearly always overlap.
+
+The descriptor is GIST-like: a coarse color histogram, a histogram of
+gradient orientations over a 4x4 grid of cells, and an 8x8 brightness
+thumbnail, each normalized.  Images of a panorama overlap only in part,
+so besides the whole image each image is also described by its four
+halves, and a pair scores the best of the whole against the whole and
+of each half against the facing half of the other image (the right
+half of one against the left half of the other, and so on).
+
+Each image proposes its k best partners, k being recall times the
+number of other images (at least min_partners), so recall is the knob
+between finding every overlap (1.0 matches all pairs) and time.  The
+report lists the proposed pairs with their reasons and the skipped
+pairs with their scores.'''
+
+import math
+import numpy
+
+color_bins = 4          # bins per channel of the color histogram
+grid = 4                # cells per side for the gradient histograms
+orientations = 8        # orientation bins per cell
+thumb = 8               # size of the brightness thumbnail
+min_partners = 2        # partners proposed for each image, at least
+sequence_window = 1     # capture sequence neighbours always proposed
+
+# the facing halves: a part of one image against a part of the other
+facing = (('whole','whole'),('right','left'),('left','right'),
+          ('bottom','top'),('top','bottom'))
+
+
+def _normalize(v):
+    v = numpy.asarray(v,dtype=numpy.float64).ravel()
+    norm = math.sqrt(numpy.dot(v,v))
+    return v/norm if norm > 0 else v
+
+def _block_mean(values,rows,columns):
+    '''Mean of values over a rows x columns grid of blocks.'''
+    h,w = values.shape[:2]
+    ys = numpy.linspace(0,h,rows+1).astype(int)
+    xs = numpy.linspace(0,w,columns+1).astype(int)
+    out = numpy.zeros((rows,columns)+values.shape[2:])
+    for j in range(rows):
+        for i in range(columns):
+            block = values[ys[j]:max(ys[j+1],ys[j]+1),xs[i]:max(xs[i+1],xs[i]+1)]
+            out[j,i] = block.reshape((-1,)+values.shape[2:]).mean(axis=0)
+    return out
+
+def describe(pixels):
+    '''The descriptor (a unit vector) of an (h,w[,bpp]) uint8 thumbnail.'''
+    pixels = numpy.asarray(pixels,dtype=numpy.float64)
+    if pixels.ndim == 2: pixels = pixels[:,:,numpy.newaxis]
+    bpp = pixels.shape[2]
+    ncolor = bpp-1 if bpp in (2,4) else bpp
+    colors = pixels[...,:ncolor]
+    if ncolor == 1: colors = numpy.concatenate([colors]*3,axis=2)
+    value = colors.mean(axis=2)
+    # coarse joint color histogram
+    bins = numpy.minimum((colors*color_bins/256.0).astype(int),color_bins-1)
+    index = (bins[...,0]*color_bins + bins[...,1])*color_bins + bins[...,2]
+    histogram = numpy.bincount(index.ravel(),minlength=color_bins**3).astype(numpy.float64)
+    # gradient orientations, weighted by magnitude, over a grid of cells
+    gx = numpy.zeros_like(value) ; gy = numpy.zeros_like(value)
+    gx[:,1:-1] = value[:,2:] - value[:,:-2]
+    gy[1:-1,:] = value[2:,:] - value[:-2,:]
+    magnitude = numpy.hypot(gx,gy)
+    angle = numpy.mod(numpy.arctan2(gy,gx),math.pi)      # unsigned orientation
+    obin = numpy.minimum((angle*orientations/math.pi).astype(int),orientations-1)
+    energy = numpy.zeros(value.shape+(orientations,))
+    rows,columns = numpy.indices(value.shape)
+    energy[rows,columns,obin] = magnitude
+    cells = _block_mean(energy,grid,grid)
+    # brightness thumbnail, zero mean
+    small = _block_mean(value,thumb,thumb)
+    small = small - small.mean()
+    return numpy.concatenate((_normalize(histogram),_normalize(cells),_normalize(small)))/math.sqrt(3.0)
+
+def describe_parts(pixels):
+    '''Descriptors of the whole image and of its four halves.'''
+    pixels = numpy.asarray(pixels)
+    h,w = pixels.shape[:2]
+    return {'whole':describe(pixels),
+            'left':describe(pixels[:,:max(w//2,1)]),'right':describe(pixels[:,w//2:]),
+            'top':describe(pixels[:max(h//2,1)]),'bottom':describe(pixels[h//2:])}
+
+def similarity(a,b):
+    '''Best cosine similarity of facing parts of two images' descriptors.'''
+    return max([float(numpy.dot(a[pa],b[pb])) for pa,pb in facing])
+
+def similarity_matrix(descriptors):
+    n = len(descriptors)
+    scores = numpy.eye(n)
+    for i in range(n):
+        for j in range(i+1,n):
+            scores[i,j] = scores[j,i] = similarity(descriptors[i],descriptors[j])
+    return scores
+
+def partners(n,recall):
+    '''Number of partners each image proposes for a recall.'''
+    if n < 2: return 0
+    return int(min(max(int(math.ceil(recall*(n-1))),min_partners),n-1))
+
+class report(object):
+    '''The pairs proposed for matching and the pairs skipped.
+
+       proposed maps (i,j), i < j, to (score,reasons) and skipped to the
+       score.  names label the images in the summary.'''
+    def __init__(self,names,scores,proposed,skipped,recall):
+        self.names = names
+        self.scores = scores
+        self.proposed = proposed
+        self.skipped = skipped
+        self.recall = recall
+    def pairs(self):
+        '''The proposed pairs, best first.'''
+        return sorted(self.proposed,key=lambda p: -self.proposed[p][0])
+    def partners_of(self,i):
+        '''The images proposed to be matched with image i, best first.'''
+        result = [(score,j if a == i else a) for (a,j),(score,reasons) in self.proposed.items()
+                  if i in (a,j)]
+        return [j for score,j in sorted(result,reverse=True)]
+    def total(self):
+        return len(self.proposed) + len(self.skipped)
+    def as_dict(self):
+        return {'recall':self.recall,'total':self.total(),
+                'proposed':[[self.names[i],self.names[j],score,reasons]
+                            for (i,j),(score,reasons) in sorted(self.proposed.items())],
+                'skipped':[[self.names[i],self.names[j],score]
+                           for (i,j),score in sorted(self.skipped.items())]}
+    def summary(self):
+        lines = ['%d of %d pairs proposed (recall %g)' % (len(self.proposed),self.total(),self.recall)]
+        for i,j in self.pairs():
+            score,reasons = self.proposed[(i,j)]
+            lines.append('  match %s - %s  %.3f  %s' % (self.names[i],self.names[j],score,
+                                                         ', '.join(reasons)))
+        for (i,j),score in sorted(self.skipped.items(),key=lambda p: -p[1]):
+            lines.append('  skip  %s - %s  %.3f' % (self.names[i],self.names[j],score))
+        return '\n'.join(lines)
+
+def select(descriptors,recall=0.5,sequence=None,names=None):
+    '''Choose the pairs of images to match.
+
+       descriptors are from describe_parts, one per image, and sequence
+       the capture order (a sort key per image, e.g. the EXIF time) or
+       None.  Returns a report.'''
+    n = len(descriptors)
+    if names is None: names = [str(i) for i in range(n)]
+    scores = similarity_matrix(descriptors)
+    k = partners(n,recall)
+    proposed = {}
+    def propose(i,j,reason):
+        key = (min(i,j),max(i,j))
+        reasons = proposed.setdefault(key,(scores[i,j],[]))[1]
+        if reason not in reasons: reasons.append(reason)
+    for i in range(n):
+        others = [j for j in numpy.argsort(-scores[i]) if j != i]
+        for j in others[:k]:
+            propose(i,int(j),'similar')
+    if sequence is not None:
+        order = sorted(range(n),key=lambda i: sequence[i])
+        for position,i in enumerate(order):
+            for j in order[position+1:position+1+sequence_window]:
+                propose(i,j,'sequence')
+    skipped = {}
+    for i in range(n):
+        for j in range(i+1,n):
+            if (i,j) not in proposed: skipped[(i,j)] = float(scores[i,j])
+    proposed = dict([(key,(float(score),reasons)) for key,(score,reasons) in proposed.items()])
+    return report(names,scores,proposed,skipped,recall)
@@ -0,0 +1,92 @@
+'''Array access to gimp drawables.
+
+read copies a rectangle of a drawable into an (h,w,bpp) uint8 array and
+write puts an array back, both a strip of rows at a time through pixel
+regions, instead of one pixel region access per pixel.  A rectangle
+read in one strip is returned as a read-only view of the string gimp
+returns, without a copy.
+
+Pixels are 8-bit with bpp channels: 1 gray, 2 gray+alpha, 3 RGB,
+4 RGBA.  Masks and channels have bpp 1 and are read and written as 2-D
+arrays.  Float arrays are taken to be in [0,1].'''
+
+import numpy
+
+strip_rows = 64       # rows read or written per pixel region access
+
+
+def has_alpha(bpp):
+    return bpp in (2,4)
+
+def color_channels(bpp):
+    '''Number of color channels (not counting alpha) for a bpp.'''
+    if has_alpha(bpp): return bpp - 1
+    return bpp
+
+def _rect(drawable,x,y,w,h):
+    if w is None: w = drawable.width - x
+    if h is None: h = drawable.height - y
+    return x,y,w,h
+
+def read_region(rgn):
+    '''Read a whole pixel region into an (h,w,bpp) array (a view, no copy).'''
+    data = numpy.frombuffer(rgn[rgn.x:rgn.x+rgn.w,rgn.y:rgn.y+rgn.h],dtype=numpy.uint8)
+    return data.reshape(rgn.h,rgn.w,rgn.bpp)
+
+def read(drawable,x=0,y=0,w=None,h=None,dtype=None,copy=False):
+    '''Read a rectangle (drawable coordinates, default all) into an array.
+
+       The result is (h,w,bpp) uint8, or (h,w) for drawables with one
+       channel.  If dtype is a float type, the values are scaled to
+       [0,1].  If the rectangle fits in one strip the array is a read
+       only view of the region data unless copy is True.'''
+    x,y,w,h = _rect(drawable,x,y,w,h)
+    rgn = drawable.get_pixel_rgn(x,y,w,h,False,False)
+    bpp = rgn.bpp
+    if h <= strip_rows:
+        pixels = read_region(rgn)
+        if copy: pixels = pixels.copy()
+    else:
+        pixels = numpy.empty((h,w,bpp),dtype=numpy.uint8)
+        for y0 in range(0,h,strip_rows):
+            y1 = min(y0+strip_rows,h)
+            strip = numpy.frombuffer(rgn[x:x+w,y+y0:y+y1],dtype=numpy.uint8)
+            pixels[y0:y1] = strip.reshape(y1-y0,w,bpp)
+    if bpp == 1: pixels = pixels[:,:,0]
+    if dtype is not None and numpy.dtype(dtype).kind == 'f':
+        return pixels.astype(dtype)/255.0
+    return pixels
+
+def iter_strips(drawable,x=0,y=0,w=None,h=None):
+    '''Iterate over (y0,pixels) strips of a rectangle, pixels as from read.'''
+    x,y,w,h = _rect(drawable,x,y,w,h)
+    for y0 in range(y,y+h,strip_rows):
+        yield y0,read(drawable,x,y0,w,min(strip_rows,y+h-y0))
+
+def as_uint8(array):
+    '''Convert an array for writing: floats in [0,1] are scaled to 0-255.'''
+    array = numpy.asarray(array)
+    if array.dtype.kind == 'f':
+        array = numpy.round(numpy.clip(array,0.0,1.0)*255.0)
+    if array.dtype != numpy.uint8:
+        array = numpy.clip(array,0,255).astype(numpy.uint8)
+    return array
+
+def write(drawable,array,x=0,y=0,update=True):
+    '''Write an (h,w,bpp) or (h,w) array into a drawable at x,y.
+
+       With update, the drawable is flushed and the rectangle updated
+       on the display.'''
+    array = as_uint8(array)
+    h,w = array.shape[:2]
+    if array.ndim == 2: array = array[:,:,numpy.newaxis]
+    rgn = drawable.get_pixel_rgn(x,y,w,h,True,False)
+    if array.shape[2] != rgn.bpp:
+        raise ValueError('array has %d channels but the drawable has %d' %
+                         (array.shape[2],rgn.bpp))
+    for y0 in range(0,h,strip_rows):
+        y1 = min(y0+strip_rows,h)
+        rgn[x:x+w,y+y0:y+y1] = numpy.ascontiguousarray(array[y0:y1]).tobytes()
+    if update:
+        drawable.flush()
+        drawable.update(x,y,w,h)
@@ -0,0 +1,186 @@
+'''Cylindrical and spherical projection of images for wide panoramas.
+
+stitch panorama warps the transformed image onto the plane of the
+reference image.  For a wide field of view the plane stretches the
+edges without bound, so the panorama gets huge and mostly empty.
+Projecting both images onto a cylinder (or sphere) around the camera
+first makes a turn of the camera a shift of the image, and the
+panorama grows only linearly with the field of view.
+
+Each image is projected about its own center with the focal length f
+of the camera in pixels.  For a point (x,y) relative to the center
+
+    cylindrical:  u = f*atan(x/f)   v = f*y/sqrt(x*x+f*f)
+    spherical:    u = f*atan(x/f)   v = f*atan(y/sqrt(x*x+f*f))
+
+The inverse mappings are separable (x depends on u only and y is a
+function of v times a function of u), so the coordinate grid used to
+remap an image is two short tables per image size.  If the focal
+length is not known it can be estimated from the control points (see
+estimate_focal_length).'''
+
+import math
+import numpy
+
+from gimplib import resample
+
+kinds = ('planar','cylindrical','spherical')
+strip_rows = 64      # output rows remapped at a time
+
+
+def center(shape):
+    '''Center of an image of shape (height,width,...) in pixel coordinates.'''
+    return (shape[1]-1)/2.0,(shape[0]-1)/2.0
+
+def forward(x,y,focal,kind):
+    '''Projection of points x,y relative to the image center.'''
+    if kind == 'planar': return x,y
+    x = numpy.asarray(x,dtype=numpy.float64)
+    y = numpy.asarray(y,dtype=numpy.float64)
+    r = numpy.hypot(x,focal)
+    u = focal*numpy.arctan2(x,focal)
+    if kind == 'cylindrical':
+        v = focal*y/r
+    else:
+        v = focal*numpy.arctan2(y,r)
+    return u,v
+
+def _column_table(u,focal,kind):
+    '''The parts of the inverse mapping which depend on u only.'''
+    x = focal*numpy.tan(u/focal)
+    return x,numpy.hypot(x,focal)/focal
+
+def _row_table(v,focal,kind):
+    '''The part of the inverse mapping which depends on v only.'''
+    if kind == 'cylindrical': return v
+    return focal*numpy.tan(v/focal)
+
+def inverse(u,v,focal,kind):
+    '''Points x,y relative to the image center projecting to u,v.'''
+    if kind == 'planar': return u,v
+    x,scale = _column_table(numpy.asarray(u,dtype=numpy.float64),focal,kind)
+    return x,_row_table(numpy.asarray(v,dtype=numpy.float64),focal,kind)*scale
+
+def frame(shape,focal,kind):
+    '''Size of the projected image and the projected image center.
+
+       Returns (width,height,(cx,cy)): projected pixel coordinates are
+       forward() + (cx,cy).  The image edges are sampled, so the frame
+       holds the whole projected image.'''
+    h,w = shape[:2]
+    cx,cy = center(shape)
+    n = 65
+    xs = numpy.concatenate((numpy.linspace(0,w-1,n),numpy.linspace(0,w-1,n),
+                            numpy.zeros(n),numpy.zeros(n)+w-1)) - cx
+    ys = numpy.concatenate((numpy.zeros(n),numpy.zeros(n)+h-1,
+                            numpy.linspace(0,h-1,n),numpy.linspace(0,h-1,n))) - cy
+    # the middle row and column bulge out in the spherical projection
+    xs = numpy.concatenate((xs,[0.0,0.0,-cx,w-1-cx]))
+    ys = numpy.concatenate((ys,[-cy,h-1-cy,0.0,0.0]))
+    u,v = forward(xs,ys,focal,kind)
+    u0 = math.floor(u.min()) ; v0 = math.floor(v.min())
+    width = int(math.ceil(u.max()) - u0) + 1
+    height = int(math.ceil(v.max()) - v0) + 1
+    return width,height,(-u0,-v0)
+
+def to_projected(x,y,shape,focal,kind):
+    '''Projected image coordinates of image points x,y.'''
+    cx,cy = center(shape)
+    width,height,(px,py) = frame(shape,focal,kind)
+    u,v = forward(numpy.asarray(x)-cx,numpy.asarray(y)-cy,focal,kind)
+    return u+px,v+py
+
+def from_projected(u,v,shape,focal,kind):
+    '''Image coordinates of projected image points u,v.'''
+    cx,cy = center(shape)
+    width,height,(px,py) = frame(shape,focal,kind)
+    x,y = inverse(numpy.asarray(u)-px,numpy.asarray(v)-py,focal,kind)
+    return x+cx,y+cy
+
+def remap(pixels,focal,kind,kernel='linear'):
+    '''Project an (h,w,bpp) uint8 image.
+
+       Returns the projected image with an alpha channel (added if the
+       image has none) which is 0 outside the projected image.  The
+       output is made a strip of rows at a time, reading only the
+       input rows each strip needs.  kernel is a resample kernel name.'''
+    pixels = numpy.asarray(pixels)
+    if pixels.ndim == 2: pixels = pixels[:,:,numpy.newaxis]
+    h,w,bpp = pixels.shape
+    alpha = bpp in (2,4)
+    ncolor = bpp-1 if alpha else bpp
+    cx,cy = center(pixels.shape)
+    width,height,(px,py) = frame(pixels.shape,focal,kind)
+    # the coordinate grid, as tables along each axis
+    xcol,scale = _column_table(numpy.arange(width)-px,focal,kind)
+    xcol = xcol + cx
+    vrow = _row_table(numpy.arange(height)-py,focal,kind)
+    out = numpy.zeros((height,width,ncolor+1),dtype=numpy.uint8)
+    margin = resample.kernels[kernel][0]//2
+    for y0 in range(0,height,strip_rows):
+        y1 = min(y0+strip_rows,height)
+        ys = vrow[y0:y1,numpy.newaxis]*scale[numpy.newaxis,:] + cy
+        xs = numpy.repeat(xcol[numpy.newaxis,:],y1-y0,axis=0)
+        iy0 = max(int(math.floor(ys.min()))-margin,0)
+        iy1 = min(int(math.ceil(ys.max()))+1+margin,h)
+        if iy1 <= iy0: continue
+        source = pixels[iy0:iy1]
+        ys = ys - iy0
+        values,inside = resample.interpolate(source,xs,ys,kernel)
+        out[y0:y1,:,:ncolor] = numpy.clip(numpy.round(values[...,:ncolor]),0,255)
+        if alpha:
+            out[y0:y1,:,-1] = numpy.clip(numpy.round(values[...,-1]),0,255)
+        else:
+            out[y0:y1,:,-1] = numpy.where(inside,255,0)
+    return out
+
+def _affine_residual(rpoints,tpoints):
+    '''RMS residual of the least squares affine fit of tpoints to rpoints.'''
+    a = numpy.hstack((tpoints,numpy.ones((len(tpoints),1))))
+    fit = numpy.linalg.lstsq(a,rpoints,rcond=None)[0]
+    residual = numpy.dot(a,fit) - rpoints
+    return math.sqrt((residual**2).sum(axis=1).mean())
+
+def estimate_focal_length(rpoints,tpoints,rshape,tshape,kind,fmin=None,fmax=None):
+    '''Estimate the focal length (pixels) from control points.
+
+       rpoints and tpoints are (n,2) arrays of matching points in the
+       reference and transformed images.  The focal length is the one
+       for which the projected points are best fitted by an affine
+       transform, searched between fmin and fmax (default 0.2 to 20
+       times the reference image diagonal).  Returns (focal,rms) or
+       None with fewer than 4 points, which any affine fit matches
+       exactly.  With a narrow field of view the residual hardly
+       depends on the focal length and the estimate is poor.'''
+    rpoints = numpy.asarray(rpoints,dtype=numpy.float64).reshape(-1,2)
+    tpoints = numpy.asarray(tpoints,dtype=numpy.float64).reshape(-1,2)
+    if len(rpoints) < 4 or kind == 'planar': return None
+    diagonal = math.hypot(rshape[0],rshape[1])
+    if fmin is None: fmin = 0.2*diagonal
+    if fmax is None: fmax = 20.0*diagonal
+    rc = center(rshape) ; tc = center(tshape)
+    def residual(logf):
+        f = math.exp(logf)
+        r = numpy.column_stack(forward(rpoints[:,0]-rc[0],rpoints[:,1]-rc[1],f,kind))
+        t = numpy.column_stack(forward(tpoints[:,0]-tc[0],tpoints[:,1]-tc[1],f,kind))
+        return _affine_residual(r,t)
+    # coarse scan, then golden section search around the best sample
+    samples = numpy.linspace(math.log(fmin),math.log(fmax),41)
+    values = [residual(s) for s in samples]
+    i = int(numpy.argmin(values))
+    a = samples[max(i-1,0)] ; b = samples[min(i+1,len(samples)-1)]
+    golden = (math.sqrt(5.0)-1.0)/2.0
+    c = b - golden*(b-a) ; d = a + golden*(b-a)
+    fc = residual(c) ; fd = residual(d)
+    for iteration in range(40):
+        if fc < fd:
+            b,d,fd = d,c,fc
+            c = b - golden*(b-a)
+            fc = residual(c)
+        else:
+            a,c,fc = c,d,fd
+            d = a + golden*(b-a)
+            fd = residual(d)
+        if b-a < 1.e-5: break
+    logf = (a+b)/2.0
+    return math.exp(logf),residual(logf)
@@ -0,0 +1,188 @@
+'''Warping with supersampling only where it is needed.
+
+gimp_drawable_transform_matrix supersamples the whole drawable or none
+of it.  render cuts the output into tiles and decides for each tile.
+The Jacobian of the mapping (output to source coordinates) at the tile
+center gives the number of source pixels an output pixel spans along
+its longest direction, the scale.  The gradient energy of the source
+(the mean squared difference of neighbouring pixels of its brightness)
+is averaged over source blocks, and a tile takes the largest energy of
+the blocks its source footprint covers.  A tile whose scale is above
+min_scale and whose energy is above min_energy is supersampled n x n,
+n being the scale rounded up (at most max_samples), since that is where
+detail finer than the output pixels would alias.  Magnified tiles and
+flat minified tiles get one sample per pixel.
+
+render returns the warped image and a report of the scale, energy and
+samples of every tile, which shows where the extra samples went and
+how many were spent against supersampling everything.  Coordinates
+are array indices as in resample.'''
+
+import math
+import numpy
+
+from gimplib import resample
+
+tile_size = 64        # output tile size in pixels
+max_samples = 4       # largest supersampling (per axis) of a tile
+min_scale = 1.25      # tiles minifying less than this are not supersampled
+min_energy = 16.0     # nor tiles whose source is flatter than this (levels**2)
+
+
+def brightness(pixels):
+    '''Mean of the color channels of an (h,w[,bpp]) image.'''
+    pixels = numpy.asarray(pixels,dtype=numpy.float64)
+    if pixels.ndim == 2: return pixels
+    bpp = pixels.shape[2]
+    ncolor = bpp-1 if bpp in (2,4) else bpp
+    return pixels[...,:ncolor].mean(axis=2)
+
+def gradient_energy(pixels,block=tile_size):
+    '''Mean squared neighbour difference of the brightness over blocks.
+
+       Returns a (ceil(h/block),ceil(w/block)) array.'''
+    value = brightness(pixels)
+    h,w = value.shape
+    energy = numpy.zeros((h,w))
+    dx = numpy.diff(value,axis=1)**2
+    dy = numpy.diff(value,axis=0)**2
+    energy[:,:-1] += dx ; energy[:,1:] += dx
+    energy[:-1,:] += dy ; energy[1:,:] += dy
+    bh = int(math.ceil(h/float(block))) ; bw = int(math.ceil(w/float(block)))
+    padded = numpy.zeros((bh*block,bw*block))
+    padded[:h,:w] = energy
+    count = numpy.zeros((bh*block,bw*block))
+    count[:h,:w] = 1.0
+    sums = padded.reshape(bh,block,bw,block).sum(axis=3).sum(axis=1)
+    counts = count.reshape(bh,block,bw,block).sum(axis=3).sum(axis=1)
+    return sums/(2.0*numpy.maximum(counts,1.0))
+
+def jacobian_scale(mapping,x,y,delta=0.5):
+    '''Largest singular value of the Jacobian of mapping at points x,y.'''
+    x = numpy.asarray(x,dtype=numpy.float64)
+    y = numpy.asarray(y,dtype=numpy.float64)
+    x0,y0 = mapping(x-delta,y) ; x1,y1 = mapping(x+delta,y)
+    a = (numpy.asarray(x1)-x0)/(2*delta) ; c = (numpy.asarray(y1)-y0)/(2*delta)
+    x0,y0 = mapping(x,y-delta) ; x1,y1 = mapping(x,y+delta)
+    b = (numpy.asarray(x1)-x0)/(2*delta) ; d = (numpy.asarray(y1)-y0)/(2*delta)
+    # singular values of [[a,b],[c,d]]
+    s = a*a + b*b + c*c + d*d
+    det = a*d - b*c
+    return numpy.sqrt((s + numpy.sqrt(numpy.maximum(s*s - 4.0*det*det,0.0)))/2.0)
+
+class report(object):
+    '''Scale, energy and samples per pixel side of each output tile.'''
+    def __init__(self,shape,tile,scale,energy,samples):
+        self.shape = tuple(shape[:2])
+        self.tile = tile
+        self.scale = scale
+        self.energy = energy
+        self.samples = samples
+    def tile_pixels(self):
+        '''Number of output pixels in each tile.'''
+        h,w = self.shape
+        rows = numpy.minimum(self.tile,h - numpy.arange(self.scale.shape[0])*self.tile)
+        cols = numpy.minimum(self.tile,w - numpy.arange(self.scale.shape[1])*self.tile)
+        return rows[:,numpy.newaxis]*cols[numpy.newaxis,:]
+    def total_samples(self):
+        return int((self.tile_pixels()*self.samples**2).sum())
+    def uniform_samples(self):
+        '''Samples taken by supersampling every tile like the worst one.'''
+        return int(self.shape[0]*self.shape[1]*self.samples.max()**2)
+    def supersampled(self):
+        return int((self.samples > 1).sum())
+    def totals(self):
+        return {'tiles':int(self.samples.size),
+                'supersampled_tiles':self.supersampled(),
+                'samples':self.total_samples(),
+                'pixels':self.shape[0]*self.shape[1],
+                'uniform_samples':self.uniform_samples()}
+    def as_dict(self):
+        result = self.totals()
+        result.update({'tile':self.tile,'scale':self.scale.tolist(),
+                       'energy':self.energy.tolist(),'samples':self.samples.tolist()})
+        return result
+    def map(self):
+        '''The samples per pixel side of each tile as rows of digits.'''
+        return '\n'.join([''.join([str(n) for n in row]) for row in self.samples])
+    def summary(self):
+        totals = self.totals()
+        text = '%(supersampled_tiles)d of %(tiles)d tiles supersampled, ' \
+               '%(samples)d samples for %(pixels)d pixels' % totals
+        if totals['uniform_samples'] > totals['pixels']:
+            text += ' (%d supersampling everything)' % totals['uniform_samples']
+        return text + '\n' + self.map()
+
+def plan(source,mapping,shape,tile=tile_size,energy_blocks=None):
+    '''The report of render without rendering: the samples of each tile.
+
+       energy_blocks is gradient_energy(source,tile) if already known.'''
+    h,w = shape[:2]
+    ty = int(math.ceil(h/float(tile))) ; tx = int(math.ceil(w/float(tile)))
+    x0 = numpy.arange(tx)*tile ; y0 = numpy.arange(ty)*tile
+    x1 = numpy.minimum(x0+tile,w)-1 ; y1 = numpy.minimum(y0+tile,h)-1
+    cx = (x0+x1)/2.0 ; cy = (y0+y1)/2.0
+    cx,cy = numpy.meshgrid(cx,cy)
+    scale = jacobian_scale(mapping,cx,cy)
+    if energy_blocks is None: energy_blocks = gradient_energy(source,tile)
+    bh,bw = energy_blocks.shape
+    sh,sw = numpy.shape(source)[:2]
+    energy = numpy.zeros((ty,tx))
+    for j in range(ty):
+        for i in range(tx):
+            # the source footprint of the tile, from its corners and edge midpoints
+            xs = numpy.array([x0[i],cx[j,i],x1[i],x0[i],x1[i],x0[i],cx[j,i],x1[i]],dtype=numpy.float64)
+            ys = numpy.array([y0[j],y0[j],y0[j],cy[j,i],cy[j,i],y1[j],y1[j],y1[j]],dtype=numpy.float64)
+            sx,sy = mapping(xs,ys)
+            sx = numpy.asarray(sx) ; sy = numpy.asarray(sy)
+            if sx.max() < 0 or sy.max() < 0 or sx.min() > sw-1 or sy.min() > sh-1: continue
+            bx0 = int(numpy.clip(math.floor(sx.min()/tile),0,bw-1))
+            bx1 = int(numpy.clip(math.floor(sx.max()/tile),0,bw-1))
+            by0 = int(numpy.clip(math.floor(sy.min()/tile),0,bh-1))
+            by1 = int(numpy.clip(math.floor(sy.max()/tile),0,bh-1))
+            energy[j,i] = energy_blocks[by0:by1+1,bx0:bx1+1].max()
+    samples = numpy.ones((ty,tx),dtype=int)
+    risky = (scale > min_scale) & (energy > min_energy)
+    samples[risky] = numpy.minimum(numpy.ceil(scale[risky]),max_samples).astype(int)
+    return report(shape,tile,scale,energy,samples)
+
+def render(source,mapping,shape,tile=tile_size,kernel='linear',energy_blocks=None):
+    '''Warp an (h,w,bpp) uint8 image to shape with supersampling by tile.
+
+       mapping(xs,ys) takes output coordinates to source coordinates.
+       Returns (pixels,report), pixels having an alpha channel (added
+       if the source has none) which is the covered fraction of each
+       output pixel.  Rendering a large output in pieces, pass the
+       gradient_energy(source,tile) of the source to each piece.'''
+    source = numpy.asarray(source)
+    if source.ndim == 2: source = source[:,:,numpy.newaxis]
+    bpp = source.shape[2]
+    alpha = bpp in (2,4)
+    ncolor = bpp-1 if alpha else bpp
+    h,w = shape[:2]
+    tiles = plan(source,mapping,shape,tile,energy_blocks)
+    out = numpy.zeros((h,w,ncolor+1),dtype=numpy.uint8)
+    for j in range(tiles.samples.shape[0]):
+        for i in range(tiles.samples.shape[1]):
+            x0 = i*tile ; y0 = j*tile
+            x1 = min(x0+tile,w) ; y1 = min(y0+tile,h)
+            n = tiles.samples[j,i]
+            offsets = (numpy.arange(n)+0.5)/n - 0.5
+            y,x = numpy.mgrid[y0:y1,x0:x1].astype(numpy.float64)
+            xs = x[...,numpy.newaxis,numpy.newaxis] + offsets[numpy.newaxis,:]
+            ys = y[...,numpy.newaxis,numpy.newaxis] + offsets[:,numpy.newaxis]
+            xs,ys = numpy.broadcast_arrays(xs,ys)
+            sx,sy = mapping(xs,ys)
+            values,inside = resample.interpolate(source,sx,sy,kernel)
+            weight = inside.reshape(inside.shape[:2]+(n*n,)).astype(numpy.float64)
+            values = values.reshape(values.shape[:2]+(n*n,bpp))
+            count = weight.sum(axis=2)
+            colors = (values[...,:ncolor]*weight[...,numpy.newaxis]).sum(axis=2) / \
+                     numpy.maximum(count,1.0)[...,numpy.newaxis]
+            out[y0:y1,x0:x1,:ncolor] = numpy.clip(numpy.round(colors),0,255)
+            if alpha:
+                a = values[...,-1].sum(axis=2)/(n*n)
+            else:
+                a = 255.0*count/(n*n)
+            out[y0:y1,x0:x1,-1] = numpy.clip(numpy.round(a),0,255)
+    return out,tiles
@@ -0,0 +1,271 @@
+'''Resampling of 2-D arrays: affine remapping and image pyramids.
+
+Coordinates are array indices, x along the columns and y along the
+rows, with pixel centers at integer positions.  Transforms are 3x3
+matrices acting on column vectors (x,y,1) and map output coordinates
+to input coordinates, i.e. they are the inverse of the warp applied to
+the image.
+
+Validity masks are carried along with the images: a resampled pixel is
+valid only if all the input pixels it is interpolated from are valid.
+
+Besides bilinear, interpolate and warp take the kernels 'nearest',
+'linear', 'cubic' (Keys, a=-0.5) and 'lanczos3'.  Their weights are
+tabulated at phases fractional positions per pixel, so sampling looks
+the weights up instead of evaluating the kernel.  A transform that only
+scales and translates is done in two separable passes, one along the
+rows and one along the columns, whose weights depend on the transform
+and sizes alone and are cached.  Scaling down widens the kernel by the
+scale so the result is not aliased.  The validity of these kernels is
+taken from the 2x2 pixels around each sample, as for bilinear, and
+cubic and lanczos3 can overshoot the input range.  Images may have a
+last axis of channels, which share the weights.'''
+
+import numpy
+
+phases = 64          # tabulated fractional positions per pixel
+max_cached = 8       # transforms whose weights are kept
+_weight_tables = {}  # kernel name: (phases+1,taps) weights
+_cache = []          # (key,weights) pairs, most recently used last
+
+def grid(shape):
+    '''x and y coordinates of every pixel of an array of the given shape.'''
+    h,w = shape[:2]
+    y,x = numpy.mgrid[0:h,0:w]
+    return x.astype(numpy.float64),y.astype(numpy.float64)
+
+def affine_coordinates(shape,matrix):
+    '''Input coordinates of each output pixel for an affine matrix.'''
+    x,y = grid(shape)
+    m = numpy.asarray(matrix,dtype=numpy.float64)
+    return (m[0,0]*x + m[0,1]*y + m[0,2],
+            m[1,0]*x + m[1,1]*y + m[1,2])
+
+def bilinear(image,xs,ys,valid=None):
+    '''Sample a 2-D image at (xs,ys) with bilinear interpolation.
+
+       Returns (values,inside) where inside flags the samples which
+       fall within the image and, if valid is given, only need valid
+       input pixels.  Values outside are 0.'''
+    image = numpy.asarray(image,dtype=numpy.float64)
+    h,w = image.shape
+    inside = (xs >= 0.0) & (xs <= w-1.0) & (ys >= 0.0) & (ys <= h-1.0)
+    x0 = numpy.clip(numpy.floor(xs),0,max(w-2,0)).astype(numpy.intp)
+    y0 = numpy.clip(numpy.floor(ys),0,max(h-2,0)).astype(numpy.intp)
+    x1 = numpy.minimum(x0+1,w-1)
+    y1 = numpy.minimum(y0+1,h-1)
+    fx = numpy.clip(xs-x0,0.0,1.0)
+    fy = numpy.clip(ys-y0,0.0,1.0)
+    values = ((image[y0,x0]*(1.0-fx) + image[y0,x1]*fx)*(1.0-fy) +
+              (image[y1,x0]*(1.0-fx) + image[y1,x1]*fx)*fy)
+    if valid is not None:
+        valid = numpy.asarray(valid,dtype=bool)
+        inside &= valid[y0,x0] & valid[y0,x1] & valid[y1,x0] & valid[y1,x1]
+    values[~inside] = 0.0
+    return values,inside
+
+def affine(image,matrix,shape=None,valid=None):
+    '''Resample an image with an affine matrix (output to input coordinates).'''
+    if shape is None: shape = numpy.shape(image)
+    xs,ys = affine_coordinates(shape,matrix)
+    return bilinear(image,xs,ys,valid)
+
+def smooth(image):
+    '''Smooth with the separable [1,2,1]/4 kernel, replicating the edges.'''
+    image = numpy.asarray(image,dtype=numpy.float64)
+    p = numpy.pad(image,1,mode='edge')
+    rows = 0.25*p[:-2,:] + 0.5*p[1:-1,:] + 0.25*p[2:,:]
+    return 0.25*rows[:,:-2] + 0.5*rows[:,1:-1] + 0.25*rows[:,2:]
+
+def downsample(image,valid=None):
+    '''Halve an image by averaging 2x2 blocks (an odd last row/column is dropped).
+
+       A block is valid only if all its pixels are.  Pixel X of the
+       result is centered on pixel 2X+0.5 of the input.'''
+    image = numpy.asarray(image,dtype=numpy.float64)
+    h,w = image.shape
+    h2 = h//2 ; w2 = w//2
+    blocks = image[:2*h2,:2*w2].reshape(h2,2,w2,2)
+    small = blocks.mean(axis=3).mean(axis=1)
+    if valid is None: return small,None
+    vblocks = numpy.asarray(valid,dtype=bool)[:2*h2,:2*w2].reshape(h2,2,w2,2)
+    return small,vblocks.all(axis=3).all(axis=1)
+
+def pyramid_levels(shape,min_size=16,max_levels=5):
+    '''Number of pyramid levels for an image, finest level included.'''
+    levels = 1
+    size = min(shape[:2])
+    while levels < max_levels and size//2 >= min_size:
+        size = size//2
+        levels += 1
+    return levels
+
+def pyramid(image,valid=None,levels=None,min_size=16):
+    '''List of (image,valid) pairs, finest first.'''
+    if levels is None: levels = pyramid_levels(numpy.shape(image),min_size)
+    result = [(numpy.asarray(image,dtype=numpy.float64),valid)]
+    for level in range(1,levels):
+        result.append(downsample(*result[-1]))
+    return result
+
+def level_scale(level):
+    '''Matrix taking level 0 coordinates to pyramid level coordinates.'''
+    s = 0.5**level
+    return numpy.array([[s,0.0,0.5*s-0.5],
+                        [0.0,s,0.5*s-0.5],
+                        [0.0,0.0,1.0]])
+
+def _nearest(d):
+    return ((d > -0.5) & (d <= 0.5)).astype(numpy.float64)
+
+def _linear(d):
+    return numpy.maximum(1.0-numpy.abs(d),0.0)
+
+def _cubic(d,a=-0.5):
+    d = numpy.abs(d)
+    return numpy.where(d <= 1.0,((a+2.0)*d - (a+3.0))*d*d + 1.0,
+                       numpy.where(d < 2.0,((a*d - 5.0*a)*d + 8.0*a)*d - 4.0*a,0.0))
+
+def _lanczos3(d):
+    return numpy.where(numpy.abs(d) < 3.0,numpy.sinc(d)*numpy.sinc(d/3.0),0.0)
+
+# name: (number of taps,kernel)
+kernels = {'nearest':(1,_nearest),
+           'linear':(2,_linear),
+           'cubic':(4,_cubic),
+           'lanczos3':(6,_lanczos3)}
+
+def weight_table(kernel):
+    '''The (phases+1,taps) weights of a kernel at fractional positions
+       0, 1/phases, ... 1, each row summing to 1.'''
+    if kernel not in _weight_tables:
+        taps,func = kernels[kernel]
+        f = numpy.arange(phases+1,dtype=numpy.float64)/phases
+        d = numpy.arange(taps)[numpy.newaxis,:] - (taps//2-1) - f[:,numpy.newaxis]
+        if taps == 1: d = numpy.zeros((phases+1,1))
+        w = func(d)
+        _weight_tables[kernel] = w/w.sum(axis=1)[:,numpy.newaxis]
+    return _weight_tables[kernel]
+
+def _taps(coords,size,kernel):
+    '''Indices and weights of the taps sampling coords along an axis of size.'''
+    taps = kernels[kernel][0]
+    if taps == 1:
+        index = numpy.clip(numpy.floor(coords+0.5),0,size-1).astype(numpy.intp)
+        return index[...,numpy.newaxis],numpy.ones(coords.shape+(1,))
+    base = numpy.floor(coords)
+    phase = numpy.round((coords-base)*phases).astype(numpy.intp)
+    index = base.astype(numpy.intp)[...,numpy.newaxis] + (numpy.arange(taps) - (taps//2-1))
+    return numpy.clip(index,0,size-1),weight_table(kernel)[phase]
+
+def _scaled_taps(n,scale,offset,size,kernel):
+    '''Indices and weights of the taps of output pixels 0..n-1 at
+       input coordinates scale*X+offset, with the kernel widened by
+       the scale when scaling down.'''
+    coords = scale*numpy.arange(n,dtype=numpy.float64) + offset
+    if scale <= 1.0 or kernel == 'nearest': return _taps(coords,size,kernel)
+    taps,func = kernels[kernel]
+    taps = int(numpy.ceil(taps*scale))
+    base = numpy.floor(coords)
+    index = base.astype(numpy.intp)[:,numpy.newaxis] + (numpy.arange(taps) - (taps//2-1))
+    w = func((index - coords[:,numpy.newaxis])/scale)
+    w /= numpy.maximum(w.sum(axis=1),1.e-12)[:,numpy.newaxis]
+    return numpy.clip(index,0,size-1),w
+
+def _cached(key,make):
+    for i,(k,value) in enumerate(_cache):
+        if k == key:
+            del _cache[i]
+            _cache.append((k,value))
+            return value
+    value = make()
+    del _cache[:max(len(_cache)-max_cached+1,0)]
+    _cache.append((key,value))
+    return value
+
+def _inside(xs,ys,shape,valid):
+    '''Samples within the image whose 2x2 neighbours are valid.'''
+    h,w = shape[:2]
+    inside = (xs >= 0.0) & (xs <= w-1.0) & (ys >= 0.0) & (ys <= h-1.0)
+    if valid is not None:
+        valid = numpy.asarray(valid,dtype=bool)
+        x0 = numpy.clip(numpy.floor(xs),0,max(w-2,0)).astype(numpy.intp)
+        y0 = numpy.clip(numpy.floor(ys),0,max(h-2,0)).astype(numpy.intp)
+        x1 = numpy.minimum(x0+1,w-1)
+        y1 = numpy.minimum(y0+1,h-1)
+        inside &= valid[y0,x0] & valid[y0,x1] & valid[y1,x0] & valid[y1,x1]
+    return inside
+
+def _gather(image,ix,wx,iy,wy):
+    '''Sum of the taps ix,iy (shape (...,taps)) weighted by wx*wy.'''
+    channels = image.shape[2:]
+    values = numpy.zeros(ix.shape[:-1]+channels)
+    extra = (numpy.newaxis,)*len(channels)
+    for j in range(iy.shape[-1]):
+        row = image[iy[...,j,numpy.newaxis],ix]          # (...,taps[,channels])
+        weights = (wx*wy[...,j,numpy.newaxis])[(Ellipsis,)+extra]
+        values += (row*weights).sum(axis=ix.ndim-1)
+    return values
+
+def interpolate(image,xs,ys,kernel='linear',valid=None):
+    '''Sample an image at (xs,ys) with a kernel.
+
+       Like bilinear, returns (values,inside) with values 0 outside.
+       The image may have a last axis of channels.'''
+    image = numpy.asarray(image,dtype=numpy.float64)
+    xs,ys = numpy.broadcast_arrays(numpy.asarray(xs,dtype=numpy.float64),
+                                   numpy.asarray(ys,dtype=numpy.float64))
+    h,w = image.shape[:2]
+    ix,wx = _taps(xs,w,kernel)
+    iy,wy = _taps(ys,h,kernel)
+    values = _gather(image,ix,wx,iy,wy)
+    inside = _inside(xs,ys,image.shape,valid)
+    values[~inside] = 0.0
+    return values,inside
+
+def is_scale_translate(matrix):
+    m = numpy.asarray(matrix,dtype=numpy.float64)
+    return m[0,1] == 0.0 and m[1,0] == 0.0 and m[2,0] == 0.0 and m[2,1] == 0.0 and \
+           m[2,2] == 1.0 and m[0,0] > 0.0 and m[1,1] > 0.0
+
+def scale(image,matrix,shape,kernel='linear',valid=None):
+    '''Resample with a scale and translate matrix in two separable passes.'''
+    image = numpy.asarray(image,dtype=numpy.float64)
+    m = numpy.asarray(matrix,dtype=numpy.float64)
+    h,w = image.shape[:2]
+    ny,nx = shape[:2]
+    ix,wx = _cached(('x',nx,m[0,0],m[0,2],w,kernel),
+                    lambda: _scaled_taps(nx,m[0,0],m[0,2],w,kernel))
+    iy,wy = _cached(('y',ny,m[1,1],m[1,2],h,kernel),
+                    lambda: _scaled_taps(ny,m[1,1],m[1,2],h,kernel))
+    extra = (numpy.newaxis,)*(image.ndim-2)
+    rows = (image[:,ix]*wx[(Ellipsis,)+extra]).sum(axis=2)          # (h,nx[,channels])
+    values = (rows[iy]*wy[(Ellipsis,numpy.newaxis)+extra]).sum(axis=1)   # (ny,nx[,channels])
+    xs = m[0,0]*numpy.arange(nx) + m[0,2]
+    ys = m[1,1]*numpy.arange(ny) + m[1,2]
+    inside = _inside(xs[numpy.newaxis,:],ys[:,numpy.newaxis],image.shape,valid)
+    values[~inside] = 0.0
+    return values,inside
+
+def warp(image,matrix,shape=None,kernel='linear',valid=None):
+    '''Resample an image with a matrix (output to input coordinates) and a kernel.
+
+       Scale and translate matrices go through scale.  For the others
+       the taps and weights of every output pixel are cached by matrix,
+       so the channels or repeated warps of an image share them.'''
+    image = numpy.asarray(image,dtype=numpy.float64)
+    if shape is None: shape = image.shape
+    if is_scale_translate(matrix): return scale(image,matrix,shape,kernel,valid)
+    m = numpy.asarray(matrix,dtype=numpy.float64)
+    h,w = image.shape[:2]
+    def make():
+        x,y = grid(shape)
+        d = m[2,0]*x + m[2,1]*y + m[2,2]
+        xs = (m[0,0]*x + m[0,1]*y + m[0,2])/d
+        ys = (m[1,0]*x + m[1,1]*y + m[1,2])/d
+        return _taps(xs,w,kernel) + _taps(ys,h,kernel) + (xs,ys)
+    ix,wx,iy,wy,xs,ys = _cached(('warp',m.tobytes(),tuple(shape[:2]),(h,w),kernel),make)
+    values = _gather(image,ix,wx,iy,wy)
+    inside = _inside(xs,ys,image.shape,valid)
+    values[~inside] = 0.0
+    return values,inside
@@ -0,0 +1,228 @@
+'''Rig templates: a solved stitch saved as remap grids.
+
+A fixed camera rig takes every image set from the same place, so the
+transform, the distortion corrections, the panorama size and the blend
+masks are the same for every set.  A template records them once from a
+solved stitch and stitches new image sets by table lookup alone.
+
+Each layer of the panorama is stored as its place on the canvas, an
+affine map from canvas to source image coordinates and the remainder of
+the (non-linear) map on a coarse grid of nodes step pixels apart, as
+float16 offsets from the affine map.  The remainder is the distortion
+correction (and projection), mostly within a hundred pixels, which
+float16 keeps to within 1/32 pixel.  Each layer records the largest
+error of its grid, measured between the nodes.  The full resolution
+map is the affine map plus the bilinear interpolation of the grid,
+made a strip of rows at a time.  The blend mask of each layer is
+stored as is (uint8).
+
+Templates are saved as compressed numpy .npz files.  Source coordinates
+are array indices as in resample, and transforms here are 3x3 matrices
+on column vectors.'''
+
+import json
+import math
+import numpy
+
+from gimplib import resample
+
+step = 16             # default grid spacing in pixels
+strip_rows = 64       # output rows remapped at a time
+version = 1
+
+
+def grid_nodes(size,step):
+    '''Node positions along an axis of size pixels (the last one at or past the end).'''
+    n = int(math.ceil((size-1)/float(step))) + 1 if size > 1 else 1
+    return numpy.arange(n,dtype=numpy.float64)*step
+
+def _fit_affine(xs,ys,sx,sy):
+    '''Least squares affine matrix taking (xs,ys) to (sx,sy).'''
+    a = numpy.column_stack((xs.ravel(),ys.ravel(),numpy.ones(xs.size)))
+    fit = numpy.linalg.lstsq(a,numpy.column_stack((sx.ravel(),sy.ravel())),rcond=None)[0]
+    return numpy.vstack((fit.T,[0.0,0.0,1.0]))
+
+def _interpolate(grid,gx,gy):
+    '''Bilinear interpolation of a (gh,gw,2) grid at node coordinates gx,gy.'''
+    gh,gw = grid.shape[:2]
+    ix = numpy.clip(numpy.floor(gx).astype(numpy.intp),0,max(gw-2,0))
+    iy = numpy.clip(numpy.floor(gy).astype(numpy.intp),0,max(gh-2,0))
+    ix1 = numpy.minimum(ix+1,gw-1) ; iy1 = numpy.minimum(iy+1,gh-1)
+    fx = (gx-ix)[...,numpy.newaxis] ; fy = (gy-iy)[...,numpy.newaxis]
+    g = grid.astype(numpy.float64)
+    return (g[iy,ix]*(1.0-fx) + g[iy,ix1]*fx)*(1.0-fy) + (g[iy1,ix]*(1.0-fx) + g[iy1,ix1]*fx)*fy
+
+class layer(object):
+    '''One layer of a rig template.
+
+       box is (x,y,width,height) of the layer on the canvas, source_shape
+       the (height,width) of the images stitched into it, affine the 3x3
+       canvas to source map relative to the box corner, offsets the
+       (gh,gw,2) float16 grid and mask the (height,width) uint8 blend
+       mask or None.'''
+    def __init__(self,name,box,source_shape,affine,offsets,step,mask=None,error=None):
+        self.name = name
+        self.box = tuple([int(v) for v in box])
+        self.source_shape = tuple([int(v) for v in source_shape[:2]])
+        self.affine = numpy.asarray(affine,dtype=numpy.float64)
+        self.offsets = numpy.asarray(offsets,dtype=numpy.float16)
+        self.step = int(step)
+        self.mask = mask
+        self.error = error          # largest map error between the nodes (pixels)
+    def coordinates(self,y0=0,y1=None):
+        '''Source coordinates (xs,ys) of the layer rows y0:y1.'''
+        width,height = self.box[2:]
+        if y1 is None: y1 = height
+        x = numpy.arange(width,dtype=numpy.float64)[numpy.newaxis,:]
+        y = numpy.arange(y0,y1,dtype=numpy.float64)[:,numpy.newaxis]
+        m = self.affine
+        remainder = _interpolate(self.offsets,x/self.step,y/self.step)
+        return (m[0,0]*x + m[0,1]*y + m[0,2] + remainder[...,0],
+                m[1,0]*x + m[1,1]*y + m[1,2] + remainder[...,1])
+    def render(self,pixels,kernel='linear'):
+        '''Remap an (h,w,bpp) uint8 source image into the layer.
+
+           Returns an (height,width,ncolor+1) uint8 array whose alpha is
+           the source alpha (or coverage) times the blend mask.  kernel is
+           a resample kernel name.'''
+        pixels = numpy.asarray(pixels)
+        if pixels.ndim == 2: pixels = pixels[:,:,numpy.newaxis]
+        if pixels.shape[:2] != self.source_shape:
+            raise ValueError('layer %s needs a %dx%d image, not %dx%d' %
+                             (self.name,self.source_shape[1],self.source_shape[0],
+                              pixels.shape[1],pixels.shape[0]))
+        h,w,bpp = pixels.shape
+        alpha = bpp in (2,4)
+        ncolor = bpp-1 if alpha else bpp
+        width,height = self.box[2:]
+        out = numpy.zeros((height,width,ncolor+1),dtype=numpy.uint8)
+        for y0 in range(0,height,strip_rows):
+            y1 = min(y0+strip_rows,height)
+            xs,ys = self.coordinates(y0,y1)
+            values,inside = resample.interpolate(pixels,xs,ys,kernel)
+            out[y0:y1,:,:ncolor] = numpy.clip(numpy.round(values[...,:ncolor]),0,255)
+            if alpha:
+                a = numpy.clip(values[...,-1],0.0,255.0)
+            else:
+                a = numpy.where(inside,255.0,0.0)
+            if self.mask is not None:
+                a = a*self.mask[y0:y1]/255.0
+            out[y0:y1,:,-1] = numpy.round(a)
+        return out
+
+def capture_layer(name,box,source_shape,mapping,mask=None,step=step):
+    '''Make a template layer from a mapping of canvas to source coordinates.
+
+       mapping(xs,ys) takes arrays of canvas coordinates to source
+       coordinates.  It is evaluated on the grid nodes and, to measure
+       the error of the grid, between them.'''
+    x0,y0,width,height = box
+    nx = grid_nodes(width,step) ; ny = grid_nodes(height,step)
+    gx,gy = numpy.meshgrid(nx,ny)
+    sx,sy = mapping(gx+x0,gy+y0)
+    sx = numpy.asarray(sx,dtype=numpy.float64) ; sy = numpy.asarray(sy,dtype=numpy.float64)
+    affine = _fit_affine(gx,gy,sx,sy)
+    offsets = numpy.empty(gx.shape+(2,))
+    offsets[...,0] = sx - (affine[0,0]*gx + affine[0,1]*gy + affine[0,2])
+    offsets[...,1] = sy - (affine[1,0]*gx + affine[1,1]*gy + affine[1,2])
+    if mask is not None:
+        mask = numpy.asarray(mask,dtype=numpy.uint8).reshape(height,width)
+    result = layer(name,box,source_shape,affine,offsets,step,mask)
+    # the error at the cell centers, where interpolation is worst
+    cx = numpy.minimum(nx[:-1]+step/2.0,width-1) if len(nx) > 1 else nx
+    cy = numpy.minimum(ny[:-1]+step/2.0,height-1) if len(ny) > 1 else ny
+    cx,cy = numpy.meshgrid(cx,cy)
+    ex,ey = mapping(cx+x0,cy+y0)
+    m = affine
+    remainder = _interpolate(result.offsets,cx/step,cy/step)
+    px = m[0,0]*cx + m[0,1]*cy + m[0,2] + remainder[...,0]
+    py = m[1,0]*cx + m[1,1]*cy + m[1,2] + remainder[...,1]
+    result.error = float(numpy.hypot(px-ex,py-ey).max())
+    return result
+
+class template(object):
+    '''The layers (bottom first) of a stitched panorama of width x height.'''
+    def __init__(self,width,height,layers=None,info=None):
+        self.width = int(width)
+        self.height = int(height)
+        self.layers = layers or []
+        self.info = info or {}       # anything else worth keeping (e.g. the transform)
+    def add(self,layer):
+        self.layers.append(layer)
+    def render(self,images,kernel='linear'):
+        '''Remap one source image per layer.  Returns a list of (box,pixels).'''
+        if len(images) != len(self.layers):
+            raise ValueError('the template needs %d images, not %d' %
+                             (len(self.layers),len(images)))
+        return [(l.box,l.render(image,kernel)) for l,image in zip(self.layers,images)]
+    def composite(self,images,kernel='linear'):
+        '''Remap and composite the images onto the canvas (alpha over, bottom first).'''
+        result = None
+        for (x,y,width,height),pixels in self.render(images,kernel):
+            if result is None:
+                result = numpy.zeros((self.height,self.width,pixels.shape[2]),dtype=numpy.float64)
+            target = result[y:y+height,x:x+width]
+            a = pixels[...,-1:]/255.0
+            target[...,:-1] = pixels[...,:-1]*a + target[...,:-1]*(1.0-a)
+            target[...,-1:] = 255.0*a + target[...,-1:]*(1.0-a)
+        return numpy.round(result).astype(numpy.uint8)
+    def save(self,filename):
+        header = {'version':version,'width':self.width,'height':self.height,
+                  'info':self.info,'layers':[]}
+        arrays = {}
+        for i,l in enumerate(self.layers):
+            header['layers'].append({'name':l.name,'box':list(l.box),
+                                     'source_shape':list(l.source_shape),
+                                     'affine':l.affine.tolist(),'step':l.step,
+                                     'error':l.error,'mask':l.mask is not None})
+            arrays['offsets%d' % i] = l.offsets
+            if l.mask is not None: arrays['mask%d' % i] = l.mask
+        arrays['header'] = numpy.frombuffer(json.dumps(header).encode('utf-8'),dtype=numpy.uint8)
+        f = open(filename,'wb')
+        try:
+            numpy.savez_compressed(f,**arrays)
+        finally:
+            f.close()
+
+def load(filename):
+    '''Read a template saved by template.save.'''
+    data = numpy.load(filename)
+    try:
+        header = json.loads(data['header'].tobytes().decode('utf-8'))
+        if header.get('version') != version:
+            raise ValueError('%s: unknown rig template version %r' % (filename,header.get('version')))
+        result = template(header['width'],header['height'],info=header['info'])
+        for i,d in enumerate(header['layers']):
+            mask = data['mask%d' % i] if d['mask'] else None
+            result.add(layer(str(d['name']),d['box'],d['source_shape'],d['affine'],
+                             data['offsets%d' % i],d['step'],mask,d['error']))
+    finally:
+        data.close()
+    return result
+
+def triangle_offsets(xs,ys,triangles,vertices,targets):
+    '''Piecewise linear map of points by a triangulation.
+
+       triangles are index triples into vertices (n,2), and targets
+       (n,2) are where the vertices go.  Returns the offsets (dx,dy)
+       which take (xs,ys) to their place in the mapped triangle, 0
+       outside all triangles.'''
+    xs = numpy.asarray(xs,dtype=numpy.float64)
+    ys = numpy.asarray(ys,dtype=numpy.float64)
+    vertices = numpy.asarray(vertices,dtype=numpy.float64)
+    shift = numpy.asarray(targets,dtype=numpy.float64) - vertices
+    dx = numpy.zeros(xs.shape) ; dy = numpy.zeros(xs.shape)
+    done = numpy.zeros(xs.shape,dtype=bool)
+    for i0,i1,i2 in triangles:
+        (x0,y0),(x1,y1),(x2,y2) = vertices[i0],vertices[i1],vertices[i2]
+        det = (y1-y2)*(x0-x2) + (x2-x1)*(y0-y2)
+        if not det: continue
+        l0 = ((y1-y2)*(xs-x2) + (x2-x1)*(ys-y2))/det
+        l1 = ((y2-y0)*(xs-x2) + (x0-x2)*(ys-y2))/det
+        l2 = 1.0 - l0 - l1
+        inside = (l0 >= -1.e-9) & (l1 >= -1.e-9) & (l2 >= -1.e-9) & ~done
+        if not inside.any(): continue
+        dx[inside] = (l0*shift[i0,0] + l1*shift[i1,0] + l2*shift[i2,0])[inside]
+        dy[inside] = (l0*shift[i0,1] + l1*shift[i1,1] + l2*shift[i2,1])[inside]
+        done |= inside
+    return dx,dy
@@ -0,0 +1,48 @@
+'''A pool of scratch arrays for image patches.
+
+Correlating control points needs a few patch sized arrays per point.
+Instead of allocating new arrays every time, buffer_pool hands out
+views of preallocated blocks.  Blocks come in size classes (two per
+octave, at least min_size), so patches of similar sizes share blocks,
+and they are kept for reuse when released.'''
+
+import numpy
+
+min_size = 32
+
+
+def size_class(n):
+    '''The smallest size class holding n: 32, 48, 64, 96, 128, 192, ...'''
+    size = min_size
+    while size < n:
+        if size*3//2 >= n: return size*3//2
+        size *= 2
+    return size
+
+class buffer_pool(object):
+    '''Hands out arrays of any shape as views of reusable blocks.'''
+    def __init__(self,max_free=4):
+        self.max_free = max_free    # blocks kept per size class and type
+        self.free = {}              # key -> list of free blocks
+        self.used = {}              # id of view -> (key,block)
+    def acquire(self,shape,dtype=numpy.float64):
+        '''Get an uninitialized array of the given shape and type.'''
+        dtype = numpy.dtype(dtype)
+        key = (tuple([size_class(n) for n in shape]),dtype.str)
+        blocks = self.free.get(key)
+        if blocks:
+            block = blocks.pop()
+        else:
+            block = numpy.empty(key[0],dtype=dtype)
+        view = block[tuple([slice(0,n) for n in shape])]
+        self.used[id(view)] = (key,block,view)
+        return view
+    def release(self,view):
+        '''Give an array from acquire back to the pool.'''
+        key,block,view = self.used.pop(id(view))
+        blocks = self.free.setdefault(key,[])
+        if len(blocks) < self.max_free:
+            blocks.append(block)
+    def clear(self):
+        '''Drop all the free blocks.'''
+        self.free = {}
@@ -0,0 +1,179 @@
+'''Stand-ins for gimp drawables, for trying out code outside of gimp.
+
+drawable holds its pixels in a bytearray and hands out pixel_region
+objects which behave like gimp pixel regions: indexing with [x,y] gets
+or sets one pixel and slices [x0:x1,y0:y1] get or set a rectangle as a
+string of rows, in drawable coordinates.  image and pdb stand in for a
+gimp image and the few PDB procedures the array code calls, and
+install_modules lets a plug-in file be imported outside of gimp (e.g.
+by the benchmarks).  Nothing here needs numpy or gimp.'''
+
+
+class pixel_region(object):
+    '''A rectangle of a stub drawable.'''
+    def __init__(self,drawable,x,y,w,h,dirty,shadow):
+        self.drawable = drawable
+        self.x = x ; self.y = y ; self.w = w ; self.h = h
+        self.bpp = drawable.bpp
+        self.dirty = dirty
+        self.shadow = shadow
+    def _span(self,index,start,size):
+        if isinstance(index,slice):
+            i0 = start if index.start is None else index.start
+            i1 = start+size if index.stop is None else index.stop
+        else:
+            i0 = index ; i1 = index+1
+        if i0 < start or i1 > start+size or i1 <= i0:
+            raise IndexError('index out of range of the pixel region')
+        return i0,i1
+    def __getitem__(self,key):
+        x0,x1 = self._span(key[0],self.x,self.w)
+        y0,y1 = self._span(key[1],self.y,self.h)
+        d = self.drawable
+        rows = [d.data[(y*d.width+x0)*d.bpp:(y*d.width+x1)*d.bpp] for y in range(y0,y1)]
+        return bytes(bytearray().join(rows))
+    def __setitem__(self,key,value):
+        x0,x1 = self._span(key[0],self.x,self.w)
+        y0,y1 = self._span(key[1],self.y,self.h)
+        d = self.drawable
+        rowsize = (x1-x0)*d.bpp
+        if len(value) != rowsize*(y1-y0):
+            raise ValueError('wrong size of pixel data')
+        value = bytearray(value)
+        for y in range(y0,y1):
+            start = (y*d.width+x0)*d.bpp
+            d.data[start:start+rowsize] = value[(y-y0)*rowsize:(y-y0+1)*rowsize]
+
+class drawable(object):
+    '''A stub drawable (layer, mask or channel) of width x height x bpp.'''
+    def __init__(self,width,height,bpp,data=None,offsets=(0,0),name='stub'):
+        self.width = width
+        self.height = height
+        self.bpp = bpp
+        self.offsets = offsets
+        self.name = name
+        if data is None:
+            data = bytearray(width*height*bpp)
+        self.data = bytearray(data)
+        if len(self.data) != width*height*bpp:
+            raise ValueError('wrong size of pixel data')
+        self.updates = 0
+    def get_pixel_rgn(self,x,y,w,h,dirty=True,shadow=False):
+        return pixel_region(self,x,y,w,h,dirty,shadow)
+    def flush(self):
+        pass
+    def update(self,x,y,w,h):
+        self.updates += 1
+
+class image(object):
+    '''A stub image with a list of layers and a rectangular selection.'''
+    _next_id = 1
+    def __init__(self,width,height,base_type=0,name='stub'):
+        self.width = width
+        self.height = height
+        self.base_type = base_type
+        self.name = name
+        self.ID = image._next_id
+        image._next_id += 1
+        self.layers = []
+        self.selection = None          # (x1,y1,x2,y2) or None
+    def select_rectangle(self,x,y,w,h):
+        self.selection = (x,y,x+w,y+h)
+    def select_none(self):
+        self.selection = None
+
+class pdb(object):
+    '''The few PDB procedures which are needed outside of gimp.
+
+       Other procedures raise AttributeError, so code which needs the
+       real gimp core fails loudly.'''
+    def __init__(self):
+        self.messages = []
+    def gimp_image_new(self,width,height,base_type):
+        return image(width,height,base_type)
+    def gimp_image_delete(self,img):
+        img.layers = []
+    def gimp_image_undo_disable(self,img):
+        pass
+    def gimp_image_undo_enable(self,img):
+        pass
+    def gimp_layer_new(self,img,width,height,layer_type,name,opacity,mode):
+        bpp = {0:3,1:4,2:1,3:2,4:1,5:2}[layer_type]   # the gimp image types
+        return drawable(width,height,bpp,name=name)
+    def gimp_image_add_layer(self,img,layer,position):
+        img.layers.insert(max(position,0),layer)
+    def gimp_layer_set_offsets(self,layer,x,y):
+        layer.offsets = (x,y)
+    def gimp_selection_bounds(self,img):
+        if img.selection is None: return (0,0,0,img.width,img.height)
+        return (1,) + tuple(img.selection)
+    def gimp_selection_none(self,img):
+        img.select_none()
+    def gimp_displays_flush(self):
+        pass
+    def gimp_display_new(self,img):
+        return None
+    def gimp_message(self,message):
+        self.messages.append(message)
+
+# enum values as in gimpenums of gimp 2.8, for the names the plug-ins use
+enums = {'TRUE':1,'FALSE':0,
+         'RUN_INTERACTIVE':0,'RUN_NONINTERACTIVE':1,'RUN_WITH_LAST_VALS':2,
+         'RGB':0,'GRAY':1,'INDEXED':2,
+         'RGB_IMAGE':0,'RGBA_IMAGE':1,'GRAY_IMAGE':2,'GRAYA_IMAGE':3,
+         'NORMAL_MODE':0,'MULTIPLY_MODE':3,'SCREEN_MODE':4,
+         'INTERPOLATION_NONE':0,'INTERPOLATION_LINEAR':1,'INTERPOLATION_CUBIC':2,'INTERPOLATION_LANCZOS':3,
+         'TRANSFORM_FORWARD':0,'TRANSFORM_BACKWARD':1,
+         'CHANNEL_OP_ADD':0,'CHANNEL_OP_SUBTRACT':1,'CHANNEL_OP_REPLACE':2,
+         'CHANNEL_OP_INTERSECT':3,
+         'ADD_SELECTION_MASK':4,
+         'FOREGROUND_FILL':0,'BACKGROUND_FILL':1,'WHITE_FILL':2,'TRANSPARENT_FILL':3,
+         'FG_BUCKET_FILL':0,'BG_BUCKET_FILL':1,
+         'FG_BG_RGB_MODE':0,'GRADIENT_LINEAR':0,'REPEAT_NONE':0,
+         'HISTOGRAM_VALUE':0,'HISTOGRAM_RED':1,'HISTOGRAM_GREEN':2,'HISTOGRAM_BLUE':3,
+         'EXTENSION':2,'PDB_INT32':0}
+
+def install_modules(directory=None):
+    '''Put stub gimp, gimpplugin, gimpenums, pygtk and gtk modules into
+       sys.modules so a plug-in can be imported (not run) outside of
+       gimp.  Modules which can really be imported are left alone.
+       Returns the gimp module.'''
+    import sys
+    import tempfile
+    import types
+    def missing(name):
+        if name in sys.modules: return False
+        try:
+            __import__(name)
+            return False
+        except ImportError:
+            return True
+    if missing('gimp'):
+        gimp = types.ModuleType('gimp')
+        gimp.pdb = pdb()
+        gimp.directory = directory or tempfile.gettempdir()
+        gimp.image_list = lambda: []
+        gimp.install_procedure = lambda *args: None
+        sys.modules['gimp'] = gimp
+    if missing('gimpplugin'):
+        gimpplugin = types.ModuleType('gimpplugin')
+        class plugin(object):
+            def start(self):
+                pass
+        gimpplugin.plugin = plugin
+        sys.modules['gimpplugin'] = gimpplugin
+    if missing('gimpenums'):
+        gimpenums = types.ModuleType('gimpenums')
+        gimpenums.__dict__.update(enums)
+        sys.modules['gimpenums'] = gimpenums
+    if missing('pygtk'):
+        pygtk = types.ModuleType('pygtk')
+        pygtk.require = lambda version: None
+        sys.modules['pygtk'] = pygtk
+    if missing('gtk'):
+        gtk = types.ModuleType('gtk')
+        gtk.TRUE = 1
+        gtk.FALSE = 0
+        gtk.events_pending = lambda: False
+        sys.modules['gtk'] = gtk
+    return sys.modules['gimp']
@@ -0,0 +1,182 @@
+'''Streaming writer of tiled TIFF and BigTIFF files.
+
+A panorama can be far larger than the memory it would take to hold it
+as a gimp image.  tiled_tiff writes one tile at a time: each tile's
+data is appended to the file as soon as it is given, and only its file
+offset and size are kept.  close writes the image file directory (the
+tags and the tile offset and size tables) after the last tile and
+points the header at it, so tiles may come in any order and the whole
+image is never in memory.  Tiles never written are stored as a shared
+blank tile.
+
+Files larger than classic TIFF's 4 GB limit are written as BigTIFF
+(64 bit offsets), which bigtiff=None picks from the image size.  Tiles
+are 8 bit, chunky (interleaved samples), uncompressed or deflate
+compressed with zlib, with the last sample unassociated alpha when
+alpha is set.  Nothing here needs numpy: tile data is any object with
+tobytes() (a numpy array) or a byte string.'''
+
+import struct
+import zlib
+
+# tag numbers
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+SAMPLES_PER_PIXEL = 277
+PLANAR_CONFIGURATION = 284
+SOFTWARE = 305
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+EXTRA_SAMPLES = 338
+
+# field types: (code,struct format,size)
+ASCII = (2,'s',1)
+SHORT = (3,'H',2)
+LONG = (4,'I',4)
+LONG8 = (16,'Q',8)
+
+compressions = {'none':1,'deflate':8}
+classic_limit = 2**32 - 2**26     # bytes, leaving room for the directory
+
+
+def _tobytes(data):
+    if hasattr(data,'tobytes'): return data.tobytes()
+    return bytes(data)
+
+class tiled_tiff(object):
+    '''A tiled TIFF file being written.
+
+       samples is the number of 8 bit samples per pixel (1 or 2 gray,
+       3 or 4 RGB, the even ones with alpha).  tile is the tile width
+       and height, a multiple of 16.'''
+    def __init__(self,filename,width,height,samples,tile=256,compression='none',
+                 bigtiff=None,software='stitch panorama'):
+        if tile % 16: raise ValueError('the tile size must be a multiple of 16')
+        if samples not in (1,2,3,4): raise ValueError('need 1 to 4 samples per pixel')
+        self.width = int(width)
+        self.height = int(height)
+        self.samples = samples
+        self.tile = tile
+        self.compression = compression
+        self.software = software
+        self.tiles_across = (self.width + tile - 1)//tile
+        self.tiles_down = (self.height + tile - 1)//tile
+        self.tile_bytes = tile*tile*samples
+        if bigtiff is None:
+            bigtiff = self.tiles_across*self.tiles_down*self.tile_bytes > classic_limit
+        self.bigtiff = bigtiff
+        self.offsets = [0]*(self.tiles_across*self.tiles_down)
+        self.byte_counts = [0]*(self.tiles_across*self.tiles_down)
+        self.file = open(filename,'wb')
+        if bigtiff:
+            self.file.write(b'II' + struct.pack('<HHHQ',43,8,0,0))
+        else:
+            self.file.write(b'II' + struct.pack('<HI',42,0))
+        self.position = self.file.tell()
+    def __enter__(self):
+        return self
+    def __exit__(self,*exc):
+        if exc[0] is None: self.close()
+        else: self.file.close()
+        return False
+    def _append(self,data):
+        if self.position % 2:        # word align (TIFF offsets should be even)
+            self.file.write(b'\0')
+            self.position += 1
+        offset = self.position
+        self.file.write(data)
+        self.position += len(data)
+        return offset
+    def _encode(self,data):
+        if self.compression == 'deflate': return zlib.compress(data,6)
+        return data
+    def write_tile(self,column,row,data):
+        '''Write the tile at column,row (in tiles) from tile x tile x samples bytes.
+
+           Edge tiles are padded: give the full tile size, with anything
+           beyond the image size ignored by readers.'''
+        data = _tobytes(data)
+        if len(data) != self.tile_bytes:
+            raise ValueError('a tile has %d bytes, not %d' % (len(data),self.tile_bytes))
+        index = row*self.tiles_across + column
+        data = self._encode(data)
+        self.offsets[index] = self._append(data)
+        self.byte_counts[index] = len(data)
+    def tile_box(self,column,row):
+        '''The (x0,y0,x1,y1) image pixels of a tile (clipped to the image).'''
+        x0 = column*self.tile ; y0 = row*self.tile
+        return x0,y0,min(x0+self.tile,self.width),min(y0+self.tile,self.height)
+    def tiles(self):
+        '''(column,row) of every tile, row by row.'''
+        return [(c,r) for r in range(self.tiles_down) for c in range(self.tiles_across)]
+    def close(self):
+        '''Write the blank tile for missing tiles and the directory.'''
+        if self.file.closed: return
+        missing = [i for i,count in enumerate(self.byte_counts) if not count]
+        if missing:
+            data = self._encode(b'\0'*self.tile_bytes)
+            offset = self._append(data)
+            for i in missing:
+                self.offsets[i] = offset
+                self.byte_counts[i] = len(data)
+        offset_type = LONG8 if self.bigtiff else LONG
+        photometric = 2 if self.samples >= 3 else 1
+        tags = [(IMAGE_WIDTH,LONG,[self.width]),
+                (IMAGE_LENGTH,LONG,[self.height]),
+                (BITS_PER_SAMPLE,SHORT,[8]*self.samples),
+                (COMPRESSION,SHORT,[compressions[self.compression]]),
+                (PHOTOMETRIC,SHORT,[photometric]),
+                (SAMPLES_PER_PIXEL,SHORT,[self.samples]),
+                (PLANAR_CONFIGURATION,SHORT,[1]),
+                (SOFTWARE,ASCII,self.software.encode('ascii') + b'\0'),
+                (TILE_WIDTH,LONG,[self.tile]),
+                (TILE_LENGTH,LONG,[self.tile]),
+                (TILE_OFFSETS,offset_type,self.offsets),
+                (TILE_BYTE_COUNTS,offset_type if self.bigtiff else LONG,self.byte_counts)]
+        if self.samples in (2,4):
+            tags.append((EXTRA_SAMPLES,SHORT,[2]))     # unassociated alpha
+        self._write_directory(sorted(tags,key=lambda t: t[0]))
+        self.file.close()
+    def _pack(self,field_type,values):
+        code,fmt,size = field_type
+        if field_type is ASCII: return values
+        return struct.pack('<%d%s' % (len(values),fmt),*values)
+    def _write_directory(self,tags):
+        # values too long to sit in an entry go before the directory
+        inline = 8 if self.bigtiff else 4
+        entries = []
+        for tag,field_type,values in tags:
+            data = self._pack(field_type,values)
+            if len(data) > inline:
+                entries.append((tag,field_type[0],len(values),self._append(data),None))
+            else:
+                entries.append((tag,field_type[0],len(values),None,data.ljust(inline,b'\0')))
+        if self.position % 2:
+            self.file.write(b'\0')
+            self.position += 1
+        directory = self.position
+        if self.bigtiff:
+            parts = [struct.pack('<Q',len(entries))]
+            for tag,code,count,offset,data in entries:
+                parts.append(struct.pack('<HHQ',tag,code,count))
+                parts.append(data if offset is None else struct.pack('<Q',offset))
+            parts.append(struct.pack('<Q',0))
+        else:
+            parts = [struct.pack('<H',len(entries))]
+            for tag,code,count,offset,data in entries:
+                parts.append(struct.pack('<HHI',tag,code,count))
+                parts.append(data if offset is None else struct.pack('<I',offset))
+            parts.append(struct.pack('<I',0))
+        self.file.write(b''.join(parts))
+        # point the header at the directory
+        if self.bigtiff:
+            self.file.seek(8)
+            self.file.write(struct.pack('<Q',directory))
+        else:
+            self.file.seek(4)
+            self.file.write(struct.pack('<I',directory))
@@ -0,0 +1,167 @@
+'''Images kept on disk in tiles, with the recently used tiles in memory.
+
+A store holds an (h,w,channels) image in a numpy.memmap file in a
+scratch directory, laid out tile by tile so that every tile is one
+contiguous block of the file.  Reads and writes of any rectangle go
+through a least recently used cache of tiles in memory, which holds
+at most ram_budget bytes; a tile changed in the cache is written back
+to the file when it is dropped from the cache or the store is flushed.
+So stages working on a panorama larger than memory can read it at
+random while only the tiles they touch are in memory.
+
+The scratch files are removed by close (a store is also a context
+manager) and, for stores never closed, when python exits.'''
+
+import atexit
+import math
+import os
+import shutil
+import tempfile
+
+from collections import OrderedDict
+
+import numpy
+
+from gimplib import pixelio
+
+tile_size = 256                  # tile width and height in pixels
+ram_budget = 256*2**20           # default bytes of tiles kept in memory
+_open = set()                    # scratch directories of stores not closed
+
+
+class store(object):
+    '''An (height,width,channels) image of dtype in tiles on disk.
+
+       directory is where the scratch directory is made (default the
+       system temporary directory).  The image starts out zero.'''
+    def __init__(self,height,width,channels=1,dtype=numpy.uint8,tile=tile_size,
+                 ram_budget=ram_budget,directory=None):
+        self.height = int(height)
+        self.width = int(width)
+        self.channels = int(channels)
+        self.dtype = numpy.dtype(dtype)
+        self.tile = int(tile)
+        self.tiles_down = int(math.ceil(self.height/float(self.tile)))
+        self.tiles_across = int(math.ceil(self.width/float(self.tile)))
+        tile_bytes = self.tile*self.tile*self.channels*self.dtype.itemsize
+        self.max_tiles = max(int(ram_budget//tile_bytes),1)
+        self.directory = tempfile.mkdtemp(prefix='stitch-tiles-',dir=directory)
+        _open.add(self.directory)
+        self.filename = os.path.join(self.directory,'tiles.dat')
+        self.data = numpy.memmap(self.filename,dtype=self.dtype,mode='w+',
+                                 shape=(max(self.tiles_down,1),max(self.tiles_across,1),
+                                        self.tile,self.tile,self.channels))
+        self.cache = OrderedDict()   # (row,column) -> tile, most recently used last
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    @property
+    def shape(self):
+        return (self.height,self.width,self.channels)
+    def __enter__(self):
+        return self
+    def __exit__(self,*exc):
+        self.close()
+        return False
+    def get_tile(self,row,column):
+        '''The tile at row,column in the cache (a writable array).'''
+        key = (row,column)
+        tile = self.cache.pop(key,None)
+        if tile is None:
+            self.misses += 1
+            tile = numpy.array(self.data[row,column])
+            while len(self.cache) >= self.max_tiles: self._evict()
+        else:
+            self.hits += 1
+        self.cache[key] = tile
+        return tile
+    def _evict(self):
+        key,tile = self.cache.popitem(last=False)
+        self.evictions += 1
+        if key in self.dirty:
+            self.data[key] = tile
+            self.dirty.discard(key)
+    def _tiles(self,x,y,w,h):
+        '''(row,column,tile window,rectangle window) of the tiles a rectangle touches.'''
+        t = self.tile
+        for row in range(y//t,(y+h-1)//t+1):
+            ty0 = max(y,row*t) ; ty1 = min(y+h,(row+1)*t)
+            for column in range(x//t,(x+w-1)//t+1):
+                tx0 = max(x,column*t) ; tx1 = min(x+w,(column+1)*t)
+                yield (row,column,
+                       (slice(ty0-row*t,ty1-row*t),slice(tx0-column*t,tx1-column*t)),
+                       (slice(ty0-y,ty1-y),slice(tx0-x,tx1-x)))
+    def _check(self,x,y,w,h):
+        if x < 0 or y < 0 or w < 0 or h < 0 or x+w > self.width or y+h > self.height:
+            raise ValueError('rectangle %d,%d %dx%d is outside the %dx%d store' %
+                             (x,y,w,h,self.width,self.height))
+    def read(self,x=0,y=0,w=None,h=None):
+        '''A copy of a rectangle (default all) as an (h,w,channels) array.'''
+        if w is None: w = self.width - x
+        if h is None: h = self.height - y
+        self._check(x,y,w,h)
+        out = numpy.empty((h,w,self.channels),dtype=self.dtype)
+        if w and h:
+            for row,column,tile_window,window in self._tiles(x,y,w,h):
+                out[window] = self.get_tile(row,column)[tile_window]
+        return out
+    def write(self,array,x=0,y=0):
+        '''Put an (h,w,channels) or (h,w) array into the store at x,y.'''
+        array = numpy.asarray(array)
+        if array.ndim == 2: array = array[:,:,numpy.newaxis]
+        h,w = array.shape[:2]
+        self._check(x,y,w,h)
+        if not w or not h: return
+        for row,column,tile_window,window in self._tiles(x,y,w,h):
+            self.get_tile(row,column)[tile_window] = array[window]
+            self.dirty.add((row,column))
+    def __getitem__(self,key):
+        '''Read with array slices [y0:y1,x0:x1] (steps are not supported).'''
+        if not isinstance(key,tuple): key = (key,)
+        rows,columns = (tuple(key)+(slice(None),slice(None)))[:2]
+        y0,y1,ystep = rows.indices(self.height)
+        x0,x1,xstep = columns.indices(self.width)
+        if ystep != 1 or xstep != 1: raise ValueError('a store is read without steps')
+        return self.read(x0,y0,max(x1-x0,0),max(y1-y0,0))[(slice(None),slice(None))+tuple(key[2:])]
+    def flush(self):
+        '''Write the changed tiles in the cache to the file.'''
+        for key in list(self.dirty):
+            self.data[key] = self.cache[key]
+        self.dirty.clear()
+        self.data.flush()
+    def close(self):
+        '''Drop the cache and remove the scratch files.'''
+        self.cache.clear()
+        self.dirty.clear()
+        self.data = None             # unmaps the file
+        _remove(self.directory)
+    def stats(self):
+        return {'hits':self.hits,'misses':self.misses,'evictions':self.evictions,
+                'cached_tiles':len(self.cache),'max_tiles':self.max_tiles}
+
+def _remove(directory):
+    if directory in _open:
+        _open.discard(directory)
+        shutil.rmtree(directory,ignore_errors=True)
+
+def from_array(array,**options):
+    '''A store holding a copy of an (h,w[,channels]) array.'''
+    array = numpy.asarray(array)
+    if array.ndim == 2: array = array[:,:,numpy.newaxis]
+    result = store(array.shape[0],array.shape[1],array.shape[2],array.dtype,**options)
+    result.write(array)
+    result.flush()
+    return result
+
+def from_drawable(drawable,**options):
+    '''A store holding the pixels of a gimp drawable, read a strip at a time.'''
+    result = store(drawable.height,drawable.width,drawable.bpp,**options)
+    for y0,pixels in pixelio.iter_strips(drawable):
+        result.write(pixels,0,y0)
+    result.flush()
+    return result
+
+@atexit.register
+def _cleanup():
+    for directory in list(_open): _remove(directory)
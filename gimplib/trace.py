@@ -0,0 +1,225 @@
+'''Timing of the stages of a plug-in run.
+
+A span times a block of code:
+
+    with trace.span('warp image') as span:
+        ...
+        span.annotate(tiles=n)
+
+and records its wall clock time, cpu time, the peak resident set size
+of the process at its end and the number of PDB calls made during it.
+The spans can be saved as a Chrome trace (load the file in
+chrome://tracing or https://ui.perfetto.dev) or summed up by name in a
+table.
+
+Tracing is off unless the environment variable STITCH_TRACE is set
+(to the name of the Chrome trace file to write) when this module is
+first imported, or enable() is called.  When it is off span returns a
+shared do-nothing context manager, and wrap and traced return the
+function unchanged, so they cost nothing in inner loops.  PDB calls are
+counted by putting a counting_pdb proxy in place of gimp.pdb for the
+duration of a pdb_counting block.  Nothing here needs numpy or gimp.'''
+
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:          # not on Windows
+    resource = None
+
+output = os.environ.get('STITCH_TRACE') or None   # Chrome trace file
+enabled = bool(output)
+
+
+def peak_rss():
+    '''Peak resident set size of this process in kilobytes (None if unknown).'''
+    if resource is None: return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': rss = rss // 1024   # bytes on mac os
+    return rss
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+class tracer(object):
+    '''Collects finished spans.'''
+    def __init__(self):
+        self.reset()
+    def reset(self):
+        self.events = []
+        self.pdb_calls = 0
+        self.pdb_counts = {}
+        self.epoch = time.time()
+    def count_pdb(self,name):
+        self.pdb_calls += 1
+        self.pdb_counts[name] = self.pdb_counts.get(name,0) + 1
+    def add(self,name,start,wall,cpu,pdb_calls,args):
+        self.events.append({'name':name,
+                            'start':start - self.epoch,
+                            'wall':wall,
+                            'cpu':cpu,
+                            'rss':peak_rss(),
+                            'pdb':pdb_calls,
+                            'args':args})
+
+_tracer = tracer()
+
+class _null_span(object):
+    def __enter__(self):
+        return self
+    def __exit__(self,*exc):
+        return False
+    def annotate(self,**args):
+        pass
+
+_null = _null_span()
+
+class _span(object):
+    def __init__(self,name,args):
+        self.name = name
+        self.args = args
+    def __enter__(self):
+        self.pdb_calls = _tracer.pdb_calls
+        self.cpu = cpu_time()
+        self.start = time.time()
+        return self
+    def __exit__(self,*exc):
+        wall = time.time() - self.start
+        _tracer.add(self.name,self.start,wall,cpu_time()-self.cpu,
+                    _tracer.pdb_calls-self.pdb_calls,self.args)
+        return False
+    def annotate(self,**args):
+        '''Add args known only once the block has run.'''
+        self.args.update(args)
+
+def span(name,**args):
+    '''Context manager timing a block as name, with args shown in the trace.'''
+    if not enabled: return _null
+    return _span(name,args)
+
+class _wrapped(object):
+    def __init__(self,func,name):
+        self.func = func
+        self.name = name
+    def __call__(self,*args,**kwargs):
+        with _span(self.name,{}):
+            return self.func(*args,**kwargs)
+
+def wrap(func,name=None):
+    '''func with each call timed as a span (func itself if tracing is off).'''
+    if not enabled: return func
+    return _wrapped(func,name or func.__name__)
+
+def traced(name=None):
+    '''Decorator version of wrap.  It is applied when the function is
+       defined, so only traces if tracing was on at import time.'''
+    def decorator(func):
+        return wrap(func,name)
+    return decorator
+
+def enable(filename=None):
+    '''Turn tracing on (from now on) and start a new trace.'''
+    global enabled, output
+    enabled = True
+    if filename: output = filename
+    _tracer.reset()
+
+def disable():
+    global enabled
+    enabled = False
+
+class _counted_procedure(object):
+    def __init__(self,name,procedure):
+        self.name = name
+        self.procedure = procedure
+    def __call__(self,*args,**kwargs):
+        _tracer.count_pdb(self.name)
+        return self.procedure(*args,**kwargs)
+    def __getattr__(self,name):
+        return getattr(self.procedure,name)
+
+class counting_pdb(object):
+    '''Stands in for gimp.pdb and counts the procedure calls.'''
+    def __init__(self,pdb):
+        self._pdb = pdb
+    def __getattr__(self,name):
+        return _counted_procedure(name,getattr(self._pdb,name))
+    def __getitem__(self,name):
+        return _counted_procedure(name,self._pdb[name])
+
+class pdb_counting(object):
+    '''Context manager counting the PDB calls made through module.pdb
+       (e.g. the gimp module) while tracing is on.'''
+    def __init__(self,module):
+        self.module = module
+        self.pdb = None
+    def __enter__(self):
+        if enabled and not isinstance(self.module.pdb,counting_pdb):
+            self.pdb = self.module.pdb
+            self.module.pdb = counting_pdb(self.pdb)
+        return self
+    def __exit__(self,*exc):
+        if self.pdb is not None:
+            self.module.pdb = self.pdb
+            self.pdb = None
+        return False
+
+def events():
+    return list(_tracer.events)
+
+def chrome_trace(filename=None):
+    '''The spans as a Chrome trace event dictionary, saved to filename if given.'''
+    pid = os.getpid()
+    trace_events = []
+    for event in _tracer.events:
+        args = dict(event['args'])
+        args.update({'cpu_ms':event['cpu']*1.e3,'peak_rss_kb':event['rss'],
+                     'pdb_calls':event['pdb']})
+        trace_events.append({'name':event['name'],'ph':'X','pid':pid,'tid':0,
+                             'ts':event['start']*1.e6,'dur':event['wall']*1.e6,
+                             'args':args})
+    result = {'traceEvents':trace_events,'displayTimeUnit':'ms',
+              'otherData':{'pdb_counts':_tracer.pdb_counts}}
+    if filename:
+        f = open(filename,'w')
+        try:
+            json.dump(result,f)
+        finally:
+            f.close()
+    return result
+
+def summary():
+    '''Table of the spans summed by name, in order of first appearance.'''
+    names = []
+    totals = {}
+    for event in _tracer.events:
+        name = event['name']
+        if name not in totals:
+            names.append(name)
+            totals[name] = [0,0.0,0.0,0,0]
+        total = totals[name]
+        total[0] += 1
+        total[1] += event['wall']
+        total[2] += event['cpu']
+        total[3] = max(total[3],event['rss'] or 0)
+        total[4] += event['pdb']
+    width = max([len(name) for name in names] + [5])
+    lines = ['%-*s %7s %10s %10s %10s %12s %9s' % (width,'stage','count','wall (s)',
+                                                  'mean (s)','cpu (s)','peak rss kb','pdb calls')]
+    for name in names:
+        count,wall,cpu,rss,pdb = totals[name]
+        lines.append('%-*s %7d %10.3f %10.4f %10.3f %12d %9d' %
+                     (width,name,count,wall,wall/count,cpu,rss,pdb))
+    return '\n'.join(lines)
+
+def finish():
+    '''Save the Chrome trace to the output file, print the summary and
+       start a new trace.  Does nothing if tracing is off.'''
+    if not enabled or not _tracer.events: return
+    if output: chrome_trace(output)
+    print(summary())
+    _tracer.reset()
@@ -73,7 +73,18 @@ from gimpenums import *
 import pygtk
 pygtk.require('2.0')
 import gtk
-import cPickle as pickle
+from gimplib import cpfile, cpcache, optimize, diagnostics, trace, delaunay
+
+# Optional modules.  The array based code paths need numpy and the
+# gimplib package which lives next to this plug-in.  Without them the
+# gimp pdb is used for everything.
+try:
+    import numpy
+    from gimplib import blend, overlay, correlate, ecc, resample, scratch, pixelio
+    from gimplib import projection, lens, rig, render, mosaic, tilestore, ingest, pairs
+    from gimplib import colorspace
+except ImportError:
+    numpy = None
 
 #------------ MAIN PLUGIN CLASS
 
@@ -149,6 +160,17 @@ class control_point(object):
             colorbalance = True
         return control_point(self.x2(),self.y2(),self.x1(),self.y1(),
                                            self.correlation,colorbalance)
+    def record(self):
+        '''The control point as a tuple for gimplib.cpfile.'''
+        return self.xy + (self.correlation,self.cb())
+
+def control_point_records(control_points):
+    '''Convert a list of control points to cpfile records.'''
+    return [cp.record() for cp in control_points]
+
+def control_points_from_records(records):
+    '''Convert cpfile records to a list of control points.'''
+    return [control_point(*record) for record in cpfile.as_tuples(records)]
 
 minradius = 20.0  # min radius for color averaging
 
@@ -159,11 +181,14 @@ class stitchable(object):
         self.rimage = rimage                   # the reference image object
         self.timage = timage                   # the transformed image object
         self.cimage = None                     # temporary image for correlation
+        self.scratch = None                    # patch arrays for correlation (needs numpy)
         self.dimage = None                     # temporary image for undistorted image
         self.rimglayer = None                  # main image layer in reference image
         self.timglayer = None                  # main image layer in transformed image
         self.rcplayer = None                   # the reference control point display layer
         self.tcplayer = None                   # the transform control point display layer
+        self.roverlay = None                   # markers drawn in rcplayer (needs numpy)
+        self.toverlay = None                   # markers drawn in tcplayer (needs numpy)
         self.control_points = control_points   # the warping control points
         self.panorama = None                   # the resulting panoramic image
         self.rlayer = None                     # the reference layer in self.panorama
@@ -174,15 +199,37 @@ class stitchable(object):
         self.txy = None                        # x,y of transformed corners [x1,y1,x2,y2]
         self.interpolation = INTERPOLATION_CUBIC
         self.supersample = 1
+        self.adaptive_supersample = False      # supersample only the tiles that need it (needs numpy)
+        self.supersample_report = None         # render.report of the adaptive supersampling
         self.cpcorrelate = True                # correlate control points?
+        self.refine_method = 'amoeba'          # 'amoeba' or 'ecc' (needs numpy)
+        self.refine_size = 64                  # patch size for refining all points
         self.recursion_level = 5
         self.clip_result = 1   # this must be 1 or gimp will crash (segmentation fault)
         self.colorbalance = True               # color balance?
         self.colorradius = minradius           # color radius
         self.blend = True                      # blend edges?
         self.blend_fraction = 0.25             # size of blend along edges (fraction of image size)
+        self.blend_method = 'gradient'         # 'gradient', 'feather' or 'seam' (need numpy)
+        self.seam_feather = 2                  # softening of the seam cut (pixels)
         self.rmdistortion = True               # remove distortion?
+        self.distortion_model = 'triangles'    # 'triangles' or 'lens' (needs numpy)
+        self.lens = None                       # lens.model the images were corrected for
+        self.projection = 'planar'             # 'planar', 'cylindrical' or 'spherical' (need numpy)
+        self.focal_length = None               # focal length in pixels (None: estimate)
+        self.originals = None                  # images and control points before correction/projection
+        self.temp_images = []                  # temporary corrected or projected images
+        self.projection_focal = None           # focal length the images were projected with
+        self.warp_triangles = None             # (triangles,undistorted,vertices) of remove_distortion
+        self.mesh = delaunay.triangulation()   # Delaunay mesh of the transformed points and corners
+        self.canvas_transform = None           # transform of timage onto the panorama
+        self.rig_template = get_rig_template_file()  # rig template file (needs numpy)
+        self.output_file = get_output_file()   # tiled TIFF to write the panorama to (needs numpy)
+        self.tile_budget = 256                 # megabytes of memory for images kept in tile stores
         self.condition_number = None           # the condition number of the transform
+        self.image_digests = None              # content digests of rimglayer,timglayer
+        self.fit_report = None                 # diagnostics.fit_report of the transform
+        self.fit_log = get_fit_log()           # diagnostics.json_log or None
         self.progressbar = None                # the progress bar widget
         self.update()
     def __getitem__(self,index):
@@ -192,16 +239,43 @@ class stitchable(object):
         if self.control_points:
             self.npoints = len(self.control_points)
             rarray,tarray = self.arrays()
+            self.condition_number = None
+            start = time.time()
             self.transform = compute_transform_matrix(rarray,tarray,self)
             self.errors = compute_control_point_errors(self)
+            self.report_fit(time.time()-start)
         else:
             self.npoints = 0
             self.transform = None
             self.errors = None
+            self.fit_report = None
+        self.update_mesh()
+    def report_fit(self,solve_time=None):
+        '''Make the fit report for the transform and log it.'''
+        rarray,tarray = self.arrays()
+        self.fit_report = diagnostics.fit_report(rarray,tarray,self.transform,
+                                                 self.condition_number,solve_time)
+        if self.fit_log:
+            try:
+                self.fit_log.write(self.fit_report,
+                                   reference=self.rimage.name,transformed=self.timage.name)
+            except (IOError,OSError):
+                error_message('Warning: could not write the fit log '+self.fit_log.filename,
+                              self.mode)
+                self.fit_log = None
     def set_control_points(self,control_points):
         '''Se the whole control point list.'''
         self.control_points = control_points
         self.update()
+    def set_solution(self,control_points,transform,condition_number):
+        '''Set the control points with an already solved transform.'''
+        self.control_points = control_points
+        self.npoints = len(control_points)
+        self.transform = transform
+        self.condition_number = condition_number
+        self.errors = compute_control_point_errors(self)
+        self.report_fit()
+        self.update_mesh()
     def add_control_point(self,cp):
         '''Add a control point to the control_points list.
            The control_point parameter should be of the control_point
@@ -240,6 +314,29 @@ class stitchable(object):
                 self.control_points[index] = cp2
                 self.control_points[index+1] = cp1
                 self.update()
+    def mesh_points(self):
+        '''The transformed control points and the corners of the
+           transformed image, as remove_distortion triangulates them.'''
+        rarray,tarray = self.arrays()
+        layer = self.timglayer or self.timage
+        width,height = layer.width,layer.height
+        return [t[:2] for t in tarray] + [[0.0,0.0],[0.0,height],[width,0.0],[width,height]]
+    def update_mesh(self):
+        '''Bring the Delaunay mesh to mesh_points.  The mesh is kept, so
+           only the points added, moved or deleted are re-triangulated.'''
+        self.mesh_index = {}                   # mesh vertex -> index in mesh_points
+        for i,v in enumerate(self.mesh.sync(self.mesh_points())):
+            self.mesh_index.setdefault(v,i)
+    def mesh_triangles(self):
+        '''Delaunay triangles of mesh_points as index lists, i < j < k.'''
+        self.update_mesh()
+        return sorted([sorted([self.mesh_index[v] for v in t]) for t in self.mesh.triangles()])
+    def locate(self,x,y):
+        '''The triangle of mesh_triangles holding the transformed image
+           pixel x,y, or None outside the mesh.'''
+        triangle = self.mesh.locate(x,y)
+        if triangle is None: return None
+        return sorted([self.mesh_index[v] for v in triangle])
     def inverse_control_points(self):
         '''Invert the control point list and return the inverse.'''
         inverse = []
@@ -435,25 +532,49 @@ def stitch_control_panel(control_points,image_list,mode):
                       'Only the bottom layer will be stitched.  You may want to '+\
                       'flatten the image and rerun stitch panorama.',stitch.mode)
 
-    try:
-        if mode == RUN_NONINTERACTIVE:
-            go_stitch_panorama(stitch)
-        else:
-            # Call the user interface
-            draw_control_points(stitch)
-            widget = ControlPanelWidget(stitch)
-            widget.main()
-            stitch = widget.stitch
-        if stitch.control_points:
-            save_control_points_to_parasite(stitch)
-    finally:
-        # clean up a bit
-        if stitch.panorama: stitch.panorama.enable_undo()
-        if stitch.rcplayer: stitch.rimage.remove_layer(stitch.rcplayer)
-        if stitch.tcplayer: stitch.timage.remove_layer(stitch.tcplayer)
-        if stitch.cimage: gimp.pdb.gimp_image_delete(stitch.cimage)
-        if stitch.dimage: gimp.pdb.gimp_image_delete(stitch.dimage)
-        gimp.pdb.gimp_displays_flush()
+    # the cache key is of the original layers: stitching replaces timglayer
+    get_cache_key(stitch)
+    if not stitch.control_points:
+        get_control_points_from_cache(stitch)
+
+    if mode == RUN_NONINTERACTIVE and stitch.rig_template and numpy and \
+       os.path.exists(stitch.rig_template):
+        # a fixed rig: stitch by the saved remap grids, no solving
+        with trace.pdb_counting(gimp):
+            try:
+                with trace.span('stitch rig template'):
+                    stitch_with_rig_template(stitch,rig.load(stitch.rig_template))
+            finally:
+                trace.finish()
+        return stitch.panorama
+
+    with trace.pdb_counting(gimp):
+        try:
+            if mode == RUN_NONINTERACTIVE:
+                if stitch.fit_report and stitch.fit_report.ill_conditioned():
+                    error_message('Error: '+stitch.fit_report.summary()+'.  '+\
+                                  'Add control points which are spread over the images.',mode)
+                else:
+                    go_stitch_panorama(stitch)
+            else:
+                # Call the user interface
+                draw_control_points(stitch)
+                widget = ControlPanelWidget(stitch)
+                widget.main()
+                stitch = widget.stitch
+            if stitch.control_points:
+                save_control_points_to_parasite(stitch)
+                save_control_points_to_cache(stitch)
+        finally:
+            # clean up a bit
+            if stitch.panorama: stitch.panorama.enable_undo()
+            if stitch.rcplayer: stitch.rimage.remove_layer(stitch.rcplayer)
+            if stitch.tcplayer: stitch.timage.remove_layer(stitch.tcplayer)
+            if stitch.cimage: gimp.pdb.gimp_image_delete(stitch.cimage)
+            if stitch.dimage: gimp.pdb.gimp_image_delete(stitch.dimage)
+            for img in stitch.temp_images: gimp.pdb.gimp_image_delete(img)
+            gimp.pdb.gimp_displays_flush()
+            trace.finish()
 
     return stitch.panorama
 
@@ -469,6 +590,7 @@ def control_points_editor(stitch):
     draw_control_points(stitch)
     return widget.stitch
 
+@trace.traced('correlate control point')
 def get_new_control_point(stitch,colorbalance=True):
     '''Get a new control point from the selections in the images.'''
     ##if __debug__: print 'this is get_new_control_point()'
@@ -492,11 +614,146 @@ def get_new_control_point(stitch,colorbalance=True):
     xscale = max(min(rxsize/8.0,txsize/8.0),1.0) # one eighth the max shift
     yscale = max(min(rysize/8.0,tysize/8.0),1.0)
 
-    # make a temporary image 
+    # the size of the correlation patches
     
     xsize = max(rxsize,txsize)
     ysize = max(rysize,tysize)
     
+    if numpy:
+        (xshift,yshift,rotate,scalxy,correlation) = correlate_selections(stitch,
+                                                                         reference_selection,
+                                                                         transformed_selection,
+                                                                         xsize,ysize,
+                                                                         xscale,yscale)
+    else:
+        (xshift,yshift,rotate,scalxy,correlation) = pdb_correlate_selections(stitch,
+                                                                             reference_selection,
+                                                                             transformed_selection,
+                                                                             xsize,ysize,
+                                                                             xscale,yscale)
+
+    rx = (reference_selection[1]+reference_selection[3])/2.0
+    ry = (reference_selection[2]+reference_selection[4])/2.0
+    tx = (transformed_selection[1]+transformed_selection[3])/2.0
+    ty = (transformed_selection[2]+transformed_selection[4])/2.0
+
+    # inverse transform takes transformed center back to reference center
+
+    transform = matrix_invert(rss2transform(xshift,yshift,rotate,scalxy,xsize,ysize))
+
+    ##if __debug__:
+    ##    print 'Test the CP calculation...'
+    ##    print 'This should be the identity matrix:'
+    ##    print matrixmultiply(transform,rss2transform(xshift,yshift,rotate,scalxy,xsize,ysize))
+
+    # since the images are centered in cimage,
+    # tx,ty in the big image corresponds to xcenter,ycenter in cimage.
+    xcenter = (xsize-1.0)/2.0
+    ycenter = (ysize-1.0)/2.0
+    stx,sty = xytransform(transform,xcenter,ycenter)
+    ##if __debug__: print 'stx,sty:',stx,sty,tx+stx-xcenter,ty+sty-ycenter
+    stx = stx - xcenter
+    sty = sty - ycenter
+
+    update_progress_bar(stitch.progressbar,' ',0.0)
+
+    return control_point(rx,ry,tx+stx,ty+sty,correlation,colorbalance)
+
+def initial_rotation_scale(stitch):
+    '''Starting rotation and scale for correlating a new control point.'''
+    if stitch.npoints >= 1:
+        # get the approximate rotation and scale
+        rarray,tarray = stitch.arrays()
+        ttrans = compute_transform_matrix(rarray,tarray,stitch)
+        (sscale,srotation) = transform2rs(ttrans)
+    else:
+        srotation = 0.0
+        sscale = 1.0
+    return (-srotation,sscale)
+
+def correlate_selections(stitch,reference_selection,transformed_selection,
+                         xsize,ysize,xscale,yscale):
+    '''Correlate the selections with numpy.
+
+       The selections are read straight from the image layers into
+       xsize x ysize patches from stitch.scratch, so no scratch image is
+       needed.  Returns (xshift,yshift,rotation,scale,correlation) like
+       pdb_correlate_selections.'''
+    if not stitch.scratch: stitch.scratch = scratch.buffer_pool()
+    rvalues = stitch.scratch.acquire((ysize,xsize))
+    rvalid = stitch.scratch.acquire((ysize,xsize),bool)
+    tvalues = stitch.scratch.acquire((ysize,xsize))
+    tvalid = stitch.scratch.acquire((ysize,xsize),bool)
+    try:
+        read_selection(stitch.rimglayer,reference_selection,rvalues,rvalid)
+        read_selection(stitch.timglayer,transformed_selection,tvalues,tvalid)
+        correlation = correlate.correlation(rvalues,tvalues,rvalid & tvalid)
+        xshift = 0.
+        yshift = 0.
+        rotate = 0.
+        scalxy = 1.
+        if stitch.cpcorrelate:
+            rs,ss = initial_rotation_scale(stitch)
+            refined = None
+            if stitch.refine_method == 'ecc':
+                # gradient based refinement, see gimplib.ecc
+                refined = ecc_refine(rvalues,rvalid,tvalues,tvalid,xsize,ysize,rs,ss)
+                if not ecc_accepted(refined,correlation,xsize,ysize): refined = None
+            if refined:
+                (xshift,yshift,rotate,scalxy,correlation) = refined
+            else:
+                # repeated with a shared memo, see pdb_correlate_selections
+                var = [0.0,0.0,rs,ss]
+                data = (rvalues,rvalid,
+                        tvalues,tvalid,
+                        xsize,ysize,
+                        stitch.progressbar)
+                scale = [xscale,yscale,0.10,0.10]
+                memo = {}
+                for iamoeba in range(2):
+                    (varbest,correlation,iterations) = amoeba(var,
+                                                              scale,
+                                                              array_correlation_func,
+                                                              ftolerance=1.e-3,
+                                                              xtolerance=1.e-3,
+                                                              itmax=100,
+                                                              data=data,
+                                                              memo=memo)
+                    if varbest == var: break
+                    var = varbest
+                (xshift,yshift,rotate,scalxy) = varbest
+    finally:
+        for array in (rvalues,rvalid,tvalues,tvalid):
+            stitch.scratch.release(array)
+    update_progress_bar(stitch.progressbar,'Correlating ...',1.0)
+    return (xshift,yshift,rotate,scalxy,correlation)
+
+def read_selection(layer,selection,values,valid):
+    '''Read the brightness of the bounding box of a selection, centered
+       in the values and valid arrays.'''
+    ysize,xsize = values.shape
+    width = selection[3]-selection[1]
+    height = selection[4]-selection[2]
+    x0 = (xsize-width)/2  # starting coordinates of the selection data
+    y0 = (ysize-height)/2
+    values[...] = 0.0
+    valid[...] = False
+    lx,ly = layer.offsets
+    correlate.read_brightness(layer,selection[1]-lx,selection[2]-ly,width,height,
+                              values[y0:y0+height,x0:x0+width],
+                              valid[y0:y0+height,x0:x0+width])
+
+def pdb_correlate_selections(stitch,reference_selection,transformed_selection,
+                             xsize,ysize,xscale,yscale):
+    '''Correlate the selections with the gimp pdb, in the scratch image
+       stitch.cimage.  Returns (xshift,yshift,rotation,scale,correlation),
+       the rss2transform parameters taking the transformed selection onto
+       the reference selection and their correlation.'''
+    rxsize = reference_selection[3]-reference_selection[1]
+    rysize = reference_selection[4]-reference_selection[2]
+    txsize = transformed_selection[3]-transformed_selection[1]
+    tysize = transformed_selection[4]-transformed_selection[2]
+
     rx0 = (xsize-rxsize)/2  # starting coordinates of layer data
     ry0 = (ysize-rysize)/2 
     tx0 = (xsize-txsize)/2 
@@ -602,15 +859,9 @@ def get_new_control_point(stitch,colorbalance=True):
                                    TRUE,        # changes applied to layer
                                    FALSE)        # Shadow
 
-    for i in range (xsize):
-        for j in range(ysize):
-            # set the alpha channel for the layers
-            r,g,b,a = struct.unpack('B'*rpixels.bpp,rpixels[i,j])
-            m = struct.unpack('B'*rmpixels.bpp,rmpixels[i,j])
-            rpixels[i,j] = struct.pack('B'*rpixels.bpp,r,g,b,m[0])
-            r,g,b,a = struct.unpack('B'*tpixels.bpp,tpixels[i,j])
-            m = struct.unpack('B'*tmpixels.bpp,tmpixels[i,j])
-            tpixels[i,j] = struct.pack('B'*tpixels.bpp,r,g,b,m[0])
+    # set the alpha channel for the layers
+    merge_alpha(rpixels,rmpixels,xsize,ysize)
+    merge_alpha(tpixels,tmpixels,xsize,ysize)
     
     tsave  = tpixels[0:xsize,0:ysize]    # store the data for restoration later.
 
@@ -638,23 +889,9 @@ def get_new_control_point(stitch,colorbalance=True):
     if stitch.cpcorrelate:
         # Update the control point by maximizing the correlation
 
-        if stitch.npoints >= 1:
-            # get the approximate rotation and scale
-            rarray,tarray = stitch.arrays()
-            ttrans = compute_transform_matrix(rarray,tarray,stitch)
-            (sscale,srotation) = transform2rs(ttrans)
-##             if __debug__:
-##                 print 'srotation is ',srotation, \
-##                       math.atan2(-ttrans[0][1],ttrans[0][0],), \
-##                       math.atan2(+ttrans[1][0],ttrans[1][1])
-        else:
-            srotation = 0.0
-            sscale = 1.0
-
         xs = 0.0
         ys = 0.0
-        rs = -srotation
-        ss = sscale
+        rs,ss = initial_rotation_scale(stitch)
         var = [xs,ys,rs,ss]
         data = (tlayer,
                 rpixels,tpixels,
@@ -667,7 +904,10 @@ def get_new_control_point(stitch,colorbalance=True):
         
         # Optimizing functions should always be repeated just in
         # case the the algorithm got stuck.  If it did not get stuck,
-        # then the second call will be quick.
+        # then the second call will be quick.  The two calls share
+        # the memo of correlations, and the second is skipped if the
+        # first did not move since it would just repeat the first.
+        memo = {}
         for iamoeba in range(2):
             (varbest,correlation,iterations) = amoeba(var,
                                                       scale,
@@ -675,11 +915,13 @@ def get_new_control_point(stitch,colorbalance=True):
                                                       ftolerance=1.e-3,
                                                       xtolerance=1.e-3,
                                                       itmax=itmax,
-                                                      data=data)
+                                                      data=data,
+                                                      memo=memo)
+            if varbest == var: break
             var = varbest
             #if __debug__:
             #    print 'Best corr after ', iterations, ' iterations: ',correlation
-            
+
         (xshift,yshift,rotate,scalxy) = varbest
                         
         #if __debug__:
@@ -689,32 +931,16 @@ def get_new_control_point(stitch,colorbalance=True):
     stitch.cimage.remove_layer(rlayer)
     stitch.cimage.remove_layer(tlayer)
 
-    rx = (reference_selection[1]+reference_selection[3])/2.0
-    ry = (reference_selection[2]+reference_selection[4])/2.0
-    tx = (transformed_selection[1]+transformed_selection[3])/2.0
-    ty = (transformed_selection[2]+transformed_selection[4])/2.0
-
-    # inverse transform takes transformed center back to reference center
-
-    transform = matrix_invert(rss2transform(xshift,yshift,rotate,scalxy,xsize,ysize))
-
-    ##if __debug__:
-    ##    print 'Test the CP calculation...'
-    ##    print 'This should be the identity matrix:'
-    ##    print matrixmultiply(transform,rss2transform(xshift,yshift,rotate,scalxy,xsize,ysize))
-
-    # since the images are centered in cimage,
-    # tx,ty in the big image corresponds to xcenter,ycenter in cimage.
-    xcenter = (xsize-1.0)/2.0
-    ycenter = (ysize-1.0)/2.0
-    stx,sty = xytransform(transform,xcenter,ycenter)
-    ##if __debug__: print 'stx,sty:',stx,sty,tx+stx-xcenter,ty+sty-ycenter
-    stx = stx - xcenter
-    sty = sty - ycenter
-
-    update_progress_bar(stitch.progressbar,' ',0.0)
+    return (xshift,yshift,rotate,scalxy,correlation)
 
-    return control_point(rx,ry,tx+stx,ty+sty,correlation,colorbalance)
+def merge_alpha(pixels,mpixels,xsize,ysize):
+    '''Copy the first channel of a mask region into the alpha channel
+       (the last channel) of a pixel region.  Both regions are read and
+       written as whole strings.'''
+    data = bytearray(pixels[0:xsize,0:ysize])
+    mask = mpixels[0:xsize,0:ysize]
+    data[pixels.bpp-1::pixels.bpp] = mask[::mpixels.bpp]
+    pixels[0:xsize,0:ysize] = str(data)
 
 def rss2transform(xs,ys,rs,ss,xsize,ysize):
     '''Convert rotation, shift and scale to a transform matrix.'''
@@ -776,6 +1002,105 @@ def transform2rs(transform):
         
     return (sscale,srotation)
 
+def transform2rss(transform,xsize,ysize):
+    '''Compute shift, rotation and scale from a rss2transform matrix.
+
+       This is exact for a transform made of a shift, a rotation and a
+       uniform scale about the center of a xsize x ysize image.'''
+    xs2 = (xsize-1)/2.0
+    ys2 = (ysize-1)/2.0
+    det = transform[0][0]*transform[1][1]-transform[0][1]*transform[1][0]
+    ss = math.sqrt(abs(det))
+    rs = math.atan2(transform[0][1],transform[0][0])
+    # the shift is applied first: [x y] -> ([x y]+[xs ys]-center)*L+center
+    dx = transform[2][0] - xs2
+    dy = transform[2][1] - ys2
+    xs = (dx*transform[1][1] - dy*transform[1][0])/det + xs2
+    ys = (dy*transform[0][0] - dx*transform[0][1])/det + ys2
+    return (xs,ys,rs,ss)
+
+def ecc_refine(rvalues,rvalid,tvalues,tvalid,xsize,ysize,rs,ss):
+    '''Find the shift, rotation and scale maximizing the correlation of two
+       patches with gimplib.ecc.  Returns (xs,ys,rs,ss,correlation).'''
+    # ecc warps take reference coordinates to transformed coordinates,
+    # the inverse of the rss transform, and act on column vectors.
+    warp = transpose(matrix_invert(rss2transform(0.0,0.0,rs,ss,xsize,ysize)))
+    warp,correlation,iterations = ecc.refine(rvalues,rvalid,tvalues,tvalid,warp)
+    transform = matrix_invert(transpose(warp.tolist()))
+    (xs,ys,rs,ss) = transform2rss(transform,xsize,ysize)
+    return (xs,ys,rs,ss,correlation)
+
+def ecc_accepted(refined,correlation,xsize,ysize):
+    '''Is an ecc_refine result to be trusted?  It must be finite, move the
+       patch center less than half the patch and correlate at least as
+       well as the unrefined patches (correlation).'''
+    (xs,ys,rs,ss,rcorrelation) = refined
+    if not numpy.all(numpy.isfinite(refined)) or ss <= 0.0: return False
+    xcenter = (xsize-1.0)/2.0
+    ycenter = (ysize-1.0)/2.0
+    x,y = xytransform(matrix_invert(rss2transform(xs,ys,rs,ss,xsize,ysize)),xcenter,ycenter)
+    return math.hypot(x-xcenter,y-ycenter) < min(xsize,ysize)/2.0 and rcorrelation >= correlation
+
+@trace.traced('refine all control points')
+def refine_all_control_points(stitch,processes=None):
+    '''Refine every control point with gimplib.ecc, in parallel.
+
+       A patch around each point is read from both image layers and the
+       patches are refined in a pool of threads (a plug-in must not
+       fork), starting from the current transform.  The control points are replaced in one batch at the
+       end; points which fail to refine are kept as they were.'''
+    if not numpy or not stitch.control_points or not stitch.transform: return
+    size = stitch.refine_size
+    # the linear part of the transform (column vectors) takes transformed
+    # coordinates to reference coordinates; the warp needs its inverse.
+    t = stitch.transform
+    det = t[0][0]*t[1][1]-t[1][0]*t[0][1]
+    if not det: return
+    linear = numpy.array([[t[1][1],-t[1][0],0.0],
+                          [-t[0][1],t[0][0],0.0],
+                          [0.0,0.0,det]])/det
+    update_progress_bar(stitch.progressbar,'Reading patches ...',0.0)
+    jobs = []
+    corners = []
+    for i in range(stitch.npoints):
+        cp = stitch.control_points[i]
+        rpixels,rvalid,rx0,ry0 = correlate.drawable_patch(stitch.rimglayer,cp.x1(),cp.y1(),size)
+        tpixels,tvalid,tx0,ty0 = correlate.drawable_patch(stitch.timglayer,cp.x2(),cp.y2(),size)
+        warp = numpy.dot([[1.0,0.0,cp.x2()-tx0],[0.0,1.0,cp.y2()-ty0],[0.0,0.0,1.0]],
+                         numpy.dot(linear,
+                                   [[1.0,0.0,rx0-cp.x1()],[0.0,1.0,ry0-cp.y1()],[0.0,0.0,1.0]]))
+        jobs.append((i,
+                     correlate.brightness(rpixels).astype(numpy.float32),rvalid,
+                     correlate.brightness(tpixels).astype(numpy.float32),tvalid,
+                     warp))
+        corners.append((rx0,ry0,tx0,ty0))
+    def progress(done,total):
+        update_progress_bar(stitch.progressbar,'Refining %d/%d' % (done,total),
+                            float(done)/total)
+    results = ecc.refine_all(jobs,processes,progress,threads=True)
+    control_points = []
+    for (i,warp,correlation,iterations),(rx0,ry0,tx0,ty0) in zip(results,corners):
+        cp = stitch.control_points[i]
+        x,y,w = numpy.dot(warp,[cp.x1()-rx0,cp.y1()-ry0,1.0])
+        x = x/w + tx0
+        y = y/w + ty0
+        if numpy.isfinite(x) and numpy.isfinite(y) and \
+           math.hypot(x-cp.x2(),y-cp.y2()) < size/2.0:
+            cp = control_point(cp.x1(),cp.y1(),x,y,correlation,cp.cb())
+        control_points.append(cp)
+    stitch.set_control_points(control_points)
+    update_progress_bar(stitch.progressbar,' ',0.0)
+
+def array_correlation_func(var,data):
+    '''transform_correlation_func for numpy patches.'''
+    (xs,ys,rs,ss) = var
+    (rvalues,rvalid,tvalues,tvalid,xsize,ysize,pbar) = data
+    # resample wants the inverse transform, acting on column vectors
+    transform = numpy.linalg.inv(rss2transform(xs,ys,rs,ss,xsize,ysize)).T
+    warped,wvalid = resample.affine(tvalues,transform,(ysize,xsize),tvalid)
+    corr = correlate.correlation(rvalues,warped,rvalid & wvalid)
+    if pbar: update_progress_bar(pbar,'Correlating ...',max(corr,0.0,pbar.get_fraction()))
+    return corr
 
 def transform_correlation_func(var,data):
     (xs,ys,rs,ss) = var
@@ -817,6 +1142,9 @@ def transform_correlation(tlayer,
 
 def compute_correlation(rpixels,tpixels):
     '''Compute the cross correlation between to pixel regions.'''
+    if numpy:
+        return correlate.pixel_correlation(pixelio.read_region(rpixels),
+                                           pixelio.read_region(tpixels))
     rformat = 'B'*rpixels.bpp  # replicate 'B' by number of bytes
     tformat = 'B'*tpixels.bpp
 
@@ -884,7 +1212,13 @@ def get_control_points_from_parasite(rimage,timage):
     name = get_pickle_name(timage)
     parasite = rimage.parasite_find(name)
     if parasite:
-        return pickle.loads(parasite.data)
+        # parasites written by older versions hold a pickle, which
+        # cpfile converts.  They are rewritten in the new format by
+        # save_control_points_to_parasite.
+        try:
+            return control_points_from_records(cpfile.loads(parasite.data))
+        except ValueError:
+            return None
     else:
         return None
 
@@ -895,12 +1229,66 @@ def save_control_points_to_parasite(stitchobj):
     # Also save the inverse set of control points to the transformed image
     # in case the user wants to apply the images the other way around.
     if stitchobj.control_points:
-        cp_pickle = pickle.dumps(stitchobj.control_points)
+        cp_data = cpfile.dumps(control_point_records(stitchobj.control_points))
         name = get_pickle_name(stitchobj.timage)
-        stitchobj.rimage.attach_new_parasite(name,3,cp_pickle)
-        cp_pickle = pickle.dumps(stitchobj.inverse_control_points())
+        stitchobj.rimage.attach_new_parasite(name,3,cp_data)
+        cp_data = cpfile.dumps(control_point_records(stitchobj.inverse_control_points()))
         name = get_pickle_name(stitchobj.rimage)
-        stitchobj.timage.attach_new_parasite(name,3,cp_pickle)
+        stitchobj.timage.attach_new_parasite(name,3,cp_data)
+
+def get_control_point_cache():
+    return cpcache.cache(os.path.join(gimp.directory,'stitch-cache'))
+
+def get_cache_key(stitchobj):
+    '''The cache key for the image pair.
+
+       The control points and their transform do not depend on any of
+       the options, so the key is of the pixels only.'''
+    if not stitchobj.image_digests:
+        stitchobj.image_digests = (cpcache.drawable_digest(stitchobj.rimglayer),
+                                   cpcache.drawable_digest(stitchobj.timglayer))
+    rdigest,tdigest = stitchobj.image_digests
+    return cpcache.cache_key(rdigest,tdigest)
+
+def get_control_points_from_cache(stitchobj):
+    '''Look for the control points of identical images from an earlier session.'''
+    try:
+        entry = get_control_point_cache().get(get_cache_key(stitchobj))
+    except (IOError,OSError):
+        entry = None
+    if not entry: return False
+    records,transform,condition_number = entry
+    control_points = control_points_from_records(records)
+    if not control_points: return False
+    if transform:
+        stitchobj.set_solution(control_points,transform,condition_number)
+    else:
+        stitchobj.set_control_points(control_points)
+    return True
+
+def save_control_points_to_cache(stitchobj):
+    '''Save the control points and the solved transform to the disk cache.'''
+    try:
+        get_control_point_cache().put(get_cache_key(stitchobj),
+                                      control_point_records(stitchobj.control_points),
+                                      stitchobj.transform,stitchobj.condition_number)
+    except (IOError,OSError):
+        error_message('Warning: could not save the control points to the cache:\n'+
+                      str(sys.exc_value),stitchobj.mode)
+
+def get_fit_log():
+    '''Log of transform fits named by $STITCH_FIT_LOG (None if not set).'''
+    filename = os.environ.get('STITCH_FIT_LOG')
+    if not filename: return None
+    return diagnostics.json_log(filename)
+
+def get_rig_template_file():
+    '''The rig template file named by $STITCH_RIG (None if not set).'''
+    return os.environ.get('STITCH_RIG') or None
+
+def get_output_file():
+    '''The tiled TIFF file named by $STITCH_OUTPUT (None if not set).'''
+    return os.environ.get('STITCH_OUTPUT') or None
 
 def compute_transform_matrix(rarray,tarray,stitch=None):
     '''Calculate the transformation matrix which defines how the transformed
@@ -1059,7 +1447,10 @@ def compute_control_point_xyerrors(stitch):
     return x,y
 
 def rgb2hsv(rgb):
-    '''Convert RGB color to HSV color.'''
+    '''Convert RGB color to HSV color.
+
+    The saturation returned here is the chroma (max-min) in the units
+    of the input.  For whole images use gimplib.colorspace.rgb_to_hsv.'''
     r = rgb[0]
     g = rgb[1]
     b = rgb[2]
@@ -1068,12 +1459,10 @@ def rgb2hsv(rgb):
     if saturation:
         if r == value:
             hue = float(g-b)/saturation
-        else:
-            if g == value:
-                hue = 2.0 + float(b-r)/saturation
-            else:
-                if b == value:
-                    hue = 4.0 + float(r-g)/saturation
+        elif g == value:
+            hue = 2.0 + float(b-r)/saturation
+        else:   # b must be the max
+            hue = 4.0 + float(r-g)/saturation
     else:
         hue = 0.0
     hue = hue * 60.0
@@ -1081,8 +1470,52 @@ def rgb2hsv(rgb):
     ##if __debug__: print 'RGB,HSV: ',r,g,b,hue,saturation,value
     return (hue,saturation,value)
 
+def overlap_color_points(stitchobj):
+    '''Curve points matching the colors of the transformed layer to the
+       reference layer over the whole of their overlap (needs numpy).
+
+       For each channel the mean and the mean plus and minus one
+       standard deviation of the transformed pixels are mapped to those
+       of the reference pixels.  Returns [red,green,blue] lists of
+       transformed,reference pairs, empty if the layers hardly overlap.'''
+    rlayer,tlayer = stitchobj.rlayer,stitchobj.tlayer
+    rx,ry = rlayer.offsets
+    tx,ty = tlayer.offsets
+    ox0 = max(rx,tx) ; oy0 = max(ry,ty)
+    ox1 = min(rx+rlayer.width,tx+tlayer.width)
+    oy1 = min(ry+rlayer.height,ty+tlayer.height)
+    points = [[],[],[]]
+    if ox1 <= ox0 or oy1 <= oy0: return points
+    w = ox1-ox0 ; h = oy1-oy0
+    rpixels = pixelio.read(rlayer,ox0-rx,oy0-ry,w,h)
+    tpixels = pixelio.read(tlayer,ox0-tx,oy0-ty,w,h)
+    valid = (pixelio.read(stitchobj.rmask,ox0-rx,oy0-ry,w,h) >= 128) & \
+            (pixelio.read(stitchobj.tmask,ox0-tx,oy0-ty,w,h) >= 128)
+    if rpixels.ndim == 2: rpixels = rpixels[:,:,numpy.newaxis]
+    if tpixels.ndim == 2: tpixels = tpixels[:,:,numpy.newaxis]
+    for pixels in (rpixels,tpixels):
+        if pixelio.has_alpha(pixels.shape[2]): valid &= pixels[...,-1] > 0
+    if valid.sum() < 64: return points
+    ncolor = min([p.shape[2]-1 if pixelio.has_alpha(p.shape[2]) else p.shape[2]
+                  for p in (rpixels,tpixels)])
+    rmean,rstd = colorspace.channel_statistics(rpixels[...,:ncolor],valid)
+    tmean,tstd = colorspace.channel_statistics(tpixels[...,:ncolor],valid)
+    channels = [min(c,ncolor-1) for c in range(3)]   # gray layers use one channel for all
+    for sign in (-1.0,0.0,1.0):
+        ts = [tmean[k]+sign*tstd[k] for k in channels]
+        rs = [rmean[k]+sign*rstd[k] for k in channels]
+        # the curves need the same number of points in each channel
+        if sign and min(tstd) < 1.0: continue
+        if min(ts) <= 0.0 or max(ts) >= 255.0: continue
+        for c in range(3):
+            points[c].extend([int(round(ts[c])),int(numpy.clip(round(rs[c]),0,255))])
+    return points
+
 def color_balance(stitchobj):
-    '''Balance the color between the two images at the control points.'''
+    '''Balance the color between the two images at the control points.
+
+       With numpy the colors of the whole overlap are matched too (see
+       overlap_color_points).'''
     ##if __debug__: print 'this is the color_balance function'
     if (not stitchobj.colorbalance or
         stitchobj.npoints < 2 or
@@ -1096,6 +1529,10 @@ def color_balance(stitchobj):
     red = [0,0,255,255]
     green = [0,0,255,255]
     blue = [0,0,255,255]
+    if numpy and stitchobj.rmask and stitchobj.tmask:
+        # the whole overlap first, so that it is kept when points are dropped
+        overlap = overlap_color_points(stitchobj)
+        red += overlap[0] ; green += overlap[1] ; blue += overlap[2]
     for i in range(len(colors)):
         c = colors[i]
         ##if __debug__: print 'color ',i,cbtests[i]
@@ -1148,13 +1585,265 @@ def copy_image_to_panorama_layer(panorama,image,imglayer,name):
     gimp.pdb.gimp_selection_none(panorama)
     return layer,mask
 
-def warp_image(stitchobj,progress=None,pbottom=None,ptop=None):
-    '''Warp the two images into a third, merged image.'''
-    
-    ##if __debug__: print 'This is warp_image.'
+def get_focal_length(stitchobj):
+    '''The focal length for projecting the images, in pixels.
+
+       The focal length set by the user, else estimated from the control
+       points, else the larger image dimension (about a 50 degree field
+       of view).'''
+    if stitchobj.focal_length: return float(stitchobj.focal_length)
+    rshape = (stitchobj.rimage.height,stitchobj.rimage.width)
+    tshape = (stitchobj.timage.height,stitchobj.timage.width)
+    rarray,tarray = stitchobj.arrays()
+    estimate = projection.estimate_focal_length([r[:2] for r in rarray],
+                                                [t[:2] for t in tarray],
+                                                rshape,tshape,stitchobj.projection)
+    if estimate: return estimate[0]
+    return float(max(rshape))
+
+def new_temporary_image(image,layer,pixels):
+    '''Make a temporary image like image holding an array of pixels with alpha.'''
+    height,width = pixels.shape[:2]
+    pimage = gimp.pdb.gimp_image_new(width,height,image.base_type)
+    gimp.pdb.gimp_image_undo_disable(pimage)
+    if image.base_type == RGB: layer_type = RGBA_IMAGE
+    else: layer_type = GRAYA_IMAGE
+    player = gimp.pdb.gimp_layer_new(pimage,width,height,layer_type,
+                                     layer.name,100,NORMAL_MODE)
+    gimp.pdb.gimp_image_add_layer(pimage,player,0)
+    pixelio.write(player,pixels)
+    return pimage,player
+
+def interpolation_kernel(interpolation):
+    '''The resample kernel for a gimp interpolation type.'''
+    return {INTERPOLATION_NONE:'nearest',
+            INTERPOLATION_LINEAR:'linear',
+            INTERPOLATION_CUBIC:'cubic',
+            INTERPOLATION_LANCZOS:'lanczos3'}.get(interpolation,'linear')
+
+def project_image(image,layer,focal,kind,kernel='linear'):
+    '''Make a temporary image holding a projection of an image layer.'''
+    return new_temporary_image(image,layer,projection.remap(pixelio.read(layer),focal,kind,kernel))
+
+def replace_images(stitchobj,rimage,rlayer,timage,tlayer,control_points):
+    '''Stitch temporary images and control points in place of the current ones.
+
+       The originals are kept the first time, so lens correction and
+       projection can both replace the images.  restore_images puts the
+       originals back.'''
+    if not stitchobj.originals:
+        stitchobj.originals = (stitchobj.rimage,stitchobj.rimglayer,
+                               stitchobj.timage,stitchobj.timglayer,
+                               stitchobj.control_points)
+    stitchobj.temp_images.extend([rimage,timage])
+    stitchobj.rimage,stitchobj.rimglayer = rimage,rlayer
+    stitchobj.timage,stitchobj.timglayer = timage,tlayer
+    stitchobj.set_control_points(control_points)
+
+def project_images(stitchobj):
+    '''Project both images and the control points onto a cylinder or sphere.
+
+       The rest of the stitching then runs on the projected images as
+       if they were the originals.'''
+    if not numpy or stitchobj.rimage.base_type == INDEXED or \
+       stitchobj.timage.base_type == INDEXED:
+        error_message('Warning: the '+stitchobj.projection+' projection needs numpy '+\
+                      'and RGB or gray images.  Stitching on a plane.',stitchobj.mode)
+        return
+    kind = stitchobj.projection
+    focal = get_focal_length(stitchobj)
+    stitchobj.projection_focal = focal
+    rshape = (stitchobj.rimage.height,stitchobj.rimage.width)
+    tshape = (stitchobj.timage.height,stitchobj.timage.width)
+    kernel = interpolation_kernel(stitchobj.interpolation)
+    rimage,rlayer = project_image(stitchobj.rimage,stitchobj.rimglayer,focal,kind,kernel)
+    timage,tlayer = project_image(stitchobj.timage,stitchobj.timglayer,focal,kind,kernel)
+    control_points = []
+    for cp in stitchobj.control_points:
+        x1,y1 = projection.to_projected(cp.x1(),cp.y1(),rshape,focal,kind)
+        x2,y2 = projection.to_projected(cp.x2(),cp.y2(),tshape,focal,kind)
+        control_points.append(control_point(x1,y1,x2,y2,cp.correlation,cp.cb()))
+    replace_images(stitchobj,rimage,rlayer,timage,tlayer,control_points)
+
+def get_lens_profiles():
+    '''The file of lens models saved by image size.'''
+    return os.path.join(gimp.directory,'stitch-lens.json')
+
+def get_lens_model(stitchobj):
+    '''The radial lens model for the two images, or None.
+
+       The model is fitted with the transform to the control points and
+       kept if it lowers their residuals, which are saved as the
+       profile for images of this size.  Otherwise it is the profile
+       saved from an earlier pair of the same size, taken with the same
+       camera and lens.'''
+    rshape = (stitchobj.rimage.height,stitchobj.rimage.width)
+    tshape = (stitchobj.timage.height,stitchobj.timage.width)
+    xerrors,yerrors = compute_control_point_xyerrors(stitchobj)
+    rms = math.sqrt(sum([x*x+y*y for x,y in zip(xerrors,yerrors)])/stitchobj.npoints)
+    rarray,tarray = stitchobj.arrays()
+    fit = lens.fit([r[:2] for r in rarray],[t[:2] for t in tarray],
+                   rshape,tshape,stitchobj.transform)
+    if fit and fit[2] < rms:
+        lens_model = fit[0]
+        if rshape == tshape:
+            try:
+                lens.save_profile(get_lens_profiles(),rshape,lens_model)
+            except (IOError,OSError):
+                pass
+        return lens_model
+    if rshape != tshape: return None
+    try:
+        return lens.load_profile(get_lens_profiles(),rshape)
+    except (IOError,OSError):
+        return None
 
-    # calculate the dimensions of the new image
-    
+def correct_lens(stitchobj):
+    '''Correct both images and the control points for radial lens distortion.
+
+       Returns True if the images were corrected.'''
+    if not numpy or stitchobj.rimage.base_type == INDEXED or \
+       stitchobj.timage.base_type == INDEXED:
+        error_message('Warning: the lens distortion model needs numpy '+\
+                      'and RGB or gray images.',stitchobj.mode)
+        return False
+    lens_model = get_lens_model(stitchobj)
+    if lens_model is None or lens_model.is_identity(): return False
+    rshape = (stitchobj.rimage.height,stitchobj.rimage.width)
+    tshape = (stitchobj.timage.height,stitchobj.timage.width)
+    kernel = interpolation_kernel(stitchobj.interpolation)
+    rimage,rlayer = new_temporary_image(stitchobj.rimage,stitchobj.rimglayer,
+                                        lens.remap(pixelio.read(stitchobj.rimglayer),lens_model,kernel))
+    timage,tlayer = new_temporary_image(stitchobj.timage,stitchobj.timglayer,
+                                        lens.remap(pixelio.read(stitchobj.timglayer),lens_model,kernel))
+    control_points = []
+    for cp in stitchobj.control_points:
+        x1,y1 = lens_model.undistort(cp.x1(),cp.y1(),rshape)
+        x2,y2 = lens_model.undistort(cp.x2(),cp.y2(),tshape)
+        control_points.append(control_point(float(x1),float(y1),float(x2),float(y2),
+                                            cp.correlation,cp.cb()))
+    replace_images(stitchobj,rimage,rlayer,timage,tlayer,control_points)
+    stitchobj.lens = lens_model
+    return True
+
+def restore_images(stitchobj):
+    '''Put back the images and control points replaced by replace_images
+       and delete the temporary images.'''
+    stitchobj.lens = None
+    stitchobj.projection_focal = None
+    if not stitchobj.originals: return
+    (stitchobj.rimage,stitchobj.rimglayer,
+     stitchobj.timage,stitchobj.timglayer,control_points) = stitchobj.originals
+    stitchobj.originals = None
+    stitchobj.set_control_points(control_points)
+    for img in stitchobj.temp_images: gimp.pdb.gimp_image_delete(img)
+    stitchobj.temp_images = []
+
+def canvas_to_image(transform,x0=0.0,y0=0.0):
+    '''Mapping of coordinates on the canvas, less x0,y0, to the image
+       placed on the canvas by transform (row vectors).'''
+    inverse = numpy.linalg.inv(numpy.array(transform,dtype=numpy.float64))
+    def mapping(x,y):
+        x = x + x0 ; y = y + y0
+        w = x*inverse[0][2] + y*inverse[1][2] + inverse[2][2]
+        return ((x*inverse[0][0] + y*inverse[1][0] + inverse[2][0])/w,
+                (x*inverse[0][1] + y*inverse[1][1] + inverse[2][1])/w)
+    return mapping
+
+def warp_layer_adaptive(stitchobj,tlayer,tmask,ttransform):
+    '''Warp the transformed image into tlayer and its coverage into tmask,
+       supersampling only the tiles where the warp shrinks detail.'''
+    x0,y0 = tlayer.offsets
+    pixels,report = render.render(pixelio.read(stitchobj.timglayer),
+                                  canvas_to_image(ttransform,x0,y0),
+                                  (tlayer.height,tlayer.width),
+                                  kernel=interpolation_kernel(stitchobj.interpolation))
+    pixelio.write(tlayer,pixels)
+    pixelio.write(tmask,pixels[...,-1])
+    stitchobj.supersample_report = report
+
+def make_rig_template(stitchobj):
+    '''A rig.template of the panorama just stitched.
+
+       Each panorama layer is mapped back through the canvas shift or
+       transform, the triangle warp of remove_distortion, the projection
+       and the lens correction to the original image, so a new image
+       pair from the same rig can be stitched by lookup alone.  Color
+       balance depends on the image content and is not part of it.'''
+    if stitchobj.originals:
+        rimage,timage = stitchobj.originals[0],stitchobj.originals[2]
+    else:
+        rimage,timage = stitchobj.rimage,stitchobj.timage
+    rshape = (rimage.height,rimage.width)
+    tshape = (timage.height,timage.width)
+    focal = stitchobj.projection_focal
+    kind = stitchobj.projection
+    lens_model = stitchobj.lens
+    def original(x,y,shape):
+        if focal: x,y = projection.from_projected(x,y,shape,focal,kind)
+        if lens_model: x,y = lens_model.distort(x,y,shape)
+        return x,y
+    def rmapping(x,y):
+        return original(x-stitchobj.rxy[0],y-stitchobj.rxy[1],rshape)
+    to_timage = canvas_to_image(stitchobj.canvas_transform)
+    def tmapping(x,y):
+        tx,ty = to_timage(x,y)
+        if stitchobj.warp_triangles:
+            dx,dy = rig.triangle_offsets(tx,ty,*stitchobj.warp_triangles)
+            tx,ty = tx+dx,ty+dy
+        return original(tx,ty,tshape)
+    template = rig.template(stitchobj.panorama.width,stitchobj.panorama.height,
+                            info={'transform':[list(row) for row in stitchobj.canvas_transform],
+                                  'projection':kind,'focal_length':focal,
+                                  'lens':lens_model.as_dict() if lens_model else None})
+    # copy_image_to_panorama_layer puts the transformed layer below the reference
+    for name,layer,mask,shape,mapping in \
+        (('transformed layer',stitchobj.tlayer,stitchobj.tmask,tshape,tmapping),
+         ('reference layer',stitchobj.rlayer,stitchobj.rmask,rshape,rmapping)):
+        box = tuple(layer.offsets) + (layer.width,layer.height)
+        if mask is not None: mask = pixelio.read(mask)
+        template.add(rig.capture_layer(name,box,shape,mapping,mask))
+    return template
+
+def save_rig_template(stitchobj):
+    '''Save the rig template of the panorama just stitched.'''
+    try:
+        make_rig_template(stitchobj).save(stitchobj.rig_template)
+    except (IOError,OSError):
+        error_message('Warning: could not save the rig template:\n'+
+                      str(sys.exc_value),stitchobj.mode)
+
+def stitch_with_rig_template(stitchobj,template):
+    '''Stitch the panorama by the remap grids of a rig template.'''
+    if stitchobj.rimage.base_type == INDEXED or stitchobj.timage.base_type == INDEXED:
+        error_message('Error: rig templates need RGB or gray images.',stitchobj.mode)
+        return
+    try:
+        layers = template.render([pixelio.read(stitchobj.timglayer),
+                                  pixelio.read(stitchobj.rimglayer)],
+                                 interpolation_kernel(stitchobj.interpolation))
+    except ValueError:
+        error_message('Error: '+str(sys.exc_value)+'.',stitchobj.mode)
+        return
+    panorama = gimp.pdb.gimp_image_new(template.width,template.height,
+                                       stitchobj.rimage.base_type)
+    gimp.pdb.gimp_image_undo_disable(panorama)
+    if stitchobj.rimage.base_type == RGB: layer_type = RGBA_IMAGE
+    else: layer_type = GRAYA_IMAGE
+    for l,((x,y,width,height),pixels) in zip(template.layers,layers):
+        layer = gimp.pdb.gimp_layer_new(panorama,width,height,layer_type,
+                                        l.name,100,NORMAL_MODE)
+        gimp.pdb.gimp_image_add_layer(panorama,layer,0)   # on top of the last one
+        gimp.pdb.gimp_layer_set_offsets(layer,x,y)
+        pixelio.write(layer,pixels)
+    gimp.pdb.gimp_image_undo_enable(panorama)
+    stitchobj.panorama = panorama
+    gimp.pdb.gimp_display_new(panorama)
+
+def panorama_bounds(stitchobj):
+    '''The size nx,ny of the panorama, the shift xshift,yshift of the
+       reference image into it and the corners t00,t10,t01,t11 of the
+       transformed image before the shift.'''
     rnx = stitchobj.rimage.width   # the dimensions of the old image
     rny = stitchobj.rimage.height
     tnx = stitchobj.timage.width
@@ -1170,14 +1859,18 @@ def warp_image(stitchobj,progress=None,pbottom=None,ptop=None):
     y1 = int(round(max(t00[1],t10[1],t01[1],t11[1],rny)))
     # xshift and yshift are the overall shift required to
     # just fit the new layers into the new image.
-    xshift = -x0
-    yshift = -y0
-    x0 += xshift
-    x1 += xshift
-    y0 += yshift
-    y1 += yshift
-    nx = x1-x0
-    ny = y1-y0
+    return x1-x0,y1-y0,-x0,-y0,(t00,t10,t01,t11)
+
+def warp_image(stitchobj,progress=None,pbottom=None,ptop=None):
+    '''Warp the two images into a third, merged image.'''
+    
+    ##if __debug__: print 'This is warp_image.'
+
+    # calculate the dimensions of the new image
+    
+    rnx = stitchobj.rimage.width   # the dimensions of the old image
+    rny = stitchobj.rimage.height
+    nx,ny,xshift,yshift,(t00,t10,t01,t11) = panorama_bounds(stitchobj)
     ##if __debug__: print 'x0,y0,x1,y1,nx,ny,xshift,yshift',x0,y0,x1,y1,nx,ny,xshift,yshift
     ##if __debug__: print 'interp,super,recursion,clip',stitchobj.interpolation, \
     ##                     stitchobj.supersample,stitchobj.recursion_level, \
@@ -1188,7 +1881,8 @@ def warp_image(stitchobj,progress=None,pbottom=None,ptop=None):
     rtransform = [[1.0,0.0,0.0],
                   [0.0,1.0,0.0],
                   [xshift,yshift,1.0]]
-    ttransform = stitchobj.transform
+    ttransform = [list(row) for row in stitchobj.transform]
+    stitchobj.canvas_transform = ttransform
     ttransform[2][0] += xshift
     ttransform[2][1] += yshift
 
@@ -1222,25 +1916,35 @@ def warp_image(stitchobj,progress=None,pbottom=None,ptop=None):
     ##if __debug__: print 'warping transformed layer: ',ttransform
     #gimp.pdb.gimp_progress_init('Warping Transformed Layers',-1)
     gimp.pdb.gimp_displays_flush()
-    for tdrawable in (tlayer,tmask):
-        # warp the transformed layer and mask
-        gimp.pdb.gimp_drawable_transform_matrix(tdrawable,
-                                                ttransform[0][0],ttransform[1][0],ttransform[2][0],
-                                                ttransform[0][1],ttransform[1][1],ttransform[2][1],
-                                                ttransform[0][2],ttransform[1][2],ttransform[2][2],
-                                                TRANSFORM_FORWARD,
-                                                stitchobj.interpolation,
-                                                stitchobj.supersample,
-                                                stitchobj.recursion_level,
-                                                stitchobj.clip_result)
-
-    # Resize the layers to circumscribe the transformed images
-    gimp.pdb.gimp_layer_resize(rlayer,rnx,rny,-xshift,-yshift)
     tx0 = int(round(min(t00[0]+xshift,t10[0]+xshift,t01[0]+xshift,t11[0]+xshift)))
     ty0 = int(round(min(t00[1]+yshift,t10[1]+yshift,t01[1]+yshift,t11[1]+yshift)))
     tx1 = int(round(max(t00[0]+xshift,t10[0]+xshift,t01[0]+xshift,t11[0]+xshift)))
     ty1 = int(round(max(t00[1]+yshift,t10[1]+yshift,t01[1]+yshift,t11[1]+yshift)))
-    gimp.pdb.gimp_layer_resize(tlayer,tx1-tx0,ty1-ty0,-tx0,-ty0)    
+    if stitchobj.supersample and stitchobj.adaptive_supersample and numpy and \
+       stitchobj.timage.base_type != INDEXED:
+        # the layer is cut to the transformed image first and drawn into
+        gimp.pdb.gimp_layer_resize(tlayer,tx1-tx0,ty1-ty0,-tx0,-ty0)
+        with trace.span('adaptive supersample') as span:
+            warp_layer_adaptive(stitchobj,tlayer,tmask,ttransform)
+            span.annotate(map=stitchobj.supersample_report.map(),
+                          **stitchobj.supersample_report.totals())
+    else:
+        stitchobj.supersample_report = None
+        for tdrawable in (tlayer,tmask):
+            # warp the transformed layer and mask
+            gimp.pdb.gimp_drawable_transform_matrix(tdrawable,
+                                                    ttransform[0][0],ttransform[1][0],ttransform[2][0],
+                                                    ttransform[0][1],ttransform[1][1],ttransform[2][1],
+                                                    ttransform[0][2],ttransform[1][2],ttransform[2][2],
+                                                    TRANSFORM_FORWARD,
+                                                    stitchobj.interpolation,
+                                                    stitchobj.supersample,
+                                                    stitchobj.recursion_level,
+                                                    stitchobj.clip_result)
+        gimp.pdb.gimp_layer_resize(tlayer,tx1-tx0,ty1-ty0,-tx0,-ty0)
+
+    # Resize the reference layer to circumscribe its image
+    gimp.pdb.gimp_layer_resize(rlayer,rnx,rny,-xshift,-yshift)
     update_progress_bar(progress,'Warping Images',ptop)
 
     stitchobj.rlayer = rlayer
@@ -1250,6 +1954,74 @@ def warp_image(stitchobj,progress=None,pbottom=None,ptop=None):
     stitchobj.rxy = [xshift,yshift,xshift+rnx,yshift+rny]
     stitchobj.txy = [tx0,ty0,tx1,ty1]
 
+def read_layer_pixels(stitchobj,drawable):
+    '''The pixels of a drawable as an array, or as a tilestore.store if
+       they would take more memory than stitchobj.tile_budget.'''
+    budget = stitchobj.tile_budget*2**20
+    if drawable.width*drawable.height*drawable.bpp <= budget: return pixelio.read(drawable)
+    return tilestore.from_drawable(drawable,ram_budget=budget)
+
+def stitch_to_tiff(stitchobj,progress=None,pbottom=None,ptop=None):
+    '''Write the panorama to stitchobj.output_file a tile at a time.
+
+       The layers are warped and blended tile by tile as they are
+       written, so the full size panorama is never made as a gimp image.
+       stitchobj.panorama becomes a downsampled proxy of it to preview.
+       The blend is the feather; color balance works on panorama layers
+       and is left out.  Returns False if the file could not be written.'''
+    if stitchobj.rimage.base_type == INDEXED or stitchobj.timage.base_type == INDEXED:
+        error_message('Error: writing a TIFF needs RGB or gray images.',stitchobj.mode)
+        return False
+    rnx = stitchobj.rimage.width
+    rny = stitchobj.rimage.height
+    nx,ny,xshift,yshift,(t00,t10,t01,t11) = panorama_bounds(stitchobj)
+    ttransform = [list(row) for row in stitchobj.transform]
+    ttransform[2][0] += xshift
+    ttransform[2][1] += yshift
+    stitchobj.canvas_transform = ttransform
+    routline = [(xshift,yshift),(xshift+rnx,yshift),(xshift+rnx,yshift+rny),(xshift,yshift+rny)]
+    toutline = [(x+xshift,y+yshift) for x,y in (t00,t10,t11,t01)]
+    kernel = interpolation_kernel(stitchobj.interpolation)
+    rpixels = read_layer_pixels(stitchobj,stitchobj.rimglayer)
+    tpixels = read_layer_pixels(stitchobj,stitchobj.timglayer)
+    reference = mosaic.layer(rpixels,routline,offset=(xshift,yshift))
+    transformed = mosaic.layer(tpixels,toutline,
+                               mapping=canvas_to_image(ttransform),kernel=kernel,
+                               supersample=bool(stitchobj.supersample and
+                                                stitchobj.adaptive_supersample))
+    # feather over blend_fraction of the narrow side of the overlap, as feather_layer_masks
+    feather = 1.0
+    if stitchobj.blend:
+        ox0 = max(xshift,min([x for x,y in toutline]))
+        oy0 = max(yshift,min([y for x,y in toutline]))
+        ox1 = min(xshift+rnx,max([x for x,y in toutline]))
+        oy1 = min(yshift+rny,max([y for x,y in toutline]))
+        if ox1 > ox0 and oy1 > oy0:
+            feather = max(stitchobj.blend_fraction*min(ox1-ox0,oy1-oy0),1.0)
+    def tiles_written(done,total):
+        if progress and (done % 16 == 0 or done == total):
+            update_progress_bar(progress,'Writing Panorama',
+                                pbottom+(ptop-pbottom)*done/float(total))
+    try:
+        proxy = mosaic.write_panorama(stitchobj.output_file,nx,ny,reference,transformed,
+                                      feather,progress=tiles_written)
+    except (IOError,OSError):
+        error_message('Error: could not write '+stitchobj.output_file+':\n'+
+                      str(sys.exc_value),stitchobj.mode)
+        return False
+    finally:
+        for pixels in (rpixels,tpixels):
+            if isinstance(pixels,tilestore.store): pixels.close()
+    if proxy.shape[2] == 4: ptype,layer_type = RGB,RGBA_IMAGE
+    else: ptype,layer_type = GRAY,GRAYA_IMAGE
+    stitchobj.panorama = gimp.pdb.gimp_image_new(proxy.shape[1],proxy.shape[0],ptype)
+    gimp.pdb.gimp_image_undo_disable(stitchobj.panorama)
+    layer = gimp.pdb.gimp_layer_new(stitchobj.panorama,proxy.shape[1],proxy.shape[0],
+                                    layer_type,'panorama preview',100,NORMAL_MODE)
+    gimp.pdb.gimp_image_add_layer(stitchobj.panorama,layer,0)
+    pixelio.write(layer,proxy)
+    return True
+
 def gradient_layer_mask(stitchobj,sprog,eprog):
     '''Add a gradient layer mask to gently blend the edges of the panorama.'''
 
@@ -1472,12 +2244,114 @@ def gradient_layer_mask(stitchobj,sprog,eprog):
     gimp.pdb.gimp_displays_flush()
 
 
+def feather_layer_mask(stitchobj,sprog,eprog):
+    '''Blend the edges of the panorama with a distance transform feather.
+
+    Unlike gradient_layer_mask, this follows the actual outline of the
+    warped layers, so rotated or distorted layers get a clean seam.'''
+
+    if not stitchobj.blend: return
+    if not stitchobj.rmask or not stitchobj.tmask:
+        error_message('Error: cannot blend layers.',stitchobj.mode)
+        return
+    update_progress_bar(stitchobj.progressbar,'Blending Images',sprog)
+    if not blend.feather_layer_masks(stitchobj.rlayer,stitchobj.rmask,
+                                     stitchobj.tlayer,stitchobj.tmask,
+                                     stitchobj.blend_fraction):
+        error_message('Warning: the images do not overlap.',stitchobj.mode)
+    update_progress_bar(stitchobj.progressbar,'Blending Images',eprog)
+    gimp.pdb.gimp_displays_flush()
+
+def seam_layer_mask(stitchobj,sprog,eprog):
+    '''Cut the overlap of the panorama along a minimum cost seam.
+
+    Each pixel in the overlap comes from only one of the images, so
+    objects which moved between the exposures do not ghost.'''
+
+    if not stitchobj.blend: return
+    if not stitchobj.rmask or not stitchobj.tmask:
+        error_message('Error: cannot blend layers.',stitchobj.mode)
+        return
+    update_progress_bar(stitchobj.progressbar,'Finding Seam',sprog)
+    if not blend.seam_layer_masks(stitchobj.rlayer,stitchobj.rmask,
+                                  stitchobj.tlayer,stitchobj.tmask,
+                                  stitchobj.seam_feather):
+        error_message('Warning: the images do not overlap.',stitchobj.mode)
+    update_progress_bar(stitchobj.progressbar,'Finding Seam',eprog)
+    gimp.pdb.gimp_displays_flush()
+
+def blend_layer_masks(stitchobj,sprog,eprog):
+    '''Blend the edges of the panorama with the selected blend method.'''
+    if stitchobj.blend_method == 'feather' and numpy:
+        feather_layer_mask(stitchobj,sprog,eprog)
+    elif stitchobj.blend_method == 'seam' and numpy:
+        seam_layer_mask(stitchobj,sprog,eprog)
+    else:
+        gradient_layer_mask(stitchobj,sprog,eprog)
+
+def draw_marker_layer(image,layer,markers,points):
+    '''Draw the markers for points into a layer sized to their bounding box.
+
+       The layer is (re)made when it does not cover the markers, else
+       only the areas around changed points are redrawn.  Returns the
+       layer, or None if there are no points.'''
+    box = markers.bounds(points,image.width,image.height)
+    if layer and not markers.covers(box):
+        gimp.pdb.gimp_image_remove_layer(image,layer)
+        layer = None
+        markers.reset()
+    if box is None: return None
+    if not layer:
+        if image.base_type == RGB: layer_type = RGBA_IMAGE
+        else: layer_type = GRAYA_IMAGE
+        layer = gimp.pdb.gimp_layer_new(image,                  # image
+                                        box[2]-box[0],          # width
+                                        box[3]-box[1],          # height
+                                        layer_type,             # type
+                                        'Control Points',       # name
+                                        100,                    # opacity
+                                        NORMAL_MODE             # layer combination mode
+                                        )
+        gimp.pdb.gimp_image_add_layer(image,layer,0)
+        layer.set_offsets(box[0],box[1])
+        markers.rect = box
+        rects = [box]
+    else:
+        rects = markers.dirty(points)
+    if image.base_type == RGB: color = (255,0,0)
+    else: color = (76,)   # the gray value of red
+    lx,ly = markers.rect[0],markers.rect[1]
+    for x0,y0,x1,y1 in rects:
+        pixels = overlay.to_pixels(markers.render(points,(x0,y0,x1,y1)),color)
+        pixelio.write(layer,pixels,x0-lx,y0-ly,update=False)
+    layer.flush()
+    for x0,y0,x1,y1 in rects:
+        layer.update(x0-lx,y0-ly,x1-x0,y1-y0)
+    markers.points = list(points)
+    return layer
+
+def draw_control_point_overlay(stitchobj):
+    '''Draw the control point markers with gimplib.overlay.'''
+    if not stitchobj.roverlay: stitchobj.roverlay = overlay.marker_overlay()
+    if not stitchobj.toverlay: stitchobj.toverlay = overlay.marker_overlay()
+    cps = stitchobj.control_points or []
+    stitchobj.rcplayer = draw_marker_layer(stitchobj.rimage,stitchobj.rcplayer,stitchobj.roverlay,
+                                           [(cp.x1(),cp.y1()) for cp in cps])
+    stitchobj.tcplayer = draw_marker_layer(stitchobj.timage,stitchobj.tcplayer,stitchobj.toverlay,
+                                           [(cp.x2(),cp.y2()) for cp in cps])
+    gimp.pdb.gimp_displays_flush()
+
 def draw_control_points(stitchobj):
     '''Draw circles around the control points to indicate their locations.'''
 
     ##if __debug__: print 'This is draw_control_points.'
 
     if not stitchobj.control_points and not stitchobj.rcplayer and not stitchobj.tcplayer: return
+
+    if numpy and stitchobj.rimage.base_type != INDEXED and \
+           stitchobj.timage.base_type != INDEXED:
+        draw_control_point_overlay(stitchobj)
+        return
     
     if not stitchobj.rcplayer:
         stitchobj.rcplayer = gimp.pdb.gimp_layer_new(stitchobj.rimage,              # image
@@ -1663,105 +2537,15 @@ def draw_control_points(stitchobj):
 ##     return False
 
 
-def get_triangle_center(x1,y1,x2,y2,x3,y3):
-    '''Find center of the circle that circumscribes a triangle.'''
-    # The center of the circumscribing circle is at the intersection
-    # of the perpendicular bisectors of the edges.
-    # get bisector 1
-    mx1 = (x2+x3)/2.0
-    my1 = (y2+y3)/2.0
-    if my1 != y2:
-        b1 = -(mx1-x2)/(my1-y2) # slope
-        a1 = my1 - b1*mx1
-        vertical1 = False
-    else:
-        vertical1 = True
-    # get bisector 2
-    mx2 = (x1+x3)/2.0
-    my2 = (y1+y3)/2.0
-    if my2 != y3:
-        b2 = -(mx2-x3)/(my2-y3) # slope
-        a2 = my2 - b2*mx2
-        vertical2 = False
-    else:
-        vertical2 = True
-    # get bisector 3
-    mx3 = (x1+x2)/2.0
-    my3 = (y1+y2)/2.0
-    if my3 != y2:
-        b3 = -(mx3-x2)/(my3-y2) # slope
-        a3 = my3 - b3*mx3
-        vertical3 = False
-    else:
-        vertical3 = True
-    # these should all give the same answer
-    if not vertical1 and not vertical2 and b2!=b1:
-        xcenter = (a1-a2)/(b2-b1)
-        ycenter = a1+b1*xcenter
-    if not vertical1 and not vertical3 and b3!=b1:
-        xcenter = (a1-a3)/(b3-b1)
-        ycenter = a1+b1*xcenter
-    if not vertical3 and not vertical2 and b2!=b3:
-        xcenter = (a3-a2)/(b2-b3)
-        ycenter = a3+b3*xcenter
-    return (xcenter,ycenter)
-        
-def is_delaunay_triangle(tarr,i,j,k):
-    '''Check if a triangle is a Delaunay triangle.'''
-    
-    # The Delaunay triangulation is defined as the set of triangles
-    # whose circumscribing circles are otherwise empty.  So, find
-    # the circumcirce and check if it is empty.  Return True if this
-    # is a Delaunay triangle.
-    
-    npoints = len(tarr)
-    xcenter,ycenter = get_triangle_center(tarr[i][0],tarr[i][1],
-                                          tarr[j][0],tarr[j][1],
-                                          tarr[k][0],tarr[k][1])
-    # these radii should all be the same.
-    radius = min([math.sqrt((xcenter-tarr[i][0])**2 + (ycenter-tarr[i][1])**2),
-                  math.sqrt((xcenter-tarr[j][0])**2 + (ycenter-tarr[j][1])**2),
-                  math.sqrt((xcenter-tarr[k][0])**2 + (ycenter-tarr[k][1])**2)])
-##     if __debug__:
-##         print 'triangle, check same', \
-##               math.sqrt((xcenter-tarr[i][0])**2 + (ycenter-tarr[i][1])**2),\
-##               math.sqrt((xcenter-tarr[j][0])**2 + (ycenter-tarr[j][1])**2),\
-##               math.sqrt((xcenter-tarr[k][0])**2 + (ycenter-tarr[k][1])**2)
-    for p in range(npoints):
-        if p != i and p != j and p != k:
-            # Check if there is a point inside the cicumscribing circle.
-            x = tarr[p][0]
-            y = tarr[p][1]
-            distance = math.sqrt((xcenter-x)**2 + (ycenter-y)**2)
-            if distance < radius: return False
-    return True
-    
 def triangulate(tarr):
-    '''Split the area covered by tarr into simple triangles.'''
-
-    npoints = len(tarr)
-    ntriangles = 0
-    # find all the triangles
-    for i in range(npoints):
-        for j in range(npoints):
-            if j > i:
-                for k in range(npoints):
-                    if k > i and k > j:
-                        dt = is_delaunay_triangle(tarr,i,j,k)
-                        if dt:
-                            if ntriangles == 0:
-                                triangles = [[i,j,k]]
-                            else:
-                                triangles.append([i,j,k])
-                            ntriangles += 1
-                        ##if __debug__:
-                        ##    if dt: print i,j,k,' is Delaunay.'
-##     if __debug__:
-##         print 'Triangulate: ',ntriangles,' triangles'
-##         widget=MessageWidget('Debug: press ok to continue.')
-##         widget.main()                    
-        
-    return triangles
+    '''Split the area covered by tarr into simple triangles.
+
+       Returns the Delaunay triangles as [i,j,k] index lists, i < j < k.
+       A point repeated in tarr is used at its first index.'''
+    mesh = delaunay.triangulation()
+    index = {}
+    for i,v in enumerate(mesh.sync([t[:2] for t in tarr])): index.setdefault(v,i)
+    return sorted([sorted([index[v] for v in t]) for t in mesh.triangles()])
 
 
 def remove_distortion(stitchobj,progress=None,pbottom=None,ptop=None):
@@ -1809,82 +2593,87 @@ def remove_distortion(stitchobj,progress=None,pbottom=None,ptop=None):
             yerr.append(0.0)
             yerr.append(0.0)
             yerr.append(0.0)
-            triangles = triangulate(tarr) # Get Delaunay triangulation
+            with trace.span('triangulate',npoints=len(tarr)):
+                triangles = stitchobj.mesh_triangles() # Get Delaunay triangulation
+            stitchobj.warp_triangles = (triangles,
+                                        [[t[0]-dx,t[1]-dy] for t,dx,dy in zip(tarr,xerr,yerr)],
+                                        [t[:2] for t in tarr])
             #gimp.pdb.gimp_progress_init('Removing distortion',-1)
             ntriangles = len(triangles)
             for i in range(ntriangles):
-                ss0 = triangles[i][0]
-                ss1 = triangles[i][1]
-                ss2 = triangles[i][2]
-                ##if __debug__: print tarr[ss0][0],tarr[ss0][1],tarr[ss1][0],tarr[ss1][1],tarr[ss2][0],tarr[ss2][1]
-                ##if __debug__: print ss0,ss1,ss2,xerr[ss0],yerr[ss0],xerr[ss1],yerr[ss1],xerr[ss2],yerr[ss2]
-                # get warping for triangle
-                rnew = [[tarr[ss0][0]-xerr[ss0],tarr[ss0][1]-yerr[ss0]],
-                        [tarr[ss1][0]-xerr[ss1],tarr[ss1][1]-yerr[ss1]],
-                        [tarr[ss2][0]-xerr[ss2],tarr[ss2][1]-yerr[ss2]]]
-                rtri = [[tarr[ss0][0]-xerr[ss0],tarr[ss0][1]-yerr[ss0],1.0],
-                        [tarr[ss1][0]-xerr[ss1],tarr[ss1][1]-yerr[ss1],1.0],
-                        [tarr[ss2][0]-xerr[ss2],tarr[ss2][1]-yerr[ss2],1.0]]
-                ttri = [[tarr[ss0][0],          tarr[ss0][1],          1.0],
-                        [tarr[ss1][0],          tarr[ss1][1],          1.0],
-                        [tarr[ss2][0],          tarr[ss2][1],          1.0]]
-                transform = compute_transform_matrix(rtri,ttri)
-                # warp image
-                # select only the required area for transformation - more efficient
-                # than transforming the whole image.
-                maxerr = max([abs(xerr[ss0]),abs(xerr[ss1]),abs(xerr[ss2]),
-                              abs(yerr[ss0]),abs(yerr[ss1]),abs(yerr[ss2])])*2.0+5.0
-                x0 = max([min([rnew[0][0],rnew[1][0],rnew[2][0]])-maxerr,0.0])
-                y0 = max([min([rnew[0][1],rnew[1][1],rnew[2][1]])-maxerr,0.0])
-                x1 = min([max([rnew[0][0],rnew[1][0],rnew[2][0]])+maxerr,stitchobj.dimage.width-1])
-                y1 = min([max([rnew[0][1],rnew[1][1],rnew[2][1]])+maxerr,stitchobj.dimage.height-1])
-                gimp.pdb.gimp_selection_none(stitchobj.dimage)
-                gimp.pdb.gimp_rect_select(stitchobj.dimage,  # image
-                                          x0,       # x
-                                          y0,       # y
-                                          x1-x0+1,  # width
-                                          y1-y0+1,  # height
-                                          2,        # replace
-                                          0,        # feather
-                                          0.)       # radius
-                gimp.pdb.gimp_drawable_transform_matrix(tlayer,
-                                                transform[0][0],transform[1][0],transform[2][0],
-                                                transform[0][1],transform[1][1],transform[2][1],
-                                                transform[0][2],transform[1][2],transform[2][2],
-                                                TRANSFORM_FORWARD,
-                                                stitchobj.interpolation,
-                                                stitchobj.supersample,
-                                                stitchobj.recursion_level,
-                                                stitchobj.clip_result)
-                flayer = gimp.pdb.gimp_image_get_floating_sel(stitchobj.dimage)
-                gimp.pdb.gimp_floating_sel_anchor(flayer)
-                # select triangle
-                for j in range(len(rtri)):   # make sure the indices are in range
-                    if rnew[j][0] < 0.0: rnew[j][0] = 0.0
-                    if rnew[j][0] > dlayer.width-1: rnew[j][0] = dlayer.width-1
-                    if rnew[j][1] < 0.0: rnew[j][1] = 0.0
-                    if rnew[j][1] > dlayer.height-1: rnew[j][1] = dlayer.height-1
-                gimp.pdb.gimp_selection_none(stitchobj.dimage)
-                gimp.pdb.gimp_free_select(stitchobj.dimage,    # image
-                                          6,                   # n points
-                                          [rnew[0][0],rnew[0][1],
-                                           rnew[1][0],rnew[1][1],
-                                           rnew[2][0],rnew[2][1]],   # point list
-                                          2,                   # replace
-                                          1,                   # antialias
-                                          1,                   # feather
-                                          2.0)                 # feather radius
-                # insert triangle into undistorted image (dlayer)
-                gimp.pdb.gimp_edit_copy(tlayer)
-                gimp.pdb.gimp_floating_sel_anchor(gimp.pdb.gimp_edit_paste(dlayer,0))
-                gimp.pdb.gimp_selection_none(stitchobj.dimage)
-                # reset temporary layer for next transform
-                tpixels[0:tlayer.width, 0:tlayer.height] = tpsave
-                #gimp.pdb.gimp_progress_update(float(i+1.0)/ntriangles)
-                if progress:
-                    update_progress_bar(progress,
-                                        'Removing Distortion',
-                                        pbottom+(ptop-pbottom)*((i+1.0)/ntriangles))
+                with trace.span('triangle',index=i):
+                    ss0 = triangles[i][0]
+                    ss1 = triangles[i][1]
+                    ss2 = triangles[i][2]
+                    ##if __debug__: print tarr[ss0][0],tarr[ss0][1],tarr[ss1][0],tarr[ss1][1],tarr[ss2][0],tarr[ss2][1]
+                    ##if __debug__: print ss0,ss1,ss2,xerr[ss0],yerr[ss0],xerr[ss1],yerr[ss1],xerr[ss2],yerr[ss2]
+                    # get warping for triangle
+                    rnew = [[tarr[ss0][0]-xerr[ss0],tarr[ss0][1]-yerr[ss0]],
+                            [tarr[ss1][0]-xerr[ss1],tarr[ss1][1]-yerr[ss1]],
+                            [tarr[ss2][0]-xerr[ss2],tarr[ss2][1]-yerr[ss2]]]
+                    rtri = [[tarr[ss0][0]-xerr[ss0],tarr[ss0][1]-yerr[ss0],1.0],
+                            [tarr[ss1][0]-xerr[ss1],tarr[ss1][1]-yerr[ss1],1.0],
+                            [tarr[ss2][0]-xerr[ss2],tarr[ss2][1]-yerr[ss2],1.0]]
+                    ttri = [[tarr[ss0][0],          tarr[ss0][1],          1.0],
+                            [tarr[ss1][0],          tarr[ss1][1],          1.0],
+                            [tarr[ss2][0],          tarr[ss2][1],          1.0]]
+                    transform = compute_transform_matrix(rtri,ttri)
+                    # warp image
+                    # select only the required area for transformation - more efficient
+                    # than transforming the whole image.
+                    maxerr = max([abs(xerr[ss0]),abs(xerr[ss1]),abs(xerr[ss2]),
+                                  abs(yerr[ss0]),abs(yerr[ss1]),abs(yerr[ss2])])*2.0+5.0
+                    x0 = max([min([rnew[0][0],rnew[1][0],rnew[2][0]])-maxerr,0.0])
+                    y0 = max([min([rnew[0][1],rnew[1][1],rnew[2][1]])-maxerr,0.0])
+                    x1 = min([max([rnew[0][0],rnew[1][0],rnew[2][0]])+maxerr,stitchobj.dimage.width-1])
+                    y1 = min([max([rnew[0][1],rnew[1][1],rnew[2][1]])+maxerr,stitchobj.dimage.height-1])
+                    gimp.pdb.gimp_selection_none(stitchobj.dimage)
+                    gimp.pdb.gimp_rect_select(stitchobj.dimage,  # image
+                                              x0,       # x
+                                              y0,       # y
+                                              x1-x0+1,  # width
+                                              y1-y0+1,  # height
+                                              2,        # replace
+                                              0,        # feather
+                                              0.)       # radius
+                    gimp.pdb.gimp_drawable_transform_matrix(tlayer,
+                                                    transform[0][0],transform[1][0],transform[2][0],
+                                                    transform[0][1],transform[1][1],transform[2][1],
+                                                    transform[0][2],transform[1][2],transform[2][2],
+                                                    TRANSFORM_FORWARD,
+                                                    stitchobj.interpolation,
+                                                    stitchobj.supersample,
+                                                    stitchobj.recursion_level,
+                                                    stitchobj.clip_result)
+                    flayer = gimp.pdb.gimp_image_get_floating_sel(stitchobj.dimage)
+                    gimp.pdb.gimp_floating_sel_anchor(flayer)
+                    # select triangle
+                    for j in range(len(rtri)):   # make sure the indices are in range
+                        if rnew[j][0] < 0.0: rnew[j][0] = 0.0
+                        if rnew[j][0] > dlayer.width-1: rnew[j][0] = dlayer.width-1
+                        if rnew[j][1] < 0.0: rnew[j][1] = 0.0
+                        if rnew[j][1] > dlayer.height-1: rnew[j][1] = dlayer.height-1
+                    gimp.pdb.gimp_selection_none(stitchobj.dimage)
+                    gimp.pdb.gimp_free_select(stitchobj.dimage,    # image
+                                              6,                   # n points
+                                              [rnew[0][0],rnew[0][1],
+                                               rnew[1][0],rnew[1][1],
+                                               rnew[2][0],rnew[2][1]],   # point list
+                                              2,                   # replace
+                                              1,                   # antialias
+                                              1,                   # feather
+                                              2.0)                 # feather radius
+                    # insert triangle into undistorted image (dlayer)
+                    gimp.pdb.gimp_edit_copy(tlayer)
+                    gimp.pdb.gimp_floating_sel_anchor(gimp.pdb.gimp_edit_paste(dlayer,0))
+                    gimp.pdb.gimp_selection_none(stitchobj.dimage)
+                    # reset temporary layer for next transform
+                    tpixels[0:tlayer.width, 0:tlayer.height] = tpsave
+                    #gimp.pdb.gimp_progress_update(float(i+1.0)/ntriangles)
+                    if progress:
+                        update_progress_bar(progress,
+                                            'Removing Distortion',
+                                            pbottom+(ptop-pbottom)*((i+1.0)/ntriangles))
 
             # set the transformed layer to the distortion free layer.  Hence the
             # undistorted layer will be used from now on as the transformed
@@ -1916,20 +2705,52 @@ def go_stitch_panorama(stitchobj):
         if stitchobj.tcplayer:
             gimp.pdb.gimp_image_remove_layer(stitchobj.timage,stitchobj.tcplayer)
             stitchobj.tcplayer = None
+        stitchobj.roverlay = None
+        stitchobj.toverlay = None
         update_image_layers(stitchobj.rimage)
         update_image_layers(stitchobj.timage)
         gimp.pdb.gimp_displays_flush()
 
-        update_progress_bar(stitchobj.progressbar,'Removing Distortion',0.00)
-        remove_distortion(stitchobj,stitchobj.progressbar,0.,0.25) # remove non-linear distortion
-        update_progress_bar(stitchobj.progressbar,'Warping Images',0.25)
-        warp_image(stitchobj,stitchobj.progressbar,0.25,0.50)  # warp the second image onto the first.
-        update_progress_bar(stitchobj.progressbar,'Balancing Color',0.50)
-        color_balance(stitchobj)  # balance color between the two images.
-        update_progress_bar(stitchobj.progressbar,'Blending Images',0.75)
-        gradient_layer_mask(stitchobj,0.75,0.99)  # add a gradient layer mask to merge the edges.
+        # lens correction and projection replace the images and control
+        # points with temporary ones, which are put back even if the
+        # stitch fails, so that stitching again starts from the originals
+        try:
+            corrected = False
+            if stitchobj.rmdistortion and stitchobj.distortion_model == 'lens':
+                update_progress_bar(stitchobj.progressbar,'Correcting Lens Distortion',0.00)
+                with trace.span('correct lens'):
+                    corrected = correct_lens(stitchobj)
+            if stitchobj.projection != 'planar':
+                update_progress_bar(stitchobj.progressbar,'Projecting Images',0.00)
+                with trace.span('project images',projection=stitchobj.projection):
+                    project_images(stitchobj)
+            if not corrected:
+                update_progress_bar(stitchobj.progressbar,'Removing Distortion',0.00)
+                with trace.span('remove distortion'):
+                    remove_distortion(stitchobj,stitchobj.progressbar,0.,0.25) # remove non-linear distortion
+            if stitchobj.output_file and numpy:
+                # straight to a tiled TIFF, only a proxy is made in gimp
+                update_progress_bar(stitchobj.progressbar,'Writing Panorama',0.25)
+                with trace.span('write tiff'):
+                    stitch_to_tiff(stitchobj,stitchobj.progressbar,0.25,0.99)
+            else:
+                update_progress_bar(stitchobj.progressbar,'Warping Images',0.25)
+                with trace.span('warp image'):
+                    warp_image(stitchobj,stitchobj.progressbar,0.25,0.50)  # warp the second image onto the first.
+                update_progress_bar(stitchobj.progressbar,'Balancing Color',0.50)
+                with trace.span('color balance'):
+                    color_balance(stitchobj)  # balance color between the two images.
+                update_progress_bar(stitchobj.progressbar,'Blending Images',0.75)
+                with trace.span('blend',method=stitchobj.blend_method):
+                    blend_layer_masks(stitchobj,0.75,0.99)  # add a layer mask to merge the edges.
+                if stitchobj.rig_template and numpy and not os.path.exists(stitchobj.rig_template):
+                    with trace.span('save rig template'):
+                        save_rig_template(stitchobj)
+        finally:
+            restore_images(stitchobj)
         update_progress_bar(stitchobj.progressbar,'Overlaying Images',0.99)
-        gimp.pdb.gimp_display_new(stitchobj.panorama)  # display the panoramic image
+        if stitchobj.panorama:
+            gimp.pdb.gimp_display_new(stitchobj.panorama)  # display the panoramic image
         update_progress_bar(stitchobj.progressbar,'',1.0)
     else:
         error_message('Error: you did not set any control points.',stitchobj.mode)
@@ -1970,6 +2791,19 @@ class ControlPanelWidget:
                                             yoptions=gtk.FILL,
                                             xoptions=gtk.FILL)
                 label.show()
+            if self.stitch.fit_report:
+                report = self.stitch.fit_report
+                label = gtk.Label('RMS Error: %8.2f  Max Error: %8.2f' % (report.rms,report.max))
+                self.transform_table.attach(label,0,3,4,5,
+                                            yoptions=gtk.FILL,
+                                            xoptions=gtk.FILL)
+                label.show()
+                for i,warning in enumerate(report.warnings):
+                    label = gtk.Label('Warning: '+warning)
+                    self.transform_table.attach(label,0,3,5+i,6+i,
+                                                yoptions=gtk.FILL,
+                                                xoptions=gtk.FILL)
+                    label.show()
             
     def create_new_transform_table(self):
         '''Create and fill the table of control points in the widget.'''
@@ -2032,6 +2866,7 @@ class ControlPanelWidget:
         if index == 0: self.stitch.interpolation = INTERPOLATION_NONE
         if index == 1: self.stitch.interpolation = INTERPOLATION_LINEAR
         if index == 2: self.stitch.interpolation = INTERPOLATION_CUBIC
+        if index == 3: self.stitch.interpolation = INTERPOLATION_LANCZOS
 
     def set_blend_size(self,combobox,data=None):
         index = combobox.get_active()
@@ -2044,6 +2879,40 @@ class ControlPanelWidget:
         if index == 6: self.stitch.blend_fraction = 1.00
         ##if __debug__: print 'blend size is ',index,self.stitch.blend_fraction
 
+    def set_blend_method(self,combobox,data=None):
+        index = combobox.get_active()
+        if index == 0: self.stitch.blend_method = 'gradient'
+        if index == 1: self.stitch.blend_method = 'feather'
+        if index == 2: self.stitch.blend_method = 'seam'
+
+    def set_projection(self,combobox,data=None):
+        index = combobox.get_active()
+        if index == 0: self.stitch.projection = 'planar'
+        if index == 1: self.stitch.projection = 'cylindrical'
+        if index == 2: self.stitch.projection = 'spherical'
+        if self.stitch.projection == 'planar':
+            self.fentry.set_sensitive(gtk.FALSE)
+        else:
+            self.fentry.set_sensitive(gtk.TRUE)
+
+    def set_distortion_model(self,combobox,data=None):
+        index = combobox.get_active()
+        if index == 0: self.stitch.distortion_model = 'triangles'
+        if index == 1: self.stitch.distortion_model = 'lens'
+
+    def set_focal_length(self,entry,data=None):
+        try:
+            focal_length = float(entry.get_text())
+        except ValueError:
+            focal_length = None
+        if focal_length is not None and focal_length <= 0.0: focal_length = None
+        self.stitch.focal_length = focal_length
+
+    def set_refine_method(self,combobox,data=None):
+        index = combobox.get_active()
+        if index == 0: self.stitch.refine_method = 'amoeba'
+        if index == 1: self.stitch.refine_method = 'ecc'
+
     def set_color_radius(self,combobox,data=None):
         index = combobox.get_active()
         if index == 0: self.stitch.colorradius = 1.0
@@ -2063,15 +2932,25 @@ class ControlPanelWidget:
     def super_sample_check_event(self,check,data=None):
         if check.get_active():
             self.stitch.supersample=1
+            if numpy: self.adaptive_check.set_sensitive(gtk.TRUE)
         else:
             self.stitch.supersample=0
+            if numpy: self.adaptive_check.set_sensitive(gtk.FALSE)
         ##if __debug__: print 'supersample is now',self.stitch.supersample
         
+    def adaptive_check_event(self,check,data=None):
+        if check.get_active():
+            self.stitch.adaptive_supersample=True
+        else:
+            self.stitch.adaptive_supersample=False
+
     def correlate_check_event(self,check,data=None):
         if check.get_active():
             self.stitch.cpcorrelate=True
+            self.rcombobox.set_sensitive(gtk.TRUE)
         else:
             self.stitch.cpcorrelate=False
+            self.rcombobox.set_sensitive(gtk.FALSE)
         ##if __debug__: print 'correlation is now',self.stitch.cpcorrelate
                 
                 
@@ -2079,16 +2958,20 @@ class ControlPanelWidget:
         if check.get_active():
             self.stitch.blend=True
             self.bcombobox.set_sensitive(gtk.TRUE)
+            self.mcombobox.set_sensitive(gtk.TRUE)
         else:
             self.stitch.blend=False
             self.bcombobox.set_sensitive(gtk.FALSE)
+            self.mcombobox.set_sensitive(gtk.FALSE)
         ##if __debug__: print 'blend is now',self.stitch.blend
 
     def distort_check_event(self,check,data=None):
         if check.get_active():
             self.stitch.rmdistortion=True
+            self.dcombobox.set_sensitive(gtk.TRUE)
         else:
             self.stitch.rmdistortion=False
+            self.dcombobox.set_sensitive(gtk.FALSE)
         ##if __debug__: print 'remove distortion is now',self.stitch.rmdistortion
                 
     def color_balance_check_event(self,check,data=None):
@@ -2148,6 +3031,25 @@ class ControlPanelWidget:
         self.scrolled_window.show()
         # create a table of the control point data
         self.create_new_transform_table()
+        # control point refinement method selector, made first since
+        # the correlation check button sets its sensitivity
+        table = gtk.Table(2,1,homogeneous=gtk.FALSE)
+        table.set_row_spacings(10)
+        table.set_col_spacings(10)
+        label = gtk.Label("Refine Method:")
+        table.attach(label,0,1,0,1,yoptions=gtk.FILL,xoptions=gtk.FILL)
+        label.show()
+        self.rcombobox = gtk.combo_box_new_text()
+        self.rcombobox.append_text("Simplex")
+        if numpy:
+            self.rcombobox.append_text("Gradient (ECC)")
+        self.rcombobox.connect("changed",self.set_refine_method)
+        self.rcombobox.set_active(0)
+        table.attach(self.rcombobox,1,2,0,1,yoptions=gtk.FILL,xoptions=gtk.FILL)
+        self.rcombobox.show()
+        self.tooltips.set_tip(self.rcombobox,"Simplex searches the shift, rotation and scale "+ \
+                              "by trial and error.  Gradient (ECC) follows the image "+ \
+                              "gradients and is much faster.")
         # control point correlation selector
         self.correlate_check = gtk.CheckButton(label='Correlate Control Points')
         self.correlate_check.connect("toggled",self.correlate_check_event)
@@ -2157,6 +3059,8 @@ class ControlPanelWidget:
         vbox.pack_start(self.correlate_check,gtk.FALSE,gtk.FALSE,0)
         self.tooltips.set_tip(self.correlate_check,"Maximize the correlation between "+ \
                               "the contol point selections.")
+        vbox.pack_start(table,gtk.FALSE,gtk.FALSE,0)
+        table.show()
         # editing buttons, add, edit, delete
         # add button
         homogeneous = gtk.FALSE ; spacing = 0
@@ -2185,6 +3089,7 @@ class ControlPanelWidget:
         self.tcombobox.append_text("None")
         self.tcombobox.append_text("Linear")
         self.tcombobox.append_text("Cubic")
+        self.tcombobox.append_text("Lanczos")
         self.tcombobox.connect("changed",self.set_interpolation)
         self.tcombobox.set_active(2)
         table.attach(self.tcombobox,1,2,0,1,yoptions=gtk.FILL,xoptions=gtk.FILL)
@@ -2213,6 +3118,63 @@ class ControlPanelWidget:
         vbox.pack_start(table,gtk.FALSE,gtk.FALSE,0)
         table.show()
         self.tooltips.set_tip(self.bcombobox,"The size of the blend as a percentage of the image overlap.")
+        # blend method selector
+        table = gtk.Table(2,1,homogeneous=gtk.FALSE)
+        table.set_row_spacings(10)
+        table.set_col_spacings(10)
+        label = gtk.Label("Blend Method:")
+        table.attach(label,0,1,0,1,yoptions=gtk.FILL,xoptions=gtk.FILL)
+        label.show()
+        self.mcombobox = gtk.combo_box_new_text()
+        self.mcombobox.append_text("Gradient")
+        if numpy:
+            self.mcombobox.append_text("Feather")
+            self.mcombobox.append_text("Seam")
+        self.mcombobox.connect("changed",self.set_blend_method)
+        self.mcombobox.set_active(0)
+        table.attach(self.mcombobox,1,2,0,1,yoptions=gtk.FILL,xoptions=gtk.FILL)
+        self.mcombobox.show()
+        vbox.pack_start(table,gtk.FALSE,gtk.FALSE,0)
+        table.show()
+        self.tooltips.set_tip(self.mcombobox,"Gradient blends along the edges of the overlap. "+ \
+                              "Feather follows the outline of the warped images. "+ \
+                              "Seam cuts the overlap where the images match best, "+ \
+                              "which avoids ghosts of moving objects.")
+        # projection selector, made after the focal length entry
+        # since it sets the sensitivity of the entry
+        table = gtk.Table(3,2,homogeneous=gtk.FALSE)
+        table.set_row_spacings(10)
+        table.set_col_spacings(10)
+        label = gtk.Label("Focal Length:")
+        table.attach(label,0,1,1,2,yoptions=gtk.FILL,xoptions=gtk.FILL)
+        label.show()
+        label = gtk.Label("Pixels")
+        table.attach(label,2,3,1,2,yoptions=gtk.FILL,xoptions=gtk.FILL)
+        label.show()
+        self.fentry = gtk.Entry(max=0)
+        if self.stitch.focal_length: self.fentry.set_text('%.1f' % self.stitch.focal_length)
+        self.fentry.connect("changed",self.set_focal_length)
+        table.attach(self.fentry,1,2,1,2,yoptions=gtk.FILL,xoptions=gtk.FILL)
+        self.fentry.show()
+        self.tooltips.set_tip(self.fentry,"The focal length of the camera in pixels. "+ \
+                              "Leave it empty to estimate it from the control points.")
+        label = gtk.Label("Projection:")
+        table.attach(label,0,1,0,1,yoptions=gtk.FILL,xoptions=gtk.FILL)
+        label.show()
+        self.pcombobox = gtk.combo_box_new_text()
+        self.pcombobox.append_text("Planar")
+        if numpy:
+            self.pcombobox.append_text("Cylindrical")
+            self.pcombobox.append_text("Spherical")
+        self.pcombobox.connect("changed",self.set_projection)
+        self.pcombobox.set_active(0)
+        table.attach(self.pcombobox,1,2,0,1,yoptions=gtk.FILL,xoptions=gtk.FILL)
+        self.pcombobox.show()
+        vbox.pack_start(table,gtk.FALSE,gtk.FALSE,0)
+        table.show()
+        self.tooltips.set_tip(self.pcombobox,"Planar warps onto the reference image. "+ \
+                              "Cylindrical and spherical project both images first, "+ \
+                              "which keeps wide panoramas small.")
         # color radius selector
         table = gtk.Table(3,1,homogeneous=gtk.FALSE)
         table.set_row_spacings(10)
@@ -2243,13 +3205,24 @@ class ControlPanelWidget:
         vbox.pack_start(table,gtk.FALSE,gtk.FALSE,0)
         table.show()
         self.tooltips.set_tip(self.ccombobox,"Colors are averaged over this radius during color balancing.")
-        # supersample selector
+        # supersample selector, the adaptive check is made first since
+        # the supersample check sets its sensitivity
+        if numpy:
+            self.adaptive_check = gtk.CheckButton(label='Adaptive Supersampling')
+            self.adaptive_check.connect("toggled",self.adaptive_check_event)
+            if self.stitch.adaptive_supersample: self.adaptive_check.set_active(gtk.TRUE)
+            else: self.adaptive_check.set_active(gtk.FALSE)
+            self.tooltips.set_tip(self.adaptive_check,"Supersample only where the warp "+ \
+                                  "shrinks detailed parts of the image.")
         self.super_sample_check = gtk.CheckButton(label='Supersample')
         self.super_sample_check.connect("toggled",self.super_sample_check_event)
         if self.stitch.supersample: self.super_sample_check.set_active(gtk.TRUE)
         else: self.super_sample_check.set_active(gtk.FALSE)
         self.super_sample_check.show()
         vbox.pack_start(self.super_sample_check,gtk.FALSE,gtk.FALSE,0)
+        if numpy:
+            self.adaptive_check.show()
+            vbox.pack_start(self.adaptive_check,gtk.FALSE,gtk.FALSE,0)
         # color balance selector
         self.color_balance_check = gtk.CheckButton(label='Color Balance')
         self.color_balance_check.connect("toggled",self.color_balance_check_event)
@@ -2266,7 +3239,24 @@ class ControlPanelWidget:
         self.blend_check.show()
         vbox.pack_start(self.blend_check,gtk.FALSE,gtk.FALSE,0)
         self.tooltips.set_tip(self.blend_check,"Blend the images with a layer mask.")
-        # Remove distortion selector
+        # Remove distortion selector, the model selector is made first
+        # since the check button sets its sensitivity
+        table = gtk.Table(2,1,homogeneous=gtk.FALSE)
+        table.set_row_spacings(10)
+        table.set_col_spacings(10)
+        label = gtk.Label("Distortion Model:")
+        table.attach(label,0,1,0,1,yoptions=gtk.FILL,xoptions=gtk.FILL)
+        label.show()
+        self.dcombobox = gtk.combo_box_new_text()
+        self.dcombobox.append_text("Triangles")
+        if numpy: self.dcombobox.append_text("Lens (k1, k2)")
+        self.dcombobox.connect("changed",self.set_distortion_model)
+        self.dcombobox.set_active(0)
+        table.attach(self.dcombobox,1,2,0,1,yoptions=gtk.FILL,xoptions=gtk.FILL)
+        self.dcombobox.show()
+        self.tooltips.set_tip(self.dcombobox,"Triangles warps each triangle of control points "+ \
+                              "onto the transform.  Lens fits a radial lens distortion "+ \
+                              "to the control points and corrects both images with it.")
         self.distort_check = gtk.CheckButton(label='Remove Distortion')
         self.distort_check.connect("toggled",self.distort_check_event)
         if self.stitch.rmdistortion: self.distort_check.set_active(gtk.TRUE)
@@ -2274,6 +3264,8 @@ class ControlPanelWidget:
         self.distort_check.show()
         vbox.pack_start(self.distort_check,gtk.FALSE,gtk.FALSE,0)
         self.tooltips.set_tip(self.distort_check,"Remove distortion in the images.")
+        vbox.pack_start(table,gtk.FALSE,gtk.FALSE,0)
+        table.show()
         # Separator
         separator = gtk.HSeparator()
         vbox.pack_start(separator,gtk.FALSE,gtk.TRUE,5)
@@ -2314,6 +3306,46 @@ class ControlPanelWidget:
         gtk.main()
 
 
+preview_size = 128  # size of the image previews in the image selector
+pair_size = 64      # size of the thumbnails compared to suggest image pairs
+pair_recall = 0.3   # fraction of the other images proposed as partners (1.0: all)
+
+def preview_pixbuf(image,size=preview_size):
+    '''A gtk pixbuf of an image about size pixels across (needs numpy).'''
+    pixels,level = ingest.image_level(image,image.layers[0],size)
+    if pixels.ndim == 2: pixels = pixels[:,:,numpy.newaxis]
+    if pixels.shape[2] in (1,2):
+        # gray to RGB, keeping the alpha
+        pixels = numpy.concatenate([pixels[...,:1]]*3+[pixels[...,1:]],axis=2)
+    h,w,bpp = pixels.shape
+    return gtk.gdk.pixbuf_new_from_data(numpy.ascontiguousarray(pixels).tobytes(),
+                                        gtk.gdk.COLORSPACE_RGB,bpp == 4,8,w,h,w*bpp)
+
+def describe_images(image_list):
+    '''(descriptors,sequence,names) of images for pairs.select (needs numpy).
+
+       The descriptors are of thumbnails, and the sequence is the capture
+       order (EXIF times, else file names) or None.'''
+    descriptors = [pairs.describe_parts(ingest.image_level(img,img.layers[0],pair_size)[0])
+                   for img in image_list]
+    filenames = [getattr(img,'filename',None) for img in image_list]
+    sequence = [ingest.capture_time(filename) for filename in filenames]
+    if None in sequence: sequence = filenames
+    if None in sequence: sequence = None
+    names = [str(img.ID)+'. '+img.name for img in image_list]
+    return descriptors,sequence,names
+
+def suggest_pairs(image_list,recall=pair_recall,described=None):
+    '''A pairs.report of the pairs of images likely to overlap (needs numpy).
+
+       described is describe_images(image_list) if already known.  The
+       report goes to the trace.'''
+    with trace.span('suggest pairs',recall=recall) as span:
+        descriptors,sequence,names = described or describe_images(image_list)
+        report = pairs.select(descriptors,recall,sequence,names)
+        span.annotate(**report.as_dict())
+    return report
+
 class ImageSelectorWidget:
     '''Widget to select the reference and transformed images.'''
     def destroy(self,widget,data=None):
@@ -2346,6 +3378,27 @@ class ImageSelectorWidget:
         else:   
             self.image_list[i] = self.full_image_list[index]
         ##if __debug__: print title+' image set to '+str(index)
+    def show_preview(self,combobox,preview):
+        '''Show a small copy of the selected image (decoded at a reduced size).'''
+        index = combobox.get_active()
+        if 0 <= index < len(self.full_image_list):
+            preview.set_from_pixbuf(preview_pixbuf(self.full_image_list[index]))
+        else:
+            preview.clear()
+    def suggest_transformed(self,combobox,data=None):
+        '''Select a likely partner of the reference image as the transformed image.'''
+        index = combobox.get_active()
+        if not self.pairs or not 0 <= index < len(self.full_image_list): return
+        partners = self.pairs.partners_of(index)
+        if partners and self.tcombobox.get_active() not in partners:
+            self.tcombobox.set_active(partners[0])
+    def set_pair_recall(self,adjustment,data=None):
+        '''Suggest the pairs again with a new recall.'''
+        self.pairs = suggest_pairs(self.full_image_list,adjustment.get_value(),self.described)
+        self.suggest_transformed(self.rcombobox)
+    def show_pair_report(self,widget,data=None):
+        '''Show the pairs suggested and skipped.'''
+        if self.pairs: error_message(self.pairs.summary(),self.mode)
     def accept(self,widget,data=None):
         self.go_image_set(self.rcombobox,'Reference',0)
         time.sleep(0.1)
@@ -2362,6 +3415,12 @@ class ImageSelectorWidget:
         self.image_list = [None,None] # by default take the first two.
         self.mode = mode
         self.filename = None
+        self.pairs = None
+        self.described = None
+        if numpy and len(image_list) > 2:
+            # with many images, suggest the pairs which overlap
+            self.described = describe_images(image_list)
+            self.pairs = suggest_pairs(image_list,pair_recall,self.described)
         # basic setup, similar for all windows
         self.window = gtk.Window(gtk.WINDOW_TOPLEVEL)
         self.window.connect("delete_event", self.delete_event)
@@ -2371,7 +3430,7 @@ class ImageSelectorWidget:
         # This is the main vertical box
         vbox = gtk.VBox(gtk.FALSE,0)
         # formatting table
-        table = gtk.Table(2,4,homogeneous=gtk.FALSE)
+        table = gtk.Table(3,5,homogeneous=gtk.FALSE)
         table.set_row_spacings(10)
         table.set_col_spacings(10)
         # label the widget
@@ -2393,6 +3452,11 @@ class ImageSelectorWidget:
             self.rcombobox.append_text(str(image_list[index].ID)+'. '+image_list[index].name)
         self.rcombobox.append_text('Load from file')
         #self.rcombobox.connect("changed",self.reference_image_set)
+        if numpy:
+            self.rpreview = gtk.Image()
+            self.rcombobox.connect("changed",self.show_preview,self.rpreview)
+            table.attach(self.rpreview,2,3,2,3,yoptions=gtk.FILL,xoptions=gtk.FILL)
+            self.rpreview.show()
         self.rcombobox.set_active(min(1,nimages))
         table.attach(self.rcombobox,1,2,2,3,yoptions=gtk.FILL,xoptions=gtk.FILL)
         self.rcombobox.show()
@@ -2406,9 +3470,26 @@ class ImageSelectorWidget:
              self.tcombobox.append_text(str(image_list[index].ID)+'. '+image_list[index].name)
         self.tcombobox.append_text('Load from file')
         #self.tcombobox.connect("changed",self.transformed_image_set)
+        if numpy:
+            self.tpreview = gtk.Image()
+            self.tcombobox.connect("changed",self.show_preview,self.tpreview)
+            table.attach(self.tpreview,2,3,3,4,yoptions=gtk.FILL,xoptions=gtk.FILL)
+            self.tpreview.show()
         self.tcombobox.set_active(min((0,nimages)))
         table.attach(self.tcombobox,1,2,3,4,yoptions=gtk.FILL,xoptions=gtk.FILL)
         self.tcombobox.show()
+        if self.pairs:
+            self.rcombobox.connect("changed",self.suggest_transformed)
+            self.suggest_transformed(self.rcombobox)
+            # recall: how many partners are suggested, against matching time
+            label = gtk.Label("Pair Recall:")
+            table.attach(label,0,1,4,5,yoptions=gtk.FILL,xoptions=gtk.FILL)
+            label.show()
+            adjustment = gtk.Adjustment(pair_recall,0.05,1.0,0.05,0.1,0)
+            spinner = gtk.SpinButton(adjustment,0.05,2)
+            adjustment.connect("value_changed",self.set_pair_recall)
+            table.attach(spinner,1,2,4,5,yoptions=gtk.FILL,xoptions=gtk.FILL)
+            spinner.show()
         vbox.pack_start(table,gtk.FALSE,gtk.FALSE,0)
         table.show()
         # Separator
@@ -2430,8 +3511,14 @@ class ImageSelectorWidget:
         button.connect("clicked", self.cancel)
         expand = gtk.FALSE ; fill = gtk.FALSE; padding = 0
         hbox.pack_start(button,expand,fill,padding)
-        vbox.pack_start(hbox,gtk.FALSE,gtk.FALSE,0)
         button.show()
+        # pair report button
+        if self.pairs:
+            button = gtk.Button("Pair Report")
+            button.connect("clicked", self.show_pair_report)
+            hbox.pack_start(button,expand,fill,padding)
+            button.show()
+        vbox.pack_start(hbox,gtk.FALSE,gtk.FALSE,0)
         hbox.show()
         # Display everything
         self.window.add(vbox)
@@ -2473,6 +3560,13 @@ class ControlPointEditorWidget:
             self.stitch.add_control_point(cp)
             self.update_control_point_table()
             
+    def refine_all_control_points(self,widget,data=None):
+        '''Refine all the control points in the list.'''
+        if self.stitch.control_points:
+            self.refine_button.set_sensitive(gtk.FALSE)  # greyed out
+            refine_all_control_points(self.stitch)
+            self.update_control_point_table()
+
     def edit_control_point(self,widget,data=None):
         '''Edit one control point from the control point list.'''
         old_control_point = self.stitch.control_points[self.selected_control_point_index]
@@ -2534,11 +3628,18 @@ class ControlPointEditorWidget:
                 qw.main()
                 if not qw.answer: self.filename=''
             if self.filename:
+                metadata = {'version':stitch_plugin.version,
+                            'reference':self.stitch.rimage.name,
+                            'reference_size':[self.stitch.rimage.width,
+                                              self.stitch.rimage.height],
+                            'transformed':self.stitch.timage.name,
+                            'transformed_size':[self.stitch.timage.width,
+                                                self.stitch.timage.height]}
                 try:
-                    fobj = file(self.filename,'wb')
-                    pickle.dump(self.stitch.control_points,fobj,True)
-                    fobj.close()
-                except IOError:
+                    cpfile.save(self.filename,
+                                control_point_records(self.stitch.control_points),
+                                metadata)
+                except (IOError,OSError):
                     error_message('Error: could not save to file '+
                                   self.filename+':\n'+
                                   str(sys.exc_value),self.mode)
@@ -2564,12 +3665,11 @@ class ControlPointEditorWidget:
                 if not qw.answer: self.filename=''
             if self.filename:
                 try:
-                    fobj = file(self.filename,'rb')
-                    control_points = pickle.load(fobj)
-                    self.stitch.set_control_points(control_points)
+                    # old pickled files are converted to the new format
+                    records,metadata = cpfile.load(self.filename)
+                    self.stitch.set_control_points(control_points_from_records(records))
                     ##if __debug__: print 'Number of imported control points: ',self.stitch.npoints
-                    fobj.close()
-                except IOError:
+                except (IOError,OSError,ValueError):
                     error_message('Error: could not restore from file '+
                                   self.filename+':\n'+
                                   str(sys.exc_value),self.mode)
@@ -2585,12 +3685,14 @@ class ControlPointEditorWidget:
             self.edit_button.set_sensitive(gtk.FALSE)  # greyed out
             self.delete_button.set_sensitive(gtk.FALSE)
             self.save_button.set_sensitive(gtk.FALSE)
+            self.refine_button.set_sensitive(gtk.FALSE)
             self.up_button.set_sensitive(gtk.FALSE)   # greyed out
             self.down_button.set_sensitive(gtk.FALSE)
         else:
             self.edit_button.set_sensitive(gtk.TRUE)  # not greyed out
             self.delete_button.set_sensitive(gtk.TRUE)
             self.save_button.set_sensitive(gtk.TRUE)
+            if numpy: self.refine_button.set_sensitive(gtk.TRUE)
             if self.stitch.npoints <= 1:
                 self.up_button.set_sensitive(gtk.FALSE)   # greyed out
                 self.down_button.set_sensitive(gtk.FALSE)
@@ -2796,6 +3898,16 @@ class ControlPointEditorWidget:
         expand = gtk.FALSE ; fill = gtk.FALSE; padding = 0
         hbox.pack_start(self.delete_button,expand,fill,padding)
         self.delete_button.show()
+        # refine all button
+        self.refine_button = gtk.Button("Refine All")
+        self.refine_button.connect("clicked", self.refine_all_control_points)
+        if not self.stitch.control_points or not numpy:
+            self.refine_button.set_sensitive(gtk.FALSE)  # greyed out
+        expand = gtk.FALSE ; fill = gtk.FALSE; padding = 0
+        hbox.pack_start(self.refine_button,expand,fill,padding)
+        self.tooltips.set_tip(self.refine_button,"Refine the positions of all the control " + \
+                                                 "points by correlating the images around them")
+        self.refine_button.show()
         # up button
         self.up_button = gtk.Button("Up")
         self.up_button.connect("clicked",self.move_control_point_up)
@@ -3451,136 +4563,9 @@ def matrixmultiply(a,b):
 
 # -------------------------------------------
 
-def amoeba(var,scale,func,ftolerance=1.e-4,xtolerance=1.e-4,itmax=500,data=None):
-    '''Use the simplex method to maximize a function of 1 or more variables.
-    
-       Input:
-              var = the initial guess, a list with one element for each variable
-              scale = the search scale for each variable, a list with one
-                      element for each variable.
-              func = the function to maximize.
-              
-       Optional Input:
-              ftolerance = convergence criterion on the function values (default = 1.e-4)
-              xtolerance = convergence criterion on the variable values (default = 1.e-4)
-              itmax = maximum number of iterations allowed (default = 500).
-              data = data to be passed to func (default = None).
-              
-       Output:
-              (varbest,funcvalue,iterations)
-              varbest = a list of the variables at the maximum.
-              funcvalue = the function value at the maximum.
-              iterations = the number of iterations used.
-
-       - Setting itmax to zero disables the itmax check and the routine will run
-         until convergence, even if it takes forever.
-       - Setting ftolerance or xtolerance to 0.0 turns that convergence criterion
-         off.  But do not set both ftolerance and xtolerance to zero or the routine
-         will exit immediately without finding the maximum.
-       - To check for convergence, check if (iterations < itmax).
-              
-       The function should be defined like func(var,data) where
-       data is optional data to pass to the function.
-
-       Example:
-       
-           import amoeba
-           def afunc(var,data=None): return 1.0-var[0]*var[0]-var[1]*var[1]
-           print amoeba.amoeba([0.25,0.25],[0.5,0.5],afunc)
-
-       Version 1.0 2005-March-28 T. Metcalf
-               1.1 2005-March-29 T. Metcalf - Use scale in simsize calculation.
-                                            - Use func convergence *and* x convergence
-                                              rather than func convergence *or* x
-                                              convergence.
-       '''
-
-    nvar = len(var)       # number of variables in the minimization
-    nsimplex = nvar + 1   # number of vertices in the simplex
-    
-    # first set up the simplex
-
-    simplex = [0]*(nvar+1)  # set the initial simplex
-    simplex[0] = var[:]
-    for i in range(nvar):
-        simplex[i+1] = var[:]
-        simplex[i+1][i] += scale[i]
-
-    fvalue = []
-    for i in range(nsimplex):  # set the function values for the simplex
-        fvalue.append(func(simplex[i],data=data))
-
-    # Ooze the simplex to the maximum
-
-    iteration = 0
-    
-    while 1:
-        # find the index of the best and worst vertices in the simplex
-        ssworst = 0
-        ssbest  = 0
-        for i in range(nsimplex):
-            if fvalue[i] > fvalue[ssbest]:
-                ssbest = i
-            if fvalue[i] < fvalue[ssworst]:
-                ssworst = i
-        
-        # get the average of the nsimplex-1 best vertices in the simplex
-        pavg = [0.0]*nvar
-        for i in range(nsimplex):
-            if i != ssworst:
-                for j in range(nvar): pavg[j] += simplex[i][j]
-        for j in range(nvar): pavg[j] = pavg[j]/nvar  # nvar is nsimplex-1
-        simscale = 0.0
-        for i in range(nvar):
-            simscale += abs(pavg[i]-simplex[ssworst][i])/scale[i]
-        simscale = simscale/nvar
-
-        # find the range of the function values
-        fscale = (abs(fvalue[ssbest])+abs(fvalue[ssworst]))/2.0
-        if fscale != 0.0:
-            frange = abs(fvalue[ssbest]-fvalue[ssworst])/fscale
-        else:
-            frange = 0.0  # all the fvalues are zero in this case
-
-        # have we converged?
-        if (((ftolerance <= 0.0 or frange < ftolerance) and    # converged to maximum
-             (xtolerance <= 0.0 or simscale < xtolerance)) or  # simplex contracted enough
-            (itmax and iteration >= itmax)):                   # ran out of iterations
-            return simplex[ssbest],fvalue[ssbest],iteration
-
-        # reflect the worst vertex
-        pnew = [0.0]*nvar
-        for i in range(nvar):
-            pnew[i] = 2.0*pavg[i] - simplex[ssworst][i]
-        fnew = func(pnew,data=data)
-        if fnew <= fvalue[ssworst]:
-            # the new vertex is worse than the worst so shrink
-            # the simplex.
-            for i in range(nsimplex):
-                if i != ssbest and i != ssworst:
-                    for j in range(nvar):
-                        simplex[i][j] = 0.5*simplex[ssbest][j] + 0.5*simplex[i][j]
-                    fvalue[i] = func(simplex[i],data=data)
-            for j in range(nvar):
-                pnew[j] = 0.5*simplex[ssbest][j] + 0.5*simplex[ssworst][j]
-            fnew = func(pnew,data=data)
-        elif fnew >= fvalue[ssbest]:
-            # the new vertex is better than the best so expand
-            # the simplex.
-            pnew2 = [0.0]*nvar
-            for i in range(nvar):
-                pnew2[i] = 3.0*pavg[i] - 2.0*simplex[ssworst][i]
-            fnew2 = func(pnew2,data=data)
-            if fnew2 > fnew:
-                # accept the new vertex in the simplex
-                pnew = pnew2
-                fnew = fnew2
-        # replace the worst vertex with the new vertex
-        for i in range(nvar):
-            simplex[ssworst][i] = pnew[i]
-        fvalue[ssworst] = fnew
-        iteration += 1
-        #if __debug__: print ssbest,fvalue[ssbest]
+# amoeba now lives in gimplib.optimize, where it can evaluate independent
+# vertices in parallel.
+amoeba = optimize.amoeba
 
 
 
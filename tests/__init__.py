@@ -0,0 +1,12 @@
+'''Unit tests of gimplib, run outside of gimp with python 2.7:
+
+    python -m unittest discover -s tests -t .
+
+from the top directory.  They need numpy but not gimp: drawables are
+the stubs of gimplib.stub.'''
+
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if root not in sys.path: sys.path.insert(0,root)
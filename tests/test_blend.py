@@ -0,0 +1,75 @@
+'''Feathering distances and weights against a brute force transform.'''
+
+import random
+import unittest
+
+import numpy
+
+from gimplib import blend
+
+def brute_distance(valid):
+    '''Distance from each pixel to the nearest invalid pixel, by looking at all of them.'''
+    ys,xs = numpy.nonzero(~valid)
+    h,w = valid.shape
+    distance = numpy.zeros((h,w))
+    for y in range(h):
+        for x in range(w):
+            if valid[y,x]:
+                distance[y,x] = numpy.sqrt(((ys-y)**2 + (xs-x)**2).min())
+    return distance
+
+def padded(valid):
+    '''valid with a border of invalid pixels, so the edges count.'''
+    result = numpy.zeros((valid.shape[0]+2,valid.shape[1]+2),dtype=bool)
+    result[1:-1,1:-1] = valid
+    return result
+
+def random_mask(rnd,h,w):
+    '''A few random rectangles and holes.'''
+    valid = numpy.zeros((h,w),dtype=bool)
+    for i in range(rnd.randint(1,4)):
+        x0 = rnd.randrange(w) ; y0 = rnd.randrange(h)
+        valid[y0:y0+rnd.randint(1,h),x0:x0+rnd.randint(1,w)] = True
+    for i in range(rnd.randint(0,3)):
+        valid[rnd.randrange(h),rnd.randrange(w)] = False
+    return valid
+
+class test_blend(unittest.TestCase):
+    def test_distance_transform(self):
+        rnd = random.Random(1)
+        for trial in range(30):
+            valid = padded(random_mask(rnd,rnd.randint(1,24),rnd.randint(1,24)))
+            numpy.testing.assert_allclose(blend.distance_transform(valid),
+                                          brute_distance(valid),atol=1e-9)
+    def test_distance_transform_noise(self):
+        valid = padded(numpy.random.RandomState(2).rand(30,40) > 0.2)
+        numpy.testing.assert_allclose(blend.distance_transform(valid),
+                                      brute_distance(valid),atol=1e-9)
+    def test_all_valid(self):
+        self.assertTrue((blend.distance_transform(numpy.ones((5,7),dtype=bool)) > 1e9).all())
+    def test_feather_weights(self):
+        rnd = random.Random(3)
+        for trial in range(10):
+            h = rnd.randint(4,24) ; w = rnd.randint(4,24)
+            rvalid = padded(random_mask(rnd,h,w))
+            tvalid = padded(random_mask(rnd,h,w))
+            feather = rnd.choice([0.5,1,3,10])
+            alpha = blend.feather_weights(blend.distance_transform(rvalid),
+                                          blend.distance_transform(tvalid),feather)
+            rdistance = brute_distance(rvalid) ; tdistance = brute_distance(tvalid)
+            expected = numpy.ones_like(alpha)
+            ramp = max(feather,1.0)
+            for (y,x),t in numpy.ndenumerate(tdistance):
+                rweight = min(rdistance[y,x]/ramp,1.0) ; tweight = min(t/ramp,1.0)
+                if tweight > 0: expected[y,x] = rweight/(rweight+tweight)
+            numpy.testing.assert_allclose(alpha,expected,atol=1e-9)
+            self.assertTrue(((alpha >= 0.0) & (alpha <= 1.0)).all())
+            self.assertTrue((alpha[~tvalid] == 1.0).all())
+            self.assertTrue((alpha[rvalid & ~tvalid] == 1.0).all())
+            self.assertTrue((alpha[tvalid & ~rvalid] == 0.0).all())
+            # both deep inside: an even share
+            deep = (rdistance >= max(feather,1)) & (tdistance >= max(feather,1))
+            numpy.testing.assert_allclose(alpha[deep],0.5)
+
+if __name__ == '__main__':
+    unittest.main()
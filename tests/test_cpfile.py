@@ -0,0 +1,96 @@
+'''The control point file format, new and legacy.'''
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+try:
+    import cPickle
+except ImportError:
+    cPickle = pickle
+
+from gimplib import cpfile
+
+records = [(1.5,2.0,3.25,4.0,0.93,True),
+           (10.0,20.0,30.0,40.0,None,False),
+           (-1.0,0.0,1.0e6,-7.5,-0.5,True)]
+
+class control_point(object):
+    '''Pickles like the control_point of older stitch panorama versions.'''
+    def __init__(self,x1,y1,x2,y2,correlation=None,colorbalance=True):
+        self.xy = (float(x1),float(y1),float(x2),float(y2))
+        self.correlation = correlation
+        self.colorbalance = colorbalance
+
+calls = []
+
+def _called(*args):
+    calls.append(args)
+
+class evil(object):
+    def __reduce__(self):
+        return (_called,('unpickled',))
+
+class test_cpfile(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='stitch-test-')
+        self.filename = os.path.join(self.directory,'points')
+        del calls[:]
+    def tearDown(self):
+        shutil.rmtree(self.directory,ignore_errors=True)
+    def test_round_trip(self):
+        data = cpfile.dumps(records)
+        self.assertEqual(data[:4],cpfile.magic)
+        self.assertEqual(len(data),16 + 48*len(records))
+        self.assertEqual(cpfile.as_tuples(cpfile.loads(data)),records)
+    def test_empty(self):
+        self.assertEqual(cpfile.as_tuples(cpfile.loads(cpfile.dumps([]))),[])
+    def test_save_load(self):
+        metadata = {'reference':'a.jpg','transformed':'b.jpg'}
+        cpfile.save(self.filename,records,metadata)
+        loaded,loaded_metadata = cpfile.load(self.filename)
+        self.assertEqual(cpfile.as_tuples(loaded),records)
+        self.assertEqual(loaded_metadata,metadata)
+        self.assertFalse(os.path.exists(self.filename+'.bak'))
+    def test_truncated(self):
+        data = cpfile.dumps(records)
+        self.assertRaises(ValueError,cpfile.loads,data[:-1])
+        self.assertRaises(ValueError,cpfile.loads,data[:10])
+    def test_newer_version(self):
+        data = bytearray(cpfile.dumps(records))
+        data[4] = cpfile.version + 1
+        self.assertRaises(ValueError,cpfile.loads,bytes(data))
+    def test_legacy(self):
+        points = [control_point(*r) for r in records]
+        for module in (pickle,cPickle):
+            for protocol in (0,1,2):
+                data = module.dumps(points,protocol)
+                self.assertTrue(cpfile.is_legacy(data))
+                self.assertEqual(cpfile.as_tuples(cpfile.loads(data)),records)
+    def test_legacy_migration(self):
+        fobj = open(self.filename,'wb')
+        fobj.write(pickle.dumps([control_point(*r) for r in records]))
+        fobj.close()
+        loaded,metadata = cpfile.load(self.filename)
+        self.assertEqual(cpfile.as_tuples(loaded),records)
+        self.assertTrue(os.path.exists(self.filename+'.bak'))
+        fobj = open(self.filename,'rb')
+        data = fobj.read()
+        fobj.close()
+        self.assertFalse(cpfile.is_legacy(data))
+        self.assertEqual(cpfile.as_tuples(cpfile.loads(data)),records)
+    def test_malicious_pickle(self):
+        for module in (pickle,cPickle):
+            for protocol in (0,2):
+                data = module.dumps([evil()],protocol)
+                self.assertRaises(ValueError,cpfile.loads,data)
+        data = pickle.dumps([control_point(*records[0]),evil()])
+        self.assertRaises(ValueError,cpfile.loads,data)
+        self.assertEqual(calls,[])
+    def test_not_a_pickle(self):
+        self.assertRaises(ValueError,cpfile.loads,b'garbage')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+'''Inserting and removing points keeps the triangulation Delaunay.'''
+
+import random
+import unittest
+
+from gimplib import delaunay
+from gimplib.delaunay import INF,incircle,orient
+
+def inside(points,triangle,p):
+    a,b,c = [points[v] for v in triangle]
+    return orient(a,b,p) >= 0 and orient(b,c,p) >= 0 and orient(c,a,p) >= 0
+
+class test_delaunay(unittest.TestCase):
+    def check(self,tr):
+        '''The tables agree and no point is inside a circumcircle.'''
+        points = tr.points
+        live = tr.vertices()
+        self.assertEqual(len(tr),len(live))
+        for t,(a,b,c) in tr.triangle.items():
+            for e in ((a,b),(b,c),(c,a)):
+                self.assertEqual(tr.edge[e],t)
+                self.assertTrue((e[1],e[0]) in tr.edge)
+            if c != INF:
+                self.assertTrue(orient(points[a],points[b],points[c]) > 0)
+        self.assertEqual(len(tr.edge),3*len(tr.triangle))
+        triangles = tr.triangles()
+        for a,b,c in triangles:
+            for v in live:
+                if v not in (a,b,c):
+                    self.assertTrue(incircle(points[a],points[b],points[c],points[v]) <= 0)
+        if triangles:
+            self.assertEqual(set(v for t in triangles for v in t),set(live))
+    def check_locate(self,tr,rnd):
+        for i in range(5):
+            p = (rnd.uniform(-10,110),rnd.uniform(-10,110))
+            found = tr.locate(*p)
+            if found is None:
+                for triangle in tr.triangles():
+                    self.assertFalse(inside(tr.points,triangle,p))
+            else:
+                self.assertTrue(found in tr.triangles())
+                self.assertTrue(inside(tr.points,found,p))
+    def check_random(self,seed,grid):
+        rnd = random.Random(seed)
+        tr = delaunay.triangulation()
+        vertices = []
+        for step in range(150):
+            if vertices and rnd.random() < 0.4:
+                tr.remove(vertices.pop(rnd.randrange(len(vertices))))
+            else:
+                if grid: p = (rnd.randrange(6)*10,rnd.randrange(6)*10)
+                else: p = (rnd.uniform(0,100),rnd.uniform(0,100))
+                v = tr.insert(*p)
+                if v not in vertices: vertices.append(v)
+            self.check(tr)
+            if tr.triangle: self.check_locate(tr,rnd)
+    def test_random(self):
+        for seed in range(5): self.check_random(seed,False)
+    def test_cocircular(self):
+        for seed in range(5): self.check_random(seed,True)
+    def test_collinear(self):
+        tr = delaunay.triangulation([(0,0),(1,1),(2,2)])
+        self.assertEqual(tr.triangles(),[])
+        self.assertEqual(tr.locate(1,1),None)
+        tr.insert(0,2)
+        self.check(tr)
+        self.assertEqual(len(tr.triangles()),2)
+        tr.remove(3)
+        self.assertEqual(tr.triangles(),[])
+    def test_repeated_point(self):
+        tr = delaunay.triangulation([(0,0),(1,0),(0,1)])
+        self.assertEqual(tr.insert(1,0),1)
+        self.assertEqual(len(tr),3)
+    def test_remove_twice(self):
+        tr = delaunay.triangulation([(0,0),(1,0),(0,1),(1,1)])
+        tr.remove(2)
+        self.assertRaises(KeyError,tr.remove,2)
+        self.check(tr)
+    def test_sync(self):
+        tr = delaunay.triangulation()
+        corners = [(0,0),(0,100),(100,0),(100,100)]
+        first = tr.sync(corners + [(30,40),(60,70)])
+        self.check(tr)
+        second = tr.sync(corners + [(60,70),(10,90)])
+        self.check(tr)
+        self.assertEqual(second[:5],first[:4] + first[5:])
+        self.assertEqual(len(tr),6)
+    def test_locate_corners(self):
+        tr = delaunay.triangulation([(0,0),(0,100),(100,0),(100,100),(50,50)])
+        self.assertTrue(inside(tr.points,tr.locate(0,0),(0,0)))
+        self.assertTrue(inside(tr.points,tr.locate(100,50),(100,50)))
+        self.assertEqual(tr.locate(100.5,50),None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+'''Reading and writing stub drawables through pixel regions.'''
+
+import unittest
+
+import numpy
+
+from gimplib import pixelio
+from gimplib import stub
+
+def random_drawable(rnd,width,height,bpp):
+    pixels = rnd.randint(0,256,(height,width,bpp)).astype(numpy.uint8)
+    return stub.drawable(width,height,bpp,pixels.tobytes()),pixels
+
+def squeeze(pixels):
+    if pixels.shape[2] == 1: return pixels[:,:,0]
+    return pixels
+
+class test_pixelio(unittest.TestCase):
+    def setUp(self):
+        self.rnd = numpy.random.RandomState(0)
+    def test_read_all(self):
+        for bpp in (1,2,3,4):
+            for height in (1,pixelio.strip_rows,pixelio.strip_rows+1,3*pixelio.strip_rows+5):
+                d,pixels = random_drawable(self.rnd,37,height,bpp)
+                numpy.testing.assert_array_equal(pixelio.read(d),squeeze(pixels))
+    def test_read_rectangle(self):
+        d,pixels = random_drawable(self.rnd,50,200,3)
+        for x,y,w,h in ((0,0,1,1),(3,5,20,10),(10,20,40,150),(49,199,1,1)):
+            numpy.testing.assert_array_equal(pixelio.read(d,x,y,w,h),pixels[y:y+h,x:x+w])
+    def test_read_float(self):
+        d,pixels = random_drawable(self.rnd,8,9,2)
+        numpy.testing.assert_allclose(pixelio.read(d,dtype=numpy.float64),pixels/255.0)
+    def test_read_view(self):
+        d,pixels = random_drawable(self.rnd,8,9,3)
+        self.assertFalse(pixelio.read(d).flags.writeable)
+        copy = pixelio.read(d,copy=True)
+        copy[0,0,0] ^= 255
+        numpy.testing.assert_array_equal(pixelio.read(d),pixels)
+    def test_iter_strips(self):
+        d,pixels = random_drawable(self.rnd,11,2*pixelio.strip_rows+3,4)
+        strips = list(pixelio.iter_strips(d,2,1,7,None))
+        self.assertEqual([y0 for y0,strip in strips],range(1,d.height,pixelio.strip_rows))
+        numpy.testing.assert_array_equal(numpy.concatenate([s for y0,s in strips]),
+                                         pixels[1:,2:9])
+    def test_write_round_trip(self):
+        for bpp in (1,2,3,4):
+            d = stub.drawable(23,2*pixelio.strip_rows+7,bpp)
+            pixels = self.rnd.randint(0,256,(d.height,d.width,bpp)).astype(numpy.uint8)
+            pixelio.write(d,squeeze(pixels))
+            self.assertEqual(bytes(d.data),pixels.tobytes())
+            numpy.testing.assert_array_equal(pixelio.read(d),squeeze(pixels))
+            self.assertEqual(d.updates,1)
+    def test_write_rectangle(self):
+        d,pixels = random_drawable(self.rnd,40,100,3)
+        patch = self.rnd.randint(0,256,(80,15,3)).astype(numpy.uint8)
+        pixelio.write(d,patch,5,12,update=False)
+        pixels[12:92,5:20] = patch
+        numpy.testing.assert_array_equal(pixelio.read(d),pixels)
+        self.assertEqual(d.updates,0)
+    def test_write_float(self):
+        d = stub.drawable(3,1,1)
+        pixelio.write(d,numpy.array([[-0.5,0.5,2.0]]))
+        self.assertEqual(list(d.data),[0,128,255])
+    def test_write_wrong_channels(self):
+        d = stub.drawable(4,4,3)
+        self.assertRaises(ValueError,pixelio.write,d,numpy.zeros((4,4,4),dtype=numpy.uint8))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+'''Tiled TIFF and BigTIFF files read back with a small TIFF parser.'''
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+import numpy
+
+from gimplib import tiffwriter
+
+_types = {2:('s',1),3:('H',2),4:('I',4),16:('Q',8)}
+
+def read_tiff(filename):
+    '''(pixels,tags,bigtiff) of a little-endian tiled TIFF file.'''
+    fobj = open(filename,'rb')
+    data = fobj.read()
+    fobj.close()
+    assert data[:2] == b'II'
+    bigtiff = struct.unpack_from('<H',data,2)[0] == 43
+    if bigtiff:
+        directory = struct.unpack_from('<Q',data,8)[0]
+        count = struct.unpack_from('<Q',data,directory)[0]
+        entry,size,start = '<HHQ',20,directory+8
+    else:
+        directory = struct.unpack_from('<I',data,4)[0]
+        count = struct.unpack_from('<H',data,directory)[0]
+        entry,size,start = '<HHI',12,directory+2
+    assert directory % 2 == 0
+    inline = size - struct.calcsize(entry)
+    tags = {}
+    for i in range(count):
+        position = start + i*size
+        tag,code,n = struct.unpack_from(entry,data,position)
+        fmt,itemsize = _types[code]
+        value = data[position+size-inline:position+size]
+        if n*itemsize > inline:
+            offset = struct.unpack('<Q' if bigtiff else '<I',value)[0]
+            value = data[offset:offset+n*itemsize]
+        value = value[:n*itemsize]
+        tags[tag] = value if fmt == 's' else struct.unpack('<%d%s' % (n,fmt),value)
+    width = tags[tiffwriter.IMAGE_WIDTH][0]
+    height = tags[tiffwriter.IMAGE_LENGTH][0]
+    samples = tags[tiffwriter.SAMPLES_PER_PIXEL][0]
+    tile = tags[tiffwriter.TILE_WIDTH][0]
+    across = (width + tile - 1)//tile
+    down = (height + tile - 1)//tile
+    pixels = numpy.zeros((down*tile,across*tile,samples),dtype=numpy.uint8)
+    offsets = tags[tiffwriter.TILE_OFFSETS]
+    counts = tags[tiffwriter.TILE_BYTE_COUNTS]
+    assert len(offsets) == len(counts) == across*down
+    for i,(offset,n) in enumerate(zip(offsets,counts)):
+        tile_data = data[offset:offset+n]
+        if tags[tiffwriter.COMPRESSION][0] == 8: tile_data = zlib.decompress(tile_data)
+        row,column = divmod(i,across)
+        pixels[row*tile:(row+1)*tile,column*tile:(column+1)*tile] = \
+            numpy.frombuffer(tile_data,dtype=numpy.uint8).reshape(tile,tile,samples)
+    return pixels[:height,:width],tags,bigtiff
+
+class test_tiffwriter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='stitch-test-')
+        self.filename = os.path.join(self.directory,'out.tif')
+    def tearDown(self):
+        shutil.rmtree(self.directory,ignore_errors=True)
+    def write(self,pixels,tile,compression,bigtiff,skip=()):
+        height,width,samples = pixels.shape
+        writer = tiffwriter.tiled_tiff(self.filename,width,height,samples,tile=tile,
+                                       compression=compression,bigtiff=bigtiff)
+        with writer:
+            for column,row in reversed(writer.tiles()):
+                if (column,row) in skip: continue
+                x0,y0,x1,y1 = writer.tile_box(column,row)
+                data = numpy.zeros((tile,tile,samples),dtype=numpy.uint8)
+                data[:y1-y0,:x1-x0] = pixels[y0:y1,x0:x1]
+                writer.write_tile(column,row,data)
+        return writer
+    def test_round_trip(self):
+        rnd = numpy.random.RandomState(0)
+        for samples in (1,2,3,4):
+            pixels = rnd.randint(0,256,(70,100,samples)).astype(numpy.uint8)
+            for compression in ('none','deflate'):
+                for bigtiff in (False,True):
+                    self.write(pixels,32,compression,bigtiff)
+                    result,tags,big = read_tiff(self.filename)
+                    self.assertEqual(big,bigtiff)
+                    numpy.testing.assert_array_equal(result,pixels)
+                    self.assertEqual(tags[tiffwriter.COMPRESSION][0],
+                                     tiffwriter.compressions[compression])
+                    self.assertEqual(tags[tiffwriter.BITS_PER_SAMPLE],(8,)*samples)
+                    self.assertEqual(tags[tiffwriter.PHOTOMETRIC][0],2 if samples >= 3 else 1)
+                    self.assertEqual(tags[tiffwriter.SOFTWARE],b'stitch panorama\0')
+                    if samples in (2,4):
+                        self.assertEqual(tags[tiffwriter.EXTRA_SAMPLES],(2,))
+                    else:
+                        self.assertFalse(tiffwriter.EXTRA_SAMPLES in tags)
+    def test_sorted_tags(self):
+        self.write(numpy.zeros((16,16,3),dtype=numpy.uint8),16,'none',False)
+        fobj = open(self.filename,'rb')
+        data = fobj.read()
+        fobj.close()
+        directory = struct.unpack_from('<I',data,4)[0]
+        count = struct.unpack_from('<H',data,directory)[0]
+        tags = [struct.unpack_from('<H',data,directory+2+12*i)[0] for i in range(count)]
+        self.assertEqual(tags,sorted(tags))
+    def test_missing_tiles(self):
+        pixels = numpy.random.RandomState(1).randint(1,256,(50,50,3)).astype(numpy.uint8)
+        writer = self.write(pixels,16,'deflate',False,skip=[(1,1),(3,0)])
+        result,tags,big = read_tiff(self.filename)
+        pixels[16:32,16:32] = 0
+        pixels[0:16,48:50] = 0
+        numpy.testing.assert_array_equal(result,pixels)
+        offsets = tags[tiffwriter.TILE_OFFSETS]
+        self.assertEqual(offsets[1*writer.tiles_across+1],offsets[3])
+    def test_tile_box(self):
+        writer = tiffwriter.tiled_tiff(self.filename,100,40,1,tile=32)
+        self.assertEqual((writer.tiles_across,writer.tiles_down),(4,2))
+        self.assertEqual(writer.tile_box(3,1),(96,32,100,40))
+        self.assertEqual(writer.tiles()[:5],[(0,0),(1,0),(2,0),(3,0),(0,1)])
+        writer.close()
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError,tiffwriter.tiled_tiff,self.filename,10,10,3,tile=20)
+        self.assertRaises(ValueError,tiffwriter.tiled_tiff,self.filename,10,10,5)
+        writer = tiffwriter.tiled_tiff(self.filename,10,10,3,tile=16)
+        self.assertRaises(ValueError,writer.write_tile,0,0,b'\0'*10)
+        writer.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+'''Random reads and writes of a tile store against an array in memory.'''
+
+import os
+import random
+import unittest
+
+import numpy
+
+from gimplib import stub
+from gimplib import tilestore
+
+class test_tilestore(unittest.TestCase):
+    def random_rectangle(self,rnd,store):
+        x = rnd.randrange(store.width) ; y = rnd.randrange(store.height)
+        return x,y,rnd.randint(1,store.width-x),rnd.randint(1,store.height-y)
+    def check_random(self,height,width,channels,dtype,tile,tiles_in_memory):
+        rnd = random.Random(height*width)
+        values = numpy.random.RandomState(channels)
+        reference = numpy.zeros((height,width,channels),dtype=dtype)
+        budget = tiles_in_memory*tile*tile*channels*numpy.dtype(dtype).itemsize
+        with tilestore.store(height,width,channels,dtype,tile=tile,ram_budget=budget) as store:
+            for step in range(200):
+                x,y,w,h = self.random_rectangle(rnd,store)
+                if rnd.random() < 0.5:
+                    array = (values.rand(h,w,channels)*100).astype(dtype)
+                    store.write(array,x,y)
+                    reference[y:y+h,x:x+w] = array
+                else:
+                    numpy.testing.assert_array_equal(store.read(x,y,w,h),reference[y:y+h,x:x+w])
+                if step % 50 == 49: store.flush()
+                self.assertTrue(len(store.cache) <= store.max_tiles)
+            numpy.testing.assert_array_equal(store.read(),reference)
+            store.flush()
+            store.cache.clear()
+            numpy.testing.assert_array_equal(store.read(),reference)
+            stats = store.stats()
+            self.assertTrue(stats['misses'] > 0 and stats['hits'] > 0)
+            if tiles_in_memory < store.tiles_down*store.tiles_across:
+                self.assertTrue(stats['evictions'] > 0)
+    def test_random_uint8(self):
+        self.check_random(100,130,3,numpy.uint8,16,4)
+    def test_random_float(self):
+        self.check_random(37,61,1,numpy.float32,16,1)
+    def test_random_cached(self):
+        self.check_random(50,50,2,numpy.int16,32,100)
+    def test_getitem(self):
+        array = numpy.random.RandomState(1).randint(0,256,(70,90,3)).astype(numpy.uint8)
+        with tilestore.from_array(array,tile=32,ram_budget=0) as store:
+            numpy.testing.assert_array_equal(store[:],array)
+            numpy.testing.assert_array_equal(store[5:40,60:],array[5:40,60:])
+            numpy.testing.assert_array_equal(store[-10:,:-5],array[-10:,:-5])
+            numpy.testing.assert_array_equal(store[3:9,4:8,1],array[3:9,4:8,1])
+            self.assertRaises(ValueError,store.__getitem__,(slice(0,10,2),))
+    def test_outside(self):
+        with tilestore.store(10,10,tile=16) as store:
+            self.assertRaises(ValueError,store.read,5,5,6,1)
+            self.assertRaises(ValueError,store.write,numpy.zeros((2,2)),-1,0)
+    def test_from_drawable(self):
+        pixels = numpy.random.RandomState(2).randint(0,256,(150,40,4)).astype(numpy.uint8)
+        drawable = stub.drawable(40,150,4,pixels.tobytes())
+        with tilestore.from_drawable(drawable,tile=64) as store:
+            self.assertEqual(store.shape,(150,40,4))
+            numpy.testing.assert_array_equal(store.read(),pixels)
+    def test_close(self):
+        store = tilestore.store(20,20)
+        directory = store.directory
+        self.assertTrue(os.path.isdir(directory))
+        store.close()
+        self.assertFalse(os.path.exists(directory))
+
+if __name__ == '__main__':
+    unittest.main()